@@ -3,7 +3,7 @@ from dataclasses import dataclass, field, asdict
 from typing import Union, List, Optional
 from copy import deepcopy
 import logging
-from raftframe.log.log_api import LogRec, LogAPI
+from raftframe.log.log_api import LogRec, LogAPI, SnapshotRec, LogMetadata, record_size
 
 class Records:
 
@@ -11,11 +11,14 @@ class Records:
         # log record indexes start at 1, per raftframe spec
         self.index = 0
         self.entries = []
+        # records before this are in the snapshot
+        self.first_index = 1
+        self.snapshot = None
 
     def get_entry_at(self, index):
-        if index < 1 or self.index == 0:
+        if index < self.first_index or index > self.index:
             return None
-        return self.entries[index - 1]
+        return self.entries[index - self.first_index]
 
     def get_last_entry(self):
         return self.get_entry_at(self.index)
@@ -28,7 +31,25 @@ class Records:
 
     def insert_entry(self, rec: LogRec) -> LogRec:
         index = rec.index
-        self.entries[index-1] = rec
+        self.entries[index - self.first_index] = rec
+
+    def truncate(self, index):
+        if index > self.index:
+            return
+        self.entries = self.entries[:index - self.first_index]
+        self.index = index - 1
+
+    def install_snapshot(self, snapshot: SnapshotRec):
+        if snapshot.index < self.first_index:
+            return
+        keep = []
+        rec = self.get_entry_at(snapshot.index)
+        if rec is not None and rec.term == snapshot.term:
+            keep = self.entries[snapshot.index - self.first_index + 1:]
+        self.entries = keep
+        self.first_index = snapshot.index + 1
+        self.index = snapshot.index + len(keep)
+        self.snapshot = snapshot
     
     def save_entry(self, rec: LogRec) -> LogRec:
         return self.insert_entry(rec)
@@ -38,7 +59,7 @@ class MemoryLog(LogAPI):
 
     def __init__(self):
         self.records = Records()
-        self.term = 0
+        self.metadata = LogMetadata()
         self.server = None
         self.working_directory = None
         self.logger = logging.getLogger(__name__)
@@ -47,19 +68,32 @@ class MemoryLog(LogAPI):
         self.server = server
         self.working_directory = working_directory
     
+    def update_metadata(self):
+        self.metadata.last_index = self.records.index
+        self.metadata.first_index = self.records.first_index
+        self.metadata.durable_index = self.records.index
+        rec = self.records.get_last_entry()
+        if rec is not None:
+            self.metadata.last_term = rec.term
+        elif self.records.snapshot is not None:
+            self.metadata.last_term = self.records.snapshot.term
+        else:
+            self.metadata.last_term = 0
+
+    def get_metadata(self) -> LogMetadata:
+        return self.metadata
+        
     async def get_term(self) -> Union[int, None]:
-        if not isinstance(self.term, int):
-            breakpoint()
-        return self.term
+        return self.metadata.term
     
     async def set_term(self, value: int):
         if not isinstance(value, int):
             breakpoint()
-        self.term = value
+        self.metadata.term = value
 
     async def incr_term(self):
-        self.term += 1
-        return self.term
+        self.metadata.term += 1
+        return self.metadata.term
 
     async def append(self, entries: List[LogRec]) -> None:
         # make copies
@@ -69,6 +103,7 @@ class MemoryLog(LogAPI):
                               term=entry.term,
                               user_data=entry.user_data)
             self.records.add_entry(save_rec)
+        self.update_metadata()
         self.logger.debug("new log record %s", save_rec.index)
 
     async def replace_or_append(self, entry:LogRec) -> LogRec:
@@ -91,13 +126,24 @@ class MemoryLog(LogAPI):
             self.records.add_entry(save_rec)
         else:
             self.records.insert_entry(save_rec)
+        self.update_metadata()
         return deepcopy(save_rec)
     
+    async def truncate_from(self, index: int):
+        if index < self.records.first_index:
+            raise Exception(f"cannot truncate from index {index}, it is in the snapshot")
+        self.records.truncate(index)
+        self.update_metadata()
+
+    async def flush(self) -> int:
+        # nothing to sync, records are as durable as they will ever be
+        return self.metadata.durable_index
+
     async def read(self, index: Union[int, None] = None) -> Union[LogRec, None]:
         if index is None:
             rec = self.records.get_last_entry()
         else:
-            if index < 1:
+            if index < self.records.first_index:
                 raise Exception(f"cannot get index {index}, not in records")
             if index > self.records.index:
                 raise Exception(f"cannot get index {index}, not in records")
@@ -106,14 +152,47 @@ class MemoryLog(LogAPI):
             return None
         return deepcopy(rec)
 
+    async def read_range(self, start: int, end: Union[int, None] = None,
+                         max_bytes: Union[int, None] = None) -> List[LogRec]:
+        if start < self.records.first_index:
+            raise Exception(f"cannot get index {start}, not in records")
+        if end is None or end > self.records.index:
+            end = self.records.index
+        result = []
+        size = 0
+        for rec in self.records.entries[start - self.records.first_index:end - self.records.first_index + 1]:
+            size += record_size(rec)
+            if max_bytes is not None and result and size > max_bytes:
+                break
+            result.append(deepcopy(rec))
+        return result
+
+    async def iter_from(self, index: int, end: Union[int, None] = None):
+        if index < self.records.first_index:
+            raise Exception(f"cannot get index {index}, not in records")
+        while end is None or index <= end:
+            rec = self.records.get_entry_at(index)
+            if rec is None:
+                return
+            yield deepcopy(rec)
+            index += 1
+
     async def get_last_index(self):
-        return self.records.index
+        return self.metadata.last_index
 
     async def get_last_term(self):
-        if self.records.index == 0:
-            return 0
-        rec = self.records.get_last_entry()
-        return rec.term
+        return self.metadata.last_term
+
+    async def install_snapshot(self, snapshot: SnapshotRec):
+        self.records.install_snapshot(deepcopy(snapshot))
+        self.update_metadata()
+        self.logger.debug("installed snapshot at index %d", snapshot.index)
+
+    async def get_snapshot(self) -> Union[SnapshotRec, None]:
+        return deepcopy(self.records.snapshot)
+
+    async def get_first_index(self):
+        return self.metadata.first_index
     
 
 
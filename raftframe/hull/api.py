@@ -1,7 +1,7 @@
 import abc
 from dataclasses import dataclass
 from typing import List, Any
-from raftframe.log.log_api import LogAPI
+from raftframe.log.log_api import LogAPI, SnapshotRec
 
 class PilotAPI(metaclass=abc.ABCMeta):
     """
@@ -39,6 +39,61 @@ class PilotAPI(metaclass=abc.ABCMeta):
         """
         raise NotImplementedError
 
+    async def process_query(self, query: str) -> List[Any]: # pragma: no cover abstract
+        """ Run a read only query against the application's state machine and
+        return the result and error, like process_command. It must not change
+        anything, since it is not in the log and only runs on one server. The
+        raft library calls it once all the commands committed before the query
+        arrived have been applied, so it sees a consistent state. Only needed
+        if queries are used.
+        """
+        raise NotImplementedError
+
+    async def take_snapshot(self, index: int, term: int) -> SnapshotRec: # pragma: no cover abstract
+        """ Save the current state of the application's state machine, which is
+        the result of applying all the commands up to and including the one in
+        the log record at index. The returned snapshot's data is whatever the
+        pilot needs to find the saved state again. Once it is returned, the log
+        records it covers are discarded. Only needed if the cluster config
+        enables snapshots.
+        """
+        raise NotImplementedError
+
+    async def restore_snapshot(self, snapshot: SnapshotRec) -> None: # pragma: no cover abstract
+        """ Replace the current state of the application's state machine with
+        the state saved in the snapshot. Called at startup when the log has a
+        snapshot, after which only the commands in records following the snapshot
+        are applied. 
+        """
+        raise NotImplementedError
+
+    async def read_snapshot_chunk(self, snapshot: SnapshotRec, offset: int,
+                                  buffer: memoryview) -> int: # pragma: no cover abstract
+        """ Copy the snapshot's saved data, starting at offset, into the buffer
+        and return the number of bytes copied. Anything less than the size of the 
+        buffer means the end of the data was reached. Used to send the snapshot
+        to a follower that needs records the log no longer has, in chunks, so
+        the data never has to be in memory all at once.
+        """
+        raise NotImplementedError
+
+    async def write_snapshot_chunk(self, snapshot: SnapshotRec, offset: int,
+                                   chunk: memoryview) -> None: # pragma: no cover abstract
+        """ Save a chunk of a snapshot being received from the leader. Chunks
+        arrive in order, an offset of zero means the start of a new transfer, and
+        anything saved for an earlier one can be discarded. The snapshot only has
+        the index and term set.
+        """
+        raise NotImplementedError
+
+    async def finish_snapshot_transfer(self, snapshot: SnapshotRec) -> SnapshotRec: # pragma: no cover abstract
+        """ Called after the last chunk of a snapshot being received has been
+        saved. Return the snapshot with data set to whatever the pilot needs
+        to find the saved state again, it will then be restored and installed
+        in the log.
+        """
+        raise NotImplementedError
+
     @abc.abstractmethod
     async def send_message(self, target_uri: str, message:str):# pragma: no cover abstract
         raise NotImplementedError
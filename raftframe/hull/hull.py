@@ -8,6 +8,8 @@ from raftframe.states.follower import Follower
 from raftframe.states.candidate import Candidate
 from raftframe.states.leader import Leader
 from raftframe.hull.api import PilotAPI
+from raftframe.hull.membership import Membership
+from raftframe.log.log_api import RecordCode, record_size
 
 class Hull:
 
@@ -17,14 +19,41 @@ class Hull:
         if not isinstance(pilot, PilotAPI):
             raise Exception('Must supply a raftframe.hull.api.PilotAPI implementation')
         self.pilot = pilot
+        commit_quorum = cluster_config.commit_quorum
+        election_quorum = cluster_config.election_quorum
+        if (not 0 < commit_quorum < 1 or not 0.5 <= election_quorum < 1
+            or commit_quorum + election_quorum < 1):
+            raise Exception(f'Commit quorum {commit_quorum} and election quorum {election_quorum}'
+                            ' do not always intersect')
         self.log = pilot.get_log()
         self.state = BaseState(self, StateCode.paused)
         self.logger = logging.getLogger("Hull")
         self.state_async_handle = None
         self.state_run_after_target = None
         self.message_problem_history = []
+        # Raft paper's commitIndex and lastApplied
+        self.commit_index = 0
+        self.applied_index = 0
+        self.apply_task = None
+        # retry of a command the pilot failed on, kept apart from the
+        # state timer so it doesn't replace the leader's heartbeat
+        self.apply_retry_handle = None
+        # (index, future) for callers waiting for that index to be applied
+        self.apply_waiters = []
+        # size of the commands applied since the last snapshot
+        self.unsnapshotted_bytes = 0
+        # voting servers, from the latest cluster config record in the log
+        self.membership = Membership(nodes=list(cluster_config.node_uris))
 
     async def start(self):
+        snapshot = await self.log.get_snapshot()
+        if snapshot is not None:
+            # no need to replay records that the snapshot covers
+            await self.pilot.restore_snapshot(snapshot)
+            self.commit_index = snapshot.index
+            self.applied_index = snapshot.index
+            self.logger.info("%s restored snapshot at index %d", self.get_my_uri(), snapshot.index)
+        await self.load_membership()
         self.state = Follower(self)
         await self.state.start()
 
@@ -35,11 +64,11 @@ class Hull:
             self.state_async_handle.cancel()
             self.state_async_handle = None
                 
-    async def start_campaign(self):
+    async def start_campaign(self, transfer=False):
         await self.stop_state()
-        self.state = Candidate(self)
+        self.state = Candidate(self, transfer)
         await self.state.start()
-        self.logger.warning("%s started campaign %s", self.get_my_uri(), await self.log.get_term())
+        self.logger.warning("%s started campaign %s", self.get_my_uri(), self.log.get_metadata().term)
 
     async def win_vote(self, new_term):
         await self.stop_state()
@@ -49,6 +78,9 @@ class Hull:
 
     async def demote_and_handle(self, message=None):
         self.logger.warning("%s demoting to follower from %s", self.get_my_uri(), self.state)
+        if self.state.state_code == StateCode.leader:
+            # somebody else may be leader now, so local reads are not safe
+            self.state.revoke_lease()
         await self.stop_state()
         # special case where candidate or leader got an append_entries message,
         # which means we need to switch to follower and retry
@@ -81,6 +113,9 @@ class Hull:
 
     async def apply_command(self, command):
         if self.state.state_code == StateCode.leader:
+            if self.state.transfer_target is not None:
+                # handing over to another server, it will take these soon
+                return dict(result=None, retry=1, redirect=None)
             result = await self.state.apply_command(command)
             return dict(result=result, retry=None, redirect=None)
         elif self.state.state_code == StateCode.follower:
@@ -88,6 +123,199 @@ class Hull:
         elif self.state.state_code == StateCode.candidate:
             return dict(result=None, retry=1, redirect=None)
 
+    async def apply_query(self, query):
+        if self.state.state_code == StateCode.leader:
+            result = await self.state.apply_query(query)
+            return dict(result=result, retry=None, redirect=None)
+        elif self.state.state_code == StateCode.follower:
+            if self.state.leader_uri is None:
+                return dict(result=None, retry=1, redirect=None)
+            # followers can answer too, with the leader's help
+            result = await self.state.apply_query(query)
+            return dict(result=result, retry=None, redirect=None)
+        elif self.state.state_code == StateCode.candidate:
+            return dict(result=None, retry=1, redirect=None)
+
+    async def transfer_leadership(self, target_uri, timeout=None):
+        # Raft thesis section 3.10, hand leadership to the target server
+        # without waiting for timeouts. Raises if this is not the leader or
+        # the target has not taken over within the timeout, which defaults
+        # to the minimum election timeout.
+        if self.state.state_code != StateCode.leader:
+            raise Exception(f'{self.get_my_uri()} is not leader, cannot transfer leadership')
+        if timeout is None:
+            timeout = self.get_election_timeout_min()
+        await self.state.transfer_leadership(target_uri, timeout)
+
+    async def change_membership(self, node_uris, learners=None, timeout=1.0):
+        # Raft paper section 6, switch the voting servers to node_uris,
+        # through a joint config, while commands keep flowing. Current
+        # learners stay unless they are promoted or learners is given.
+        if self.state.state_code != StateCode.leader:
+            raise Exception(f'{self.get_my_uri()} is not leader, cannot change membership')
+        if learners is None:
+            learners = [uri for uri in self.membership.learners if uri not in node_uris]
+        await self.state.change_membership(node_uris, learners, timeout)
+
+    async def add_learner(self, uri, timeout=1.0):
+        # Learner gets everything from the leader without changing the quorum
+        await self.change_membership(self.membership.nodes, self.membership.learners + [uri],
+                                     timeout)
+
+    async def promote_learner(self, uri, timeout=1.0):
+        # Once the learner has caught up, make it a voter
+        if self.state.state_code != StateCode.leader:
+            raise Exception(f'{self.get_my_uri()} is not leader, cannot change membership')
+        if uri not in self.membership.learners:
+            raise Exception(f'{uri} is not a learner')
+        await self.state.wait_for_match(uri, self.commit_index, timeout)
+        await self.change_membership(self.membership.nodes + [uri], timeout=timeout)
+
+    async def membership_at(self, index):
+        # Latest config record at or before index, or the snapshot's
+        # config, or the static one if it has never changed
+        first_index = self.log.get_metadata().first_index
+        while index >= first_index and index > 0:
+            start = max(first_index, index - 63)
+            for rec in reversed(await self.log.read_range(start, index)):
+                if rec.code == RecordCode.cluster_confit:
+                    return Membership.from_json(rec.user_data, rec.index)
+            index = start - 1
+        snapshot = await self.log.get_snapshot()
+        if snapshot is not None and snapshot.config is not None:
+            return Membership.from_json(snapshot.config, snapshot.index)
+        return Membership(nodes=list(self.cluster_config.node_uris))
+
+    async def load_membership(self):
+        membership = await self.membership_at(self.log.get_metadata().last_index)
+        if membership != self.membership:
+            self.logger.info("%s cluster membership now %s", self.get_my_uri(), membership)
+            self.membership = membership
+            await self.state.membership_changed()
+
+    async def records_saved(self, records):
+        # New config takes effect as soon as it is in the log,
+        # no need to wait for commit
+        for rec in records:
+            if rec.code == RecordCode.cluster_confit:
+                await self.load_membership()
+                return
+
+    async def set_commit_index(self, index):
+        # Records up to the index are known to be committed, so they can be
+        # applied. That happens in a separate task so that message handling
+        # does not wait on the pilot's command processing.
+        if index > self.commit_index:
+            self.commit_index = index
+        if self.applied_index < self.commit_index:
+            if self.apply_task is None or self.apply_task.done():
+                self.apply_task = asyncio.get_event_loop().create_task(self.apply_committed())
+
+    async def apply_committed(self):
+        while self.applied_index < self.commit_index:
+            start_index = self.applied_index
+            async for rec in self.log.iter_from(self.applied_index + 1, self.commit_index):
+                index = rec.index
+                if index != self.applied_index + 1:
+                    # a snapshot was installed while we were applying,
+                    # start again after it
+                    break
+                result = None
+                error = None
+                if rec.code == RecordCode.client:
+                    try:
+                        result, error = await self.pilot.process_command(rec.user_data)
+                    except Exception as e:
+                        # Can't skip it, later commands may depend on it, so try
+                        # again shortly. Whoever waits on it keeps waiting, the
+                        # command is in the log and will be applied.
+                        self.logger.error("%s processing command at index %d failed, %s", self.get_my_uri(),
+                                          index, traceback.format_exc())
+                        self.schedule_apply_retry()
+                        return
+                    if error is not None:
+                        self.logger.warning("%s processor ran command at index %d but had an error",
+                                            self.get_my_uri(), index)
+                self.applied_index = index
+                self.unsnapshotted_bytes += record_size(rec)
+                await self.state.command_applied(index, result, error)
+                self.release_apply_waiters()
+                await self.check_snapshot_policy(rec)
+            if self.applied_index == start_index:
+                # records not in the log yet
+                return
+
+    def schedule_apply_retry(self):
+        if self.apply_retry_handle is not None:
+            self.apply_retry_handle.cancel()
+        loop = asyncio.get_event_loop()
+        self.apply_retry_handle = loop.call_later(self.get_heartbeat_period(),
+                                                  lambda: asyncio.create_task(self.retry_apply()))
+
+    async def retry_apply(self):
+        self.apply_retry_handle = None
+        if self.state.stopped:
+            return
+        await self.set_commit_index(self.commit_index)
+
+    def release_apply_waiters(self):
+        waiting = []
+        for index, waiter in self.apply_waiters:
+            if index > self.applied_index:
+                waiting.append((index, waiter))
+            elif not waiter.done():
+                waiter.set_result(True)
+        self.apply_waiters = waiting
+
+    async def wait_for_applied(self, index, timeout=1.0):
+        if index <= self.applied_index:
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self.apply_waiters.append((index, waiter))
+        try:
+            await asyncio.wait_for(waiter, timeout=timeout)
+        except asyncio.TimeoutError:
+            raise Exception(f'Index {index} not applied in {timeout} seconds')
+
+    async def check_snapshot_policy(self, rec):
+        max_entries = self.cluster_config.snapshot_max_entries
+        max_bytes = self.cluster_config.snapshot_max_bytes
+        if max_entries == 0 and max_bytes == 0:
+            return
+        first_index = self.log.get_metadata().first_index
+        if ((max_entries and rec.index - first_index + 1 >= max_entries)
+            or (max_bytes and self.unsnapshotted_bytes >= max_bytes)):
+            await self.take_snapshot(rec.index, rec.term)
+
+    async def take_snapshot(self, index, term):
+        # Pilot state is exactly as of the last applied record, since
+        # nothing else gets applied while we wait here.
+        snapshot = await self.pilot.take_snapshot(index, term)
+        snapshot.config = (await self.membership_at(index)).to_json()
+        await self.log.install_snapshot(snapshot)
+        self.unsnapshotted_bytes = 0
+        self.logger.info("%s took snapshot at index %d", self.get_my_uri(), index)
+
+    async def install_received_snapshot(self, snapshot):
+        # Whatever is being applied right now has to finish before
+        # the state gets replaced
+        if self.apply_task is not None and not self.apply_task.done():
+            await self.apply_task
+        if snapshot.index <= self.applied_index:
+            return
+        config = snapshot.config
+        snapshot = await self.pilot.finish_snapshot_transfer(snapshot)
+        snapshot.config = config
+        await self.pilot.restore_snapshot(snapshot)
+        await self.log.install_snapshot(snapshot)
+        await self.load_membership()
+        self.commit_index = max(self.commit_index, snapshot.index)
+        self.applied_index = snapshot.index
+        self.unsnapshotted_bytes = 0
+        self.release_apply_waiters()
+        self.logger.info("%s installed snapshot at index %d from leader", self.get_my_uri(),
+                         snapshot.index)
+
     async def state_after_runner(self, target):
         if self.state.stopped:
             return
@@ -127,10 +355,37 @@ class Hull:
         return self.pilot
     
     async def get_term(self):
-        return await self.log.get_term()
+        return self.log.get_metadata().term
+
+    def get_commit_index(self):
+        return self.commit_index
+
+    def get_applied_index(self):
+        return self.applied_index
 
     def get_cluster_node_ids(self):
-        return self.cluster_config.node_uris
+        return self.membership.all_nodes()
+
+    def get_membership(self):
+        return self.membership
+
+    def get_voter_ids(self):
+        return self.membership.voters()
+
+    def get_node_weights(self):
+        return self.cluster_config.node_weights
+
+    def get_commit_quorum(self):
+        return self.cluster_config.commit_quorum
+
+    def is_quorum(self, uris):
+        # enough to commit, or to confirm leadership
+        return self.membership.is_quorum(uris, self.cluster_config.node_weights,
+                                         self.cluster_config.commit_quorum)
+
+    def is_election_quorum(self, uris):
+        return self.membership.is_quorum(uris, self.cluster_config.node_weights,
+                                         self.cluster_config.election_quorum)
 
     def get_leader_lost_timeout(self):
         return self.cluster_config.leader_lost_timeout
@@ -138,7 +393,71 @@ class Hull:
     def get_heartbeat_period(self):
         return self.cluster_config.heartbeat_period
 
+    def get_command_batch_window(self):
+        return self.cluster_config.command_batch_window
+
+    def get_command_batch_max_count(self):
+        return self.cluster_config.command_batch_max_count
+
+    def get_command_batch_max_bytes(self):
+        return self.cluster_config.command_batch_max_bytes
+
+    def get_catchup_max_entries(self):
+        return self.cluster_config.catchup_max_entries
+
+    def get_catchup_max_bytes(self):
+        return self.cluster_config.catchup_max_bytes
+
+    def get_max_in_flight_messages(self):
+        return self.cluster_config.max_in_flight_messages
+
+    def get_max_in_flight_bytes(self):
+        return self.cluster_config.max_in_flight_bytes
+
+    def get_snapshot_chunk_size(self):
+        return self.cluster_config.snapshot_chunk_size
+
+    def get_leader_lease(self):
+        return self.cluster_config.leader_lease
+
+    def get_lease_clock_drift(self):
+        return self.cluster_config.lease_clock_drift
+
+    def get_pre_vote(self):
+        return self.cluster_config.pre_vote
+
+    def get_election_timeout_min(self):
+        return self.cluster_config.election_timeout_min
+
+    def get_election_priority(self, uri=None):
+        if uri is None:
+            uri = self.get_my_uri()
+        priorities = self.cluster_config.election_priorities
+        if not priorities:
+            return 0
+        return priorities.get(uri, 0)
+
+    def get_election_timeout_band(self):
+        # Higher priority servers get the earlier part of the range
+        t_min = self.cluster_config.election_timeout_min
+        t_max = self.cluster_config.election_timeout_max
+        if not self.cluster_config.election_priorities:
+            return t_min, t_max
+        if self.get_my_uri() not in self.get_voter_ids():
+            # learners and removed servers don't campaign, bands are for voters
+            return t_min, t_max
+        levels = sorted(set(self.get_election_priority(uri) for uri in self.get_voter_ids()),
+                        reverse=True)
+        width = (t_max - t_min) / len(levels)
+        low = t_min + levels.index(self.get_election_priority()) * width
+        return low, low + width
+
+    def get_priority_delay(self):
+        # how much longer than the top priority servers we wait to campaign
+        low, high = self.get_election_timeout_band()
+        return low - self.cluster_config.election_timeout_min
+
     def get_election_timeout(self):
-        res = random.uniform(self.cluster_config.election_timeout_min,
-                             self.cluster_config.election_timeout_max)
+        low, high = self.get_election_timeout_band()
+        res = random.uniform(low, high)
         return res
@@ -35,6 +35,9 @@ class ClusterConfig:
             A list of addresses of the all nodes in the cluster
             in the same form as the uri in the LocalConfig. This server's
             uri is in there too.
+            This is the starting membership, once a change has been made
+            through Hull.change_membership the cluster config records in
+            the log say who is in the cluster.
         heartbeat_period:
             Leader sends a heartbeat message if it hasn't sent other messages 
             in this amount of time (float seconds)
@@ -48,11 +51,99 @@ class ClusterConfig:
             start another election if no leader elected in a random
             amount of time bounded by election_timeout_min and election_timeout_max,
             raft paper suggests range of 150 to 350 milliseconds
+            The leader resigns if a majority of the servers have not answered
+            it in election_timeout_min, since they may have elected another.
+        command_batch_window:
+            Leader collects commands that arrive within this amount of time
+            (float seconds) after the first one and sends them as a single
+            append entries message, saved with a single log append. Zero
+            means no batching, each command is sent as soon as it arrives.
+        command_batch_max_count:
+            Leader sends a collected batch early if it reaches this many commands
+        command_batch_max_bytes:
+            Leader sends a collected batch early if the commands in it reach
+            this total size, in utf-8 encoded bytes
+        catchup_max_entries:
+            When a follower is behind, the leader sends it up to this many
+            consecutive log entries in each catch up append entries message
+        catchup_max_bytes:
+            Limit on the total size of commands in a catch up message, in utf-8
+            encoded bytes. At least one entry is always sent.
+        max_in_flight_messages:
+            Each follower gets its own task that sends it new commands, and it
+            will not have more than this many append entries messages waiting
+            for a response. Others wait their turn, so a slow follower gets
+            backpressure without slowing down the others.
+        max_in_flight_bytes:
+            Limit on the total size of commands in messages waiting for a 
+            response from one follower, in utf-8 encoded bytes. One message
+            is always allowed, no matter how big.
+        snapshot_max_entries:
+            Take a snapshot of the state machine and discard the log records
+            it covers once this many records have been applied since the last
+            one. Zero means never, based on count.
+        snapshot_max_bytes:
+            Take a snapshot once the commands applied since the last one reach
+            this total size, in utf-8 encoded bytes. Zero means never, based on size.
+        snapshot_chunk_size:
+            When a follower needs records that the leader's log no longer has,
+            the leader sends it the snapshot in chunks of this many bytes. The
+            in flight limits apply to these too.
+        leader_lease:
+            Let the leader answer reads without contacting the others, for as
+            long as a quorum has recently answered its heartbeats. Followers
+            then refuse to vote while they still hear from a leader. This is
+            only safe if server clocks run at close to the same rate.
+        lease_clock_drift:
+            Fraction by which a server's clock might run faster or slower than the
+            others. The lease lasts for the leader lost timeout, less this fraction,
+            counted from when the heartbeats that a quorum answered were sent.
+        pre_vote:
+            Before starting an election, a candidate asks the others if they would
+            vote for it, and only raises its term if a majority says yes. Servers
+            that still hear from a leader say no, so a server that rejoins after
+            being cut off doesn't depose a healthy leader.
+        election_priorities:
+            Optional dict of node uri to an integer priority, missing ones are 0.
+            The election timeout range is split into one band per priority level,
+            and higher priority servers wait in the earlier bands, so they campaign
+            first. A leader hands leadership over to a higher priority server
+            that is keeping up with it.
+        node_weights:
+            Optional dict of node uri to voting weight, missing ones are 1.
+        commit_quorum:
+            A record is committed once the servers that have it hold more than
+            this fraction of the total voting weight. Leadership confirmation for
+            reads and the leader's check quorum use it too.
+        election_quorum:
+            A candidate wins once servers holding more than this fraction of the
+            voting weight vote for it. It must be at least 0.5, so that only one
+            leader can win a term, and commit_quorum plus election_quorum must
+            be at least 1, so that every election quorum includes a server that
+            has every committed record (Flexible Paxos). For example, with five
+            equal servers, 0.3 and 0.7 commit with two and elect with four.
     """
     node_uris: list # addresses of other nodes in the cluster
     heartbeat_period: float
     leader_lost_timeout: float
     election_timeout_min: float
     election_timeout_max: float
+    command_batch_window: float = 0.0
+    command_batch_max_count: int = 100
+    command_batch_max_bytes: int = 1024 * 1024
+    catchup_max_entries: int = 100
+    catchup_max_bytes: int = 1024 * 1024
+    max_in_flight_messages: int = 10
+    max_in_flight_bytes: int = 10 * 1024 * 1024
+    snapshot_max_entries: int = 0
+    snapshot_max_bytes: int = 0
+    snapshot_chunk_size: int = 1024 * 1024
+    leader_lease: bool = False
+    lease_clock_drift: float = 0.1
+    pre_vote: bool = False
+    election_priorities: dict = None
+    node_weights: dict = None
+    commit_quorum: float = 0.5
+    election_quorum: float = 0.5
 
     
@@ -0,0 +1,75 @@
+"""
+Cluster membership, as set by the latest cluster config record in the log.
+"""
+import json
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+def node_weight(weights, uri):
+    """ Voting weight of the server, one unless weights says otherwise """
+    if weights is None:
+        return 1
+    return weights.get(uri, 1)
+
+@dataclass
+class Membership:
+    """
+    The servers that vote in elections and count for commits. Servers use the
+    latest config in their log, whether it is committed or not. During a change
+    the config is joint, and decisions need a majority of both the old and the
+    new servers (Raft paper section 6). Learners get records from the leader
+    but don't vote and don't count for commits.
+
+    Args:
+        nodes:
+            The voting servers, the new ones if the config is joint
+        old_nodes:
+            The voting servers before the change, None unless joint
+        index:
+            Log index of the config record, 0 for the static cluster config
+        learners:
+            Non voting servers, usually catching up before being promoted
+    """
+    nodes: List[str]
+    old_nodes: Optional[List[str]] = None
+    index: int = field(default=0)
+    learners: List[str] = field(default_factory=list)
+
+    def is_joint(self) -> bool:
+        return self.old_nodes is not None
+
+    def voters(self) -> List[str]:
+        """ Every server that votes, old ones first """
+        if self.old_nodes is None:
+            return list(self.nodes)
+        return list(self.old_nodes) + [uri for uri in self.nodes if uri not in self.old_nodes]
+
+    def all_nodes(self) -> List[str]:
+        """ Every server that gets messages from the leader, learners last """
+        voters = self.voters()
+        return voters + [uri for uri in self.learners if uri not in voters]
+
+    def is_quorum(self, uris, weights=None, fraction=0.5) -> bool:
+        """
+        True if the servers in uris have more than fraction of the voting weight,
+        or of both halves if joint. Weights default to one per server, so the
+        default is a simple majority.
+        """
+        for voters in (self.nodes, self.old_nodes):
+            if voters is None:
+                continue
+            total = sum(node_weight(weights, uri) for uri in voters)
+            have = sum(node_weight(weights, uri) for uri in voters if uri in uris)
+            if have <= total * fraction:
+                return False
+        return True
+
+    def to_json(self) -> str:
+        return json.dumps(dict(nodes=self.nodes, old_nodes=self.old_nodes, learners=self.learners))
+
+    @classmethod
+    def from_json(cls, data, index):
+        values = json.loads(data)
+        return cls(nodes=values['nodes'], old_nodes=values['old_nodes'], index=index,
+                   learners=values.get('learners', []))
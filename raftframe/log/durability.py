@@ -0,0 +1,138 @@
+"""
+Durability tracking shared by the log implementations that write to disk.
+"""
+import asyncio
+import logging
+from typing import Callable, Awaitable
+from raftframe.log.log_api import DurabilityPolicy, DurabilityMode, LogMetadata
+
+
+class Syncer:
+    """
+    Does the syncing a DurabilityPolicy calls for and keeps the durable index
+    in the log's metadata. The log tells it about every write, and supplies
+    the function that makes everything written so far durable.
+
+    Args:
+        policy:
+            The durability policy
+        sync_func:
+            Async function that syncs all writes made before it was called
+        metadata:
+            The log's metadata, the durable index in it is kept here
+    """
+
+    def __init__(self, policy: DurabilityPolicy, sync_func: Callable[[], Awaitable[None]],
+                 metadata: LogMetadata):
+        self.policy = policy
+        self.sync_func = sync_func
+        self.metadata = metadata
+        # last index written, durable or not
+        self.written_index = 0
+        # lowest index rewritten while a sync was running, that sync
+        # can't vouch for anything after it
+        self.low_water = None
+        self.pending_bytes = 0
+        self.sync_lock = asyncio.Lock()
+        self.timer_task = None
+        # (index, future) for callers of flush
+        self.waiters = []
+        self.logger = logging.getLogger(__name__)
+
+    def reset(self, index: int):
+        """ Everything up to index is on disk, as when the log is opened """
+        self.written_index = index
+        self.metadata.durable_index = index
+
+    async def written(self, first_index: int, last_index: int, nbytes: int):
+        """ Records from first_index to last_index were written, replacing
+        any that were there, and they are now the end of the log.
+        """
+        self.written_index = last_index
+        if first_index - 1 < self.metadata.durable_index:
+            self.metadata.durable_index = first_index - 1
+        if self.low_water is not None:
+            self.low_water = min(self.low_water, first_index - 1)
+        if self.policy.mode == DurabilityMode.none:
+            self.metadata.durable_index = last_index
+        elif self.policy.mode == DurabilityMode.every_append:
+            await self.sync()
+        else:
+            self.pending_bytes += nbytes
+            if self.pending_bytes >= self.policy.group_bytes:
+                await self.sync()
+            elif self.timer_task is None:
+                self.timer_task = asyncio.create_task(self.group_timer())
+
+    async def snapshot_installed(self, last_index: int):
+        """ The log now ends at last_index after a snapshot, sync right away,
+        it is rare and everything after it depends on it.
+        """
+        self.written_index = last_index
+        if self.policy.mode == DurabilityMode.none:
+            self.metadata.durable_index = last_index
+        else:
+            await self.sync(force=True)
+        self.wake_waiters()
+
+    async def group_timer(self):
+        await asyncio.sleep(self.policy.group_ms / 1000.0)
+        self.timer_task = None
+        await self.sync()
+
+    async def sync(self, force=False):
+        """ Sync now if anything written isn't durable yet, or if forced
+        because the log changed something other than the records. Never
+        syncs if the policy is not to.
+        """
+        if self.policy.mode == DurabilityMode.none:
+            return
+        async with self.sync_lock:
+            target = self.written_index
+            if self.metadata.durable_index >= target and not force:
+                return
+            self.pending_bytes = 0
+            self.low_water = target
+            try:
+                await self.sync_func()
+            finally:
+                durable = min(target, self.low_water)
+                self.low_water = None
+            if durable > self.metadata.durable_index:
+                self.metadata.durable_index = durable
+            self.wake_waiters()
+
+    def wake_waiters(self):
+        waiting = []
+        for index, future in self.waiters:
+            if future.done():
+                continue
+            if index <= self.metadata.durable_index or index > self.written_index:
+                # done, or the records were cut and won't be coming
+                future.set_result(self.metadata.durable_index)
+            else:
+                waiting.append((index, future))
+        self.waiters = waiting
+
+    async def flush(self) -> int:
+        target = self.written_index
+        if self.metadata.durable_index >= target:
+            return self.metadata.durable_index
+        if self.policy.mode != DurabilityMode.group:
+            await self.sync()
+            return self.metadata.durable_index
+        # wait for the group sync, so that concurrent callers share it
+        if self.timer_task is None:
+            self.timer_task = asyncio.create_task(self.group_timer())
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((target, future))
+        return await future
+
+    async def stop(self):
+        if self.timer_task is not None:
+            self.timer_task.cancel()
+            self.timer_task = None
+        for index, future in self.waiters:
+            if not future.done():
+                future.set_result(self.metadata.durable_index)
+        self.waiters = []
@@ -0,0 +1,543 @@
+"""
+File implementation of the LogAPI, an append only log kept in fixed size
+segment files that are memory mapped for reading.
+"""
+import os
+import json
+import mmap
+import zlib
+import struct
+import asyncio
+import logging
+from pathlib import Path
+from typing import Union, List
+from raftframe.log.log_api import LogRec, LogAPI, SnapshotRec, LogMetadata, RecordCode, record_size
+from raftframe.log.log_api import DurabilityPolicy
+from raftframe.log.durability import Syncer
+
+# data length, crc, index, term, record code, data kind. The crc covers
+# everything after itself, including the data.
+HEADER = struct.Struct("<IIQQBB")
+CRC_START = 8
+CODES = list(RecordCode)
+# how many records iter_from reads at a time
+ITER_CHUNK = 64
+# how user data is stored, so that it comes back as the same type
+KIND_NONE = 0
+KIND_STR = 1
+KIND_BYTES = 2
+
+
+def encode_data(data):
+    if data is None:
+        return KIND_NONE, b''
+    if isinstance(data, str):
+        return KIND_STR, data.encode()
+    return KIND_BYTES, bytes(data)
+
+def decode_data(kind, view):
+    if kind == KIND_NONE:
+        return None
+    if kind == KIND_STR:
+        return str(view, 'utf-8')
+    return bytes(view)
+
+def encode_record(rec: LogRec) -> bytes:
+    kind, data = encode_data(rec.user_data)
+    header = HEADER.pack(len(data), 0, rec.index, rec.term, CODES.index(rec.code), kind)
+    crc = zlib.crc32(data, zlib.crc32(header[CRC_START:]))
+    return HEADER.pack(len(data), crc, rec.index, rec.term, CODES.index(rec.code), kind) + data
+
+def sync_dir(directory: Path):
+    """ Make the directory's entries durable, a new or renamed file isn't until this is done """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_file(path: Path, data: bytes):
+    """ Replace the file with data, so that a crash leaves the old or the new, never a mix """
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    sync_dir(path.parent)
+
+
+class Segment:
+    """
+    One segment file. It is created at full size and mapped once, records
+    are written into the map one after another, and an all zero header
+    marks the end. A sparse index keeps the offset of every interval'th
+    record, a read walks forward from the nearest one. The index lives in
+    memory and is rebuilt by the scan that checks the records on open.
+    """
+
+    def __init__(self, path: Path, first_index: int, interval: int):
+        self.path = path
+        self.first_index = first_index
+        self.last_index = first_index - 1
+        self.last_term = 0
+        self.interval = interval
+        self.offsets = []
+        self.end = 0
+        self.file = None
+        self.mm = None
+
+    @classmethod
+    def create(cls, directory: Path, first_index: int, size: int, interval: int):
+        path = Path(directory, f"{first_index:020d}.seg")
+        with open(path, "wb") as f:
+            if hasattr(os, "posix_fallocate"):
+                # real blocks, so a full disk fails here rather than
+                # with a SIGBUS on a write into the map
+                os.posix_fallocate(f.fileno(), 0, size)
+            else:
+                f.truncate(size)
+            os.fsync(f.fileno())
+        sync_dir(directory)
+        seg = cls(path, first_index, interval)
+        seg.open()
+        return seg
+
+    def open(self):
+        self.file = open(self.path, "r+b")
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        self.scan()
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def delete(self):
+        self.close()
+        os.unlink(self.path)
+
+    def size(self) -> int:
+        return len(self.mm)
+
+    def has_room(self, nbytes) -> bool:
+        return self.end + nbytes <= len(self.mm)
+
+    def scan(self):
+        """ Find the valid records, stopping at the end marker, a bad crc
+        or a record out of sequence, any of which is a torn write.
+        """
+        offset = 0
+        index = self.first_index
+        self.offsets = []
+        while offset + HEADER.size <= len(self.mm):
+            length, crc, rec_index, term, code, kind = HEADER.unpack_from(self.mm, offset)
+            if length == 0 and crc == 0 and rec_index == 0:
+                break
+            stop = offset + HEADER.size + length
+            if rec_index != index or stop > len(self.mm):
+                break
+            view = memoryview(self.mm)[offset + CRC_START:stop]
+            ok = zlib.crc32(view) == crc
+            view.release()
+            if not ok:
+                break
+            if (index - self.first_index) % self.interval == 0:
+                self.offsets.append(offset)
+            self.last_index = index
+            self.last_term = term
+            index += 1
+            offset = stop
+        self.end = offset
+        # clear anything after a torn write so it can't come back later,
+        # only touching the pages that need it
+        chunk = mmap.PAGESIZE * 16
+        zeros = bytes(chunk)
+        for start in range(self.end, len(self.mm), chunk):
+            stop = min(start + chunk, len(self.mm))
+            if self.mm[start:stop] != zeros[:stop - start]:
+                self.mm[start:stop] = zeros[:stop - start]
+
+    def write(self, rec: LogRec, data: bytes):
+        if (rec.index - self.first_index) % self.interval == 0:
+            self.offsets.append(self.end)
+        self.mm[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        self.last_index = rec.index
+        self.last_term = rec.term
+
+    def find(self, index: int) -> int:
+        slot = (index - self.first_index) // self.interval
+        offset = self.offsets[slot]
+        for i in range(self.first_index + slot * self.interval, index):
+            length = HEADER.unpack_from(self.mm, offset)[0]
+            offset += HEADER.size + length
+        return offset
+
+    def read_view(self, index: int):
+        """ The header values and a view of the user data in the map, no copies """
+        offset = self.find(index)
+        length, crc, rec_index, term, code, kind = HEADER.unpack_from(self.mm, offset)
+        start = offset + HEADER.size
+        return rec_index, term, CODES[code], kind, memoryview(self.mm)[start:start + length]
+
+    def read_records(self, start: int, end: int, max_bytes: Union[int, None],
+                     size: int = 0, have: int = 0):
+        """ Records from start to end in this segment, walking the map once.
+        The caller may already have some, have is how many and size is their
+        total, which is returned updated along with the records.
+        """
+        result = []
+        offset = self.find(start)
+        for index in range(start, min(end, self.last_index) + 1):
+            length, crc, rec_index, term, code, kind = HEADER.unpack_from(self.mm, offset)
+            data_start = offset + HEADER.size
+            view = memoryview(self.mm)[data_start:data_start + length]
+            rec = LogRec(code=CODES[code], index=rec_index, term=term,
+                         user_data=decode_data(kind, view))
+            view.release()
+            size += record_size(rec)
+            if max_bytes is not None and (result or have) and size > max_bytes:
+                break
+            result.append(rec)
+            offset = data_start + length
+        return result, size
+
+    def cut(self, index: int):
+        """ Drop the records from index on """
+        offset = self.find(index)
+        self.mm[offset:self.end] = bytes(self.end - offset)
+        self.end = offset
+        self.offsets = self.offsets[:(index - self.first_index + self.interval - 1) // self.interval]
+        self.last_index = index - 1
+        if self.last_index < self.first_index:
+            self.last_term = 0
+        else:
+            self.last_term = HEADER.unpack_from(self.mm, self.find(self.last_index))[3]
+
+    def flush(self):
+        self.mm.flush()
+
+
+class FileLog(LogAPI):
+    """
+    Keeps the log in a directory of segment files. Records are appended to
+    the last segment, each with a length, crc, index and term header, and a
+    new segment is started when one fills up. Reads go through the memory
+    map. Installing a snapshot deletes the segments it covers whole, records
+    before the first index in a partly covered segment just get skipped.
+    The term and the snapshot are kept in their own small files.
+
+    Record user data and snapshot data must be None, str or bytes.
+
+    Args:
+        segment_size:
+            Size of each segment file in bytes, a record bigger than this
+            gets a segment of its own sized to fit
+        index_interval:
+            How many records apart the sparse index entries are
+        dirname:
+            Name of the log directory in the working directory
+        durability:
+            When records are synced, every append if not given. The term
+            and snapshot files are always synced when written.
+    """
+
+    def __init__(self, segment_size: int = 64 * 1024 * 1024, index_interval: int = 64,
+                 dirname: str = "raft_log", durability: DurabilityPolicy = None):
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        self.dirname = dirname
+        self.directory = None
+        self.working_directory = None
+        self.segments = []
+        # segments written since the last sync
+        self.dirty = []
+        self.snapshot = None
+        self.write_lock = asyncio.Lock()
+        self.metadata = LogMetadata()
+        if durability is None:
+            durability = DurabilityPolicy()
+        self.syncer = Syncer(durability, self.sync, self.metadata)
+        self.logger = logging.getLogger(__name__)
+
+    async def start(self, working_directory: os.PathLike):
+        self.working_directory = working_directory
+        self.directory = Path(working_directory, self.dirname)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        term_path = Path(self.directory, "term")
+        if term_path.exists():
+            self.metadata.term = json.loads(term_path.read_text())['term']
+        snap_path = Path(self.directory, "snapshot")
+        if snap_path.exists():
+            self.snapshot = self.load_snapshot(snap_path)
+        self.segments = []
+        for path in sorted(self.directory.glob("*.seg")):
+            seg = Segment(path, int(path.stem), self.index_interval)
+            if self.segments and seg.first_index != self.segments[-1].last_index + 1:
+                # an earlier segment lost its tail, so nothing after it counts
+                os.unlink(path)
+                continue
+            seg.open()
+            self.segments.append(seg)
+        first_index = 1
+        if self.snapshot is not None:
+            first_index = self.snapshot.index + 1
+            # a crash during install_snapshot can leave records that it discards
+            term = self.term_in_segments(self.snapshot.index)
+            if term is not None and term != self.snapshot.term:
+                self.drop_segments(len(self.segments))
+            else:
+                self.drop_segments(self.covered_count(self.snapshot.index))
+        self.metadata.first_index = first_index
+        self.update_metadata()
+        self.syncer.reset(self.metadata.last_index)
+
+    async def sync(self):
+        dirty = self.dirty
+        self.dirty = []
+        loop = asyncio.get_running_loop()
+        for seg in dirty:
+            if seg.mm is not None:
+                await loop.run_in_executor(None, seg.flush)
+
+    async def flush(self) -> int:
+        return await self.syncer.flush()
+
+    async def close(self):
+        await self.syncer.sync()
+        await self.syncer.stop()
+        for seg in self.segments:
+            seg.close()
+        self.segments = []
+
+    def load_snapshot(self, path: Path) -> SnapshotRec:
+        raw = path.read_bytes()
+        split = raw.index(b"\n")
+        header = json.loads(raw[:split])
+        data = decode_data(header['kind'], memoryview(raw)[split + 1:])
+        return SnapshotRec(index=header['index'], term=header['term'], data=data,
+                           config=header['config'])
+
+    def term_in_segments(self, index: int) -> Union[int, None]:
+        for seg in self.segments:
+            if seg.first_index <= index <= seg.last_index:
+                return HEADER.unpack_from(seg.mm, seg.find(index))[3]
+        return None
+
+    def covered_count(self, index: int) -> int:
+        """ How many segments, from the front, hold no records after index """
+        count = 0
+        for seg in self.segments:
+            if seg.last_index > index:
+                break
+            count += 1
+        return count
+
+    def drop_segments(self, count: int):
+        for seg in self.segments[:count]:
+            seg.delete()
+        self.segments = self.segments[count:]
+
+    def update_metadata(self):
+        first = self.metadata.first_index
+        if self.segments and self.segments[-1].last_index >= first:
+            self.metadata.last_index = self.segments[-1].last_index
+            self.metadata.last_term = self.segments[-1].last_term
+        elif self.snapshot is not None:
+            self.metadata.last_index = self.snapshot.index
+            self.metadata.last_term = self.snapshot.term
+        else:
+            self.metadata.last_index = 0
+            self.metadata.last_term = 0
+
+    def get_metadata(self) -> LogMetadata:
+        return self.metadata
+
+    async def get_term(self) -> int:
+        return self.metadata.term
+
+    async def set_term(self, value: int):
+        async with self.write_lock:
+            path = Path(self.directory, "term")
+            data = json.dumps(dict(term=value)).encode()
+            await asyncio.get_running_loop().run_in_executor(None, write_file, path, data)
+            self.metadata.term = value
+
+    async def incr_term(self) -> int:
+        await self.set_term(self.metadata.term + 1)
+        return self.metadata.term
+
+    def segment_for(self, index: int) -> Segment:
+        for seg in reversed(self.segments):
+            if seg.first_index <= index:
+                return seg
+        raise Exception(f"cannot get index {index}, not in records")
+
+    async def write_records(self, recs: List[LogRec]):
+        """ Write at the end of the log, caller holds the lock """
+        nbytes = 0
+        for rec in recs:
+            data = encode_record(rec)
+            if not self.segments or not self.segments[-1].has_room(len(data)):
+                size = max(self.segment_size, len(data) + HEADER.size)
+                # creating it syncs the file and directory, keep that off the loop
+                seg = await asyncio.get_running_loop().run_in_executor(
+                    None, Segment.create, self.directory, rec.index, size, self.index_interval)
+                self.segments.append(seg)
+            seg = self.segments[-1]
+            seg.write(rec, data)
+            nbytes += len(data)
+            if seg not in self.dirty:
+                self.dirty.append(seg)
+        self.update_metadata()
+        await self.syncer.written(recs[0].index, recs[-1].index, nbytes)
+
+    async def cut(self, index: int):
+        """ Drop the records from index on, caller holds the lock """
+        while self.segments and self.segments[-1].first_index >= index:
+            self.segments.pop().delete()
+        if self.segments and self.segments[-1].last_index >= index:
+            self.segments[-1].cut(index)
+            if self.segments[-1] not in self.dirty:
+                self.dirty.append(self.segments[-1])
+        self.update_metadata()
+
+    async def append(self, entries: List[LogRec]) -> None:
+        if len(entries) == 0:
+            return
+        async with self.write_lock:
+            index = self.metadata.last_index
+            recs = []
+            for entry in entries:
+                index += 1
+                recs.append(LogRec(code=entry.code, index=index, term=entry.term,
+                                   user_data=entry.user_data))
+            await self.write_records(recs)
+        self.logger.debug("new log records %d to %d", recs[0].index, index)
+
+    async def replace_or_append(self, entry: LogRec) -> LogRec:
+        if entry.index is None:
+            raise Exception("api usage error, call append for new record")
+        if entry.index == 0:
+            raise Exception("api usage error, cannot insert at index 0")
+        save_rec = LogRec(code=entry.code, index=entry.index, term=entry.term,
+                          user_data=entry.user_data)
+        async with self.write_lock:
+            last_index = self.metadata.last_index
+            if save_rec.index > last_index + 1:
+                raise Exception(f"cannot save index {save_rec.index}, "
+                                f"last index is {last_index}")
+            if save_rec.index < self.metadata.first_index:
+                raise Exception(f"cannot replace index {save_rec.index}, it is in the snapshot")
+            # Records can't be changed in place, so the ones after it
+            # are cut and written again behind the new one
+            recs = [save_rec]
+            for index in range(save_rec.index + 1, last_index + 1):
+                recs.append(self.read_rec(index))
+            await self.cut(save_rec.index)
+            await self.write_records(recs)
+        return save_rec
+
+    def read_rec(self, index: int) -> LogRec:
+        rec_index, term, code, kind, view = self.segment_for(index).read_view(index)
+        user_data = decode_data(kind, view)
+        view.release()
+        return LogRec(code=code, index=rec_index, term=term, user_data=user_data)
+
+    async def truncate_from(self, index: int):
+        async with self.write_lock:
+            if index < self.metadata.first_index:
+                raise Exception(f"cannot truncate from index {index}, it is in the snapshot")
+            if index > self.metadata.last_index:
+                return
+            # whole segments get deleted, the one index is in gets cut
+            await self.cut(index)
+            await self.syncer.written(index, index - 1, 0)
+        self.logger.debug("truncated log from index %d", index)
+
+    async def read(self, index: Union[int, None] = None) -> Union[LogRec, None]:
+        if index is None:
+            index = self.metadata.last_index
+            if index < self.metadata.first_index:
+                return None
+        elif index < self.metadata.first_index or index > self.metadata.last_index:
+            raise Exception(f"cannot get index {index}, not in records")
+        return self.read_rec(index)
+
+    async def read_range(self, start: int, end: Union[int, None] = None,
+                         max_bytes: Union[int, None] = None) -> List[LogRec]:
+        if start < self.metadata.first_index:
+            raise Exception(f"cannot get index {start}, not in records")
+        if end is None or end > self.metadata.last_index:
+            end = self.metadata.last_index
+        result = []
+        size = 0
+        for seg in self.segments:
+            if seg.last_index < start or seg.first_index > end:
+                continue
+            recs, size = seg.read_records(max(start, seg.first_index), end, max_bytes,
+                                          size, len(result))
+            result.extend(recs)
+            if result and result[-1].index < min(end, seg.last_index):
+                # hit max_bytes
+                break
+        return result
+
+    async def iter_from(self, index: int, end: Union[int, None] = None):
+        if index < self.metadata.first_index:
+            raise Exception(f"cannot get index {index}, not in records")
+        while end is None or index <= end:
+            if index < self.metadata.first_index:
+                return
+            stop = index + ITER_CHUNK - 1
+            if end is not None:
+                stop = min(stop, end)
+            recs = await self.read_range(index, stop)
+            if not recs:
+                return
+            for rec in recs:
+                yield rec
+            index = recs[-1].index + 1
+
+    async def get_last_index(self) -> int:
+        return self.metadata.last_index
+
+    async def get_last_term(self) -> int:
+        return self.metadata.last_term
+
+    async def install_snapshot(self, snapshot: SnapshotRec):
+        async with self.write_lock:
+            if snapshot.index < self.metadata.first_index:
+                return
+            kind, data = encode_data(snapshot.data)
+            header = json.dumps(dict(index=snapshot.index, term=snapshot.term,
+                                     config=snapshot.config, kind=kind)).encode()
+            path = Path(self.directory, "snapshot")
+            await asyncio.get_running_loop().run_in_executor(None, write_file, path,
+                                                             header + b"\n" + data)
+            term = None
+            if snapshot.index <= self.metadata.last_index:
+                term = self.term_in_segments(snapshot.index)
+            if term == snapshot.term:
+                self.drop_segments(self.covered_count(snapshot.index))
+            else:
+                self.drop_segments(len(self.segments))
+            self.snapshot = SnapshotRec(index=snapshot.index, term=snapshot.term,
+                                        data=decode_data(kind, data), config=snapshot.config)
+            self.metadata.first_index = snapshot.index + 1
+            self.update_metadata()
+            await self.syncer.snapshot_installed(self.metadata.last_index)
+        self.logger.debug("installed snapshot at index %d", snapshot.index)
+
+    async def get_snapshot(self) -> Union[SnapshotRec, None]:
+        if self.snapshot is None:
+            return None
+        return SnapshotRec(index=self.snapshot.index, term=self.snapshot.term,
+                           data=self.snapshot.data, config=self.snapshot.config)
+
+    async def get_first_index(self) -> int:
+        return self.metadata.first_index
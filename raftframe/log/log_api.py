@@ -5,7 +5,7 @@ Definitions for the API of the operations log managed by the state variants.
 import os
 import abc
 from dataclasses import dataclass, field, asdict
-from typing import Union, List, Optional, Any
+from typing import Union, List, Optional, Any, AsyncIterator
 from enum import Enum
 
 class RecordCode(str, Enum):
@@ -20,6 +20,18 @@ class RecordCode(str, Enum):
     """ Cluster Configuration Data """
     cluster_confit = "CLUSTER_CONFIG" 
 
+class DurabilityMode(str, Enum):
+    """ When a log makes appended records durable """
+
+    """ Sync before each append returns """
+    every_append = "EVERY_APPEND"
+
+    """ Sync every so many milliseconds or bytes, whichever comes first """
+    group = "GROUP"
+
+    """ Never sync, leave it to the operating system """
+    none = "NONE"
+
     
 @dataclass
 class LogRec:
@@ -35,6 +47,66 @@ class LogRec:
                   term=data['term'],
                   user_data=data['user_data'])
         return rec
+
+def record_size(rec: LogRec) -> int:
+    """ Size of the record's user data, as utf-8 encoded bytes """
+    if rec.user_data is None:
+        return 0
+    if isinstance(rec.user_data, str):
+        return len(rec.user_data.encode())
+    return len(rec.user_data)
+
+@dataclass
+class SnapshotRec:
+    """ 
+    Describes a snapshot of the state machine, taken after the command in
+    the log record at index was applied. The pilot decides what data is,
+    it is just whatever it needs to find the saved state again. The config
+    is the cluster membership as of index, filled in by the hull, since the
+    cluster config records it came from get discarded with the rest.
+    """
+    index: int = field(default = 0)
+    term: int = field(default = 0)
+    data: Any = field(default=None, repr=False)
+    config: Any = field(default=None, repr=False)
+
+@dataclass
+class LogMetadata:
+    """
+    The values the state classes check on nearly every message, held in memory
+    by the log and updated by it whenever it changes them, so they can be read
+    without waiting on storage. Callers must treat it as read only. The
+    durable index is the last record the log's durability policy says is
+    safely stored.
+    """
+    term: int = field(default = 0)
+    last_index: int = field(default = 0)
+    last_term: int = field(default = 0)
+    first_index: int = field(default = 1)
+    durable_index: int = field(default = 0)
+
+@dataclass
+class DurabilityPolicy:
+    """
+    How a log gets records to disk. Syncing every append is the safe
+    default. Group mode lets many appends share one sync, the callers that
+    need their records on disk wait in flush() for the next one. With no
+    syncing a crash can lose records that were acknowledged, which Raft
+    assumes never happens.
+
+    Args:
+        mode:
+            When to sync
+        group_ms:
+            In group mode, longest time between an append and the sync that
+            covers it
+        group_bytes:
+            In group mode, sync as soon as this much has been written since
+            the last one
+    """
+    mode: DurabilityMode = field(default=DurabilityMode.every_append)
+    group_ms: float = field(default=2.0)
+    group_bytes: int = field(default=1024 * 1024)
     
 # abstract class for all states
 class LogAPI(metaclass=abc.ABCMeta):
@@ -68,10 +140,36 @@ class LogAPI(metaclass=abc.ABCMeta):
     def replace_or_append(self, entry: LogRec) -> LogRec:  # pragma: no cover abstract
         raise NotImplementedError
 
+    @abc.abstractmethod
+    async def truncate_from(self, index: int):  # pragma: no cover abstract
+        """ Discard the record at index and all after it, so the next append
+        goes at index. Nothing happens if index is past the last record.
+        Records in the snapshot can't be discarded.
+        """
+        raise NotImplementedError
+
     @abc.abstractmethod
     async def read(self, index: Union[int, None] = None) -> Union[LogRec, None]:  # pragma: no cover abstract
         raise NotImplementedError
 
+    @abc.abstractmethod
+    async def read_range(self, start: int, end: Union[int, None] = None,
+                         max_bytes: Union[int, None] = None) -> List[LogRec]:  # pragma: no cover abstract
+        """ Records from start up to and including end, or to the last record if
+        end is None or past it, read in one go. With max_bytes, stops before the
+        record that would take the total record_size over it, though the first
+        record is always included. Empty if start is past the last record.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def iter_from(self, index: int, end: Union[int, None] = None) -> AsyncIterator[LogRec]:  # pragma: no cover abstract
+        """ Async iterator over the records from index to end, or to the last
+        record. Records added while iterating are included if end allows. Stops
+        early if the records it has not reached yet get discarded by a snapshot.
+        """
+        raise NotImplementedError
+
     @abc.abstractmethod
     async def get_last_index(self) -> int:  # pragma: no cover abstract
         raise NotImplementedError
@@ -80,7 +178,40 @@ class LogAPI(metaclass=abc.ABCMeta):
     async def get_last_term(self) -> int:  # pragma: no cover abstract
         raise NotImplementedError
 
-    
+    @abc.abstractmethod
+    async def install_snapshot(self, snapshot: SnapshotRec):  # pragma: no cover abstract
+        """ Save the snapshot and discard the records up to and including its
+        index. If the log has a record at that index with the same term, any records
+        after it are kept, otherwise they are discarded too, and the log continues
+        from the snapshot. Snapshots older than the current one are ignored.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_snapshot(self) -> Union[SnapshotRec, None]:  # pragma: no cover abstract
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_first_index(self) -> int:  # pragma: no cover abstract
+        """ Index of the first record still in the log, one more than the
+        last snapshot's index. Can be greater than the last index if all the
+        records are in the snapshot. 
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def flush(self) -> int:  # pragma: no cover abstract
+        """ Wait until the records appended so far are durable, as far as the
+        log's durability policy goes, and return the durable index.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_metadata(self) -> LogMetadata:  # pragma: no cover abstract
+        """ The log's current metadata, not a copy, so it stays up to date.
+        Not async, it must never touch storage.
+        """
+        raise NotImplementedError
         
 
 
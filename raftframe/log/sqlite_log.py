@@ -0,0 +1,363 @@
+"""
+SQLite implementation of the LogAPI. The database work is all done on one
+dedicated thread so that disk writes never stall the event loop.
+"""
+import os
+import asyncio
+import sqlite3
+import logging
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, List
+from raftframe.log.log_api import LogRec, LogAPI, SnapshotRec, LogMetadata, RecordCode, record_size
+from raftframe.log.log_api import DurabilityPolicy, DurabilityMode
+from raftframe.log.durability import Syncer
+
+SYNC_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+# how many records iter_from reads at a time
+ITER_CHUNK = 64
+# synchronous level to use for each durability mode, unless one is given
+MODE_SYNC_LEVELS = {DurabilityMode.every_append: "FULL",
+                    DurabilityMode.group: "NORMAL",
+                    DurabilityMode.none: "OFF"}
+
+# Statements are kept as constants so that the sqlite3 statement cache
+# finds them prepared on every call after the first
+INSERT_REC = "insert into records (rec_index, code, term, user_data) values (?,?,?,?)"
+REPLACE_REC = "replace into records (rec_index, code, term, user_data) values (?,?,?,?)"
+SELECT_REC = "select rec_index, code, term, user_data from records where rec_index = ?"
+SELECT_RANGE = "select rec_index, code, term, user_data from records " \
+    "where rec_index between ? and ? order by rec_index"
+SELECT_LAST = "select rec_index, term from records order by rec_index desc limit 1"
+DELETE_UPTO = "delete from records where rec_index <= ?"
+DELETE_ALL = "delete from records"
+DELETE_FROM = "delete from records where rec_index >= ?"
+SELECT_TERM = "select term from stats where id = 1"
+SAVE_TERM = "replace into stats (id, term) values (1, ?)"
+SELECT_SNAP = "select rec_index, term, data, config from snapshot where id = 1"
+SAVE_SNAP = "replace into snapshot (id, rec_index, term, data, config) values (1,?,?,?,?)"
+
+
+def data_size(recs: List[LogRec]) -> int:
+    """ Rough count of the bytes the records add to the database """
+    return sum(len(rec.user_data) + 32 if rec.user_data else 32 for rec in recs)
+
+
+class Records:
+    """
+    The blocking side of SqliteLog. Every method runs on the log's
+    writer thread, which is the only thread that uses the connection.
+    """
+
+    def __init__(self, filepath: os.PathLike, synchronous: str):
+        self.filepath = filepath
+        self.synchronous = synchronous
+        self.db = None
+
+    def open(self) -> LogMetadata:
+        self.db = sqlite3.connect(self.filepath, cached_statements=64)
+        self.db.execute("pragma journal_mode=WAL")
+        self.db.execute(f"pragma synchronous={self.synchronous}")
+        with self.db:
+            self.db.execute("create table if not exists records "
+                            "(rec_index INTEGER primary key, code TEXT, "
+                            "term INTEGER, user_data)")
+            self.db.execute("create table if not exists stats "
+                            "(id INTEGER primary key, term INTEGER)")
+            self.db.execute("create table if not exists snapshot "
+                            "(id INTEGER primary key, rec_index INTEGER, "
+                            "term INTEGER, data, config TEXT)")
+        return self.read_metadata()
+
+    def sync(self) -> None:
+        """ Sync the write ahead log, which holds every commit since the
+        last checkpoint.
+        """
+        wal_path = f"{self.filepath}-wal"
+        if not os.path.exists(wal_path):
+            return
+        fd = os.open(wal_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self) -> None:
+        if self.db is None:
+            return
+        self.db.close()
+        self.db = None
+
+    def read_metadata(self) -> LogMetadata:
+        meta = LogMetadata()
+        row = self.db.execute(SELECT_TERM).fetchone()
+        if row:
+            meta.term = row[0]
+        row = self.db.execute(SELECT_SNAP).fetchone()
+        if row:
+            meta.first_index = row[0] + 1
+            meta.last_index = row[0]
+            meta.last_term = row[1]
+        row = self.db.execute(SELECT_LAST).fetchone()
+        if row:
+            meta.last_index, meta.last_term = row
+        return meta
+
+    def set_term(self, value: int) -> None:
+        with self.db:
+            self.db.execute(SAVE_TERM, (value,))
+
+    def insert(self, recs: List[LogRec]) -> None:
+        rows = [(rec.index, str(rec.code.value), rec.term, rec.user_data) for rec in recs]
+        with self.db:
+            self.db.executemany(INSERT_REC, rows)
+
+    def replace(self, rec: LogRec) -> None:
+        with self.db:
+            self.db.execute(REPLACE_REC, (rec.index, str(rec.code.value), rec.term, rec.user_data))
+
+    def truncate(self, index: int) -> LogMetadata:
+        with self.db:
+            self.db.execute(DELETE_FROM, (index,))
+        return self.read_metadata()
+
+    def read_entry(self, index: int) -> Union[LogRec, None]:
+        row = self.db.execute(SELECT_REC, (index,)).fetchone()
+        if row is None:
+            return None
+        return LogRec(code=RecordCode(row[1]), index=row[0], term=row[2], user_data=row[3])
+
+    def read_range(self, start: int, end: int, max_bytes: Union[int, None]) -> List[LogRec]:
+        result = []
+        size = 0
+        cursor = self.db.execute(SELECT_RANGE, (start, end))
+        try:
+            for row in cursor:
+                rec = LogRec(code=RecordCode(row[1]), index=row[0], term=row[2], user_data=row[3])
+                size += record_size(rec)
+                if max_bytes is not None and result and size > max_bytes:
+                    break
+                result.append(rec)
+        finally:
+            cursor.close()
+        return result
+
+    def install_snapshot(self, snapshot: SnapshotRec) -> LogMetadata:
+        with self.db:
+            rec = self.read_entry(snapshot.index)
+            if rec is not None and rec.term == snapshot.term:
+                self.db.execute(DELETE_UPTO, (snapshot.index,))
+            else:
+                self.db.execute(DELETE_ALL)
+            self.db.execute(SAVE_SNAP, (snapshot.index, snapshot.term,
+                                        snapshot.data, snapshot.config))
+        return self.read_metadata()
+
+    def get_snapshot(self) -> Union[SnapshotRec, None]:
+        row = self.db.execute(SELECT_SNAP).fetchone()
+        if row is None:
+            return None
+        return SnapshotRec(index=row[0], term=row[1], data=row[2], config=row[3])
+
+
+class SqliteLog(LogAPI):
+    """
+    Keeps the log in a SQLite database in WAL mode. All database calls run
+    on a single writer thread, each append is one transaction with one
+    executemany insert, and the metadata is updated once the write that
+    changed it has finished. Changes are serialized by a lock, so
+    concurrent callers see them in order.
+
+    Record user data and snapshot data are stored as is, so they must be
+    types that sqlite can store, str and bytes being the usual ones.
+
+    Args:
+        synchronous:
+            The sqlite synchronous level, one of OFF, NORMAL, FULL or EXTRA.
+            FULL syncs the WAL on every transaction. NORMAL only syncs at
+            checkpoints, leaving the rest to the durability policy's group
+            syncs. Defaults to FULL, NORMAL or OFF to go with the policy's
+            mode.
+        filename:
+            Name of the database file in the working directory
+        durability:
+            When records are synced, every append if not given
+    """
+
+    def __init__(self, synchronous: str = None, filename: str = "log.sqlite",
+                 durability: DurabilityPolicy = None):
+        if durability is None:
+            durability = DurabilityPolicy()
+        if synchronous is None:
+            synchronous = MODE_SYNC_LEVELS[durability.mode]
+        synchronous = synchronous.upper()
+        if synchronous not in SYNC_LEVELS:
+            raise Exception(f"synchronous must be one of {SYNC_LEVELS}, not {synchronous}")
+        self.synchronous = synchronous
+        self.filename = filename
+        self.records = None
+        self.working_directory = None
+        self.executor = None
+        self.write_lock = asyncio.Lock()
+        self.metadata = LogMetadata()
+        self.syncer = Syncer(durability, self.sync, self.metadata)
+        self.logger = logging.getLogger(__name__)
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def start(self, working_directory: os.PathLike):
+        self.working_directory = working_directory
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="raftframe-log")
+        filepath = Path(working_directory, self.filename).resolve()
+        self.records = Records(filepath, self.synchronous)
+        meta = await self.run(self.records.open)
+        self.metadata.term = meta.term
+        self.update_metadata(meta)
+        self.syncer.reset(meta.last_index)
+
+    async def sync(self):
+        # with FULL or EXTRA every commit has synced already
+        if self.synchronous not in ("FULL", "EXTRA"):
+            await self.run(self.records.sync)
+
+    async def flush(self) -> int:
+        return await self.syncer.flush()
+
+    async def close(self):
+        if self.executor is None:
+            return
+        await self.syncer.sync()
+        await self.syncer.stop()
+        await self.run(self.records.close)
+        self.executor.shutdown()
+        self.executor = None
+
+    def get_metadata(self) -> LogMetadata:
+        return self.metadata
+
+    def update_metadata(self, meta: LogMetadata):
+        # copy into the existing object, callers may be holding it
+        self.metadata.first_index = meta.first_index
+        self.metadata.last_index = meta.last_index
+        self.metadata.last_term = meta.last_term
+
+    async def get_term(self) -> int:
+        return self.metadata.term
+
+    async def set_term(self, value: int):
+        async with self.write_lock:
+            await self.run(self.records.set_term, value)
+            await self.syncer.sync(force=True)
+            self.metadata.term = value
+
+    async def incr_term(self) -> int:
+        async with self.write_lock:
+            value = self.metadata.term + 1
+            await self.run(self.records.set_term, value)
+            await self.syncer.sync(force=True)
+            self.metadata.term = value
+        return value
+
+    async def append(self, entries: List[LogRec]) -> None:
+        if len(entries) == 0:
+            return
+        async with self.write_lock:
+            index = self.metadata.last_index
+            recs = []
+            for entry in entries:
+                index += 1
+                recs.append(LogRec(code=entry.code, index=index, term=entry.term,
+                                   user_data=entry.user_data))
+            await self.run(self.records.insert, recs)
+            self.metadata.last_index = index
+            self.metadata.last_term = recs[-1].term
+            await self.syncer.written(recs[0].index, index, data_size(recs))
+        self.logger.debug("new log records %d to %d", recs[0].index, index)
+
+    async def replace_or_append(self, entry: LogRec) -> LogRec:
+        if entry.index is None:
+            raise Exception("api usage error, call append for new record")
+        if entry.index == 0:
+            raise Exception("api usage error, cannot insert at index 0")
+        save_rec = LogRec(code=entry.code, index=entry.index, term=entry.term,
+                          user_data=entry.user_data)
+        async with self.write_lock:
+            if save_rec.index > self.metadata.last_index + 1:
+                raise Exception(f"cannot save index {save_rec.index}, "
+                                f"last index is {self.metadata.last_index}")
+            await self.run(self.records.replace, save_rec)
+            if save_rec.index >= self.metadata.last_index:
+                self.metadata.last_index = save_rec.index
+                self.metadata.last_term = save_rec.term
+            await self.syncer.written(save_rec.index, self.metadata.last_index,
+                                      data_size([save_rec]))
+        return save_rec
+
+    async def truncate_from(self, index: int):
+        async with self.write_lock:
+            if index < self.metadata.first_index:
+                raise Exception(f"cannot truncate from index {index}, it is in the snapshot")
+            if index > self.metadata.last_index:
+                return
+            # one range delete, whatever the count
+            meta = await self.run(self.records.truncate, index)
+            self.update_metadata(meta)
+            await self.syncer.written(index, index - 1, 0)
+        self.logger.debug("truncated log from index %d", index)
+
+    async def read(self, index: Union[int, None] = None) -> Union[LogRec, None]:
+        if index is None:
+            index = self.metadata.last_index
+            if index < self.metadata.first_index:
+                return None
+        elif index < self.metadata.first_index or index > self.metadata.last_index:
+            raise Exception(f"cannot get index {index}, not in records")
+        return await self.run(self.records.read_entry, index)
+
+    async def read_range(self, start: int, end: Union[int, None] = None,
+                         max_bytes: Union[int, None] = None) -> List[LogRec]:
+        if start < self.metadata.first_index:
+            raise Exception(f"cannot get index {start}, not in records")
+        if end is None or end > self.metadata.last_index:
+            end = self.metadata.last_index
+        if start > end:
+            return []
+        return await self.run(self.records.read_range, start, end, max_bytes)
+
+    async def iter_from(self, index: int, end: Union[int, None] = None):
+        if index < self.metadata.first_index:
+            raise Exception(f"cannot get index {index}, not in records")
+        while end is None or index <= end:
+            if index < self.metadata.first_index:
+                return
+            stop = index + ITER_CHUNK - 1
+            if end is not None:
+                stop = min(stop, end)
+            recs = await self.read_range(index, stop)
+            if not recs:
+                return
+            for rec in recs:
+                yield rec
+            index = recs[-1].index + 1
+
+    async def get_last_index(self) -> int:
+        return self.metadata.last_index
+
+    async def get_last_term(self) -> int:
+        return self.metadata.last_term
+
+    async def install_snapshot(self, snapshot: SnapshotRec):
+        async with self.write_lock:
+            if snapshot.index < self.metadata.first_index:
+                return
+            meta = await self.run(self.records.install_snapshot, snapshot)
+            self.update_metadata(meta)
+            await self.syncer.snapshot_installed(meta.last_index)
+        self.logger.debug("installed snapshot at index %d", snapshot.index)
+
+    async def get_snapshot(self) -> Union[SnapshotRec, None]:
+        return await self.run(self.records.get_snapshot)
+
+    async def get_first_index(self) -> int:
+        return self.metadata.first_index
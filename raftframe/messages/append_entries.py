@@ -7,13 +7,16 @@ class AppendEntriesMessage(BaseMessage):
     code = "append_entries"
 
     def __init__(self, sender:str, receiver:str, term:int, prevLogIndex:int, prevLogTerm:int,
-                 entries:List[Any]):
+                 entries:List[Any], leaderCommit:int, serial:int=0):
         BaseMessage.__init__(self, sender, receiver, term, prevLogIndex, prevLogTerm)
         self.entries = entries
+        self.leaderCommit = leaderCommit
+        # increases with each message the leader sends, echoed in the response
+        self.serial = serial
     
     def __repr__(self):
         msg = super().__repr__()
-        msg += f" e={len(self.entries)}"
+        msg += f" e={len(self.entries)},c={self.leaderCommit}"
         return msg
 
 class AppendResponseMessage(BaseMessage):
@@ -22,10 +25,11 @@ class AppendResponseMessage(BaseMessage):
 
     def __init__(self, sender:str, receiver:str, term:int, prevLogIndex:int, prevLogTerm:int,
                  entries:List[Any], results:List[Any],
-                 myPrevLogIndex:int, myPrevLogTerm:int):
+                 myPrevLogIndex:int, myPrevLogTerm:int, serial:int=0):
         BaseMessage.__init__(self, sender, receiver, term, prevLogIndex, prevLogTerm)
         self.myPrevLogIndex = myPrevLogIndex 
         self.myPrevLogTerm = myPrevLogTerm
+        self.serial = serial
         self.entries = entries
         self.results = results
     
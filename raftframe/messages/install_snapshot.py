@@ -0,0 +1,43 @@
+from .base_message import BaseMessage
+
+
+class InstallSnapshotMessage(BaseMessage):
+    """
+    One chunk of a snapshot, starting at offset. The prevLogIndex and prevLogTerm
+    are the index and term of the last log record included in the snapshot. The
+    done flag marks the last chunk. The config is the snapshot's cluster membership.
+    """
+    code = "install_snapshot"
+
+    def __init__(self, sender:str, receiver:str, term:int, prevLogIndex:int, prevLogTerm:int,
+                 offset:int, data:memoryview, done:bool, config:str=None):
+        BaseMessage.__init__(self, sender, receiver, term, prevLogIndex, prevLogTerm)
+        self.offset = offset
+        self.data = data
+        self.done = done
+        self.config = config
+
+    def __repr__(self):
+        msg = super().__repr__()
+        msg += f" o={self.offset},s={len(self.data)},d={self.done}"
+        return msg
+
+class InstallSnapshotResponseMessage(BaseMessage):
+    """
+    Answers the chunk at offset. The nextOffset is where the receiver wants the
+    next chunk to start, which is where the sender should resume if any chunks
+    were lost. The done flag means that the snapshot has been installed.
+    """
+    code = "install_snapshot_response"
+
+    def __init__(self, sender:str, receiver:str, term:int, prevLogIndex:int, prevLogTerm:int,
+                 offset:int, nextOffset:int, done:bool):
+        BaseMessage.__init__(self, sender, receiver, term, prevLogIndex, prevLogTerm)
+        self.offset = offset
+        self.nextOffset = nextOffset
+        self.done = done
+
+    def __repr__(self):
+        msg = super().__repr__()
+        msg += f" o={self.offset},n={self.nextOffset},d={self.done}"
+        return msg
@@ -0,0 +1,37 @@
+from .base_message import BaseMessage
+
+
+class ReadIndexMessage(BaseMessage):
+    """
+    Follower asking the leader for a commit index that is safe to read at. The
+    requestId is the follower's, echoed in the response. 
+    """
+    code = "read_index"
+
+    def __init__(self, sender:str, receiver:str, term:int, prevLogIndex:int, prevLogTerm:int,
+                 requestId:int):
+        BaseMessage.__init__(self, sender, receiver, term, prevLogIndex, prevLogTerm)
+        self.requestId = requestId
+
+    def __repr__(self):
+        msg = super().__repr__()
+        msg += f" r={self.requestId}"
+        return msg
+
+class ReadIndexResponseMessage(BaseMessage):
+    """
+    Leader's answer to a read index request, error is None if readIndex is good.
+    """
+    code = "read_index_response"
+
+    def __init__(self, sender:str, receiver:str, term:int, prevLogIndex:int, prevLogTerm:int,
+                 requestId:int, readIndex:int, error:str):
+        BaseMessage.__init__(self, sender, receiver, term, prevLogIndex, prevLogTerm)
+        self.requestId = requestId
+        self.readIndex = readIndex
+        self.error = error
+
+    def __repr__(self):
+        msg = super().__repr__()
+        msg += f" r={self.requestId},i={self.readIndex},e={self.error}"
+        return msg
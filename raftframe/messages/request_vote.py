@@ -2,9 +2,23 @@ from .base_message import BaseMessage
 
 
 class RequestVoteMessage(BaseMessage):
-
+    """
+    The transfer flag is set when the current leader asked the sender to run,
+    so servers that still hear from that leader should vote anyway.
+    """
     code = "request_vote"
 
+    def __init__(self, sender:str, receiver:str, term:int, prevLogIndex:int, prevLogTerm:int,
+                 transfer:bool=False):
+        BaseMessage.__init__(self, sender, receiver, term, prevLogIndex, prevLogTerm)
+        self.transfer = transfer
+
+    def __repr__(self):
+        msg = super().__repr__()
+        if self.transfer:
+            msg += " transfer"
+        return msg
+
 class RequestVoteResponseMessage(BaseMessage):
 
     code = "request_vote_response"
@@ -17,3 +31,26 @@ class RequestVoteResponseMessage(BaseMessage):
         msg = super().__repr__()
         msg += f" v={self.vote}"
         return msg
+
+class PreVoteMessage(BaseMessage):
+    """
+    Asks if the receiver would vote for the sender in an election at term. Nobody
+    changes their term because of this, it is only a proposal. The prevLogIndex
+    and prevLogTerm are the index and term of the sender's last log record.
+    """
+    code = "pre_vote"
+
+class PreVoteResponseMessage(BaseMessage):
+    """
+    Answers a pre vote, the term is the proposed one from the request.
+    """
+    code = "pre_vote_response"
+
+    def __init__(self, sender:str, receiver:str, term:int, prevLogIndex:int, prevLogTerm:int, vote:bool):
+        BaseMessage.__init__(self, sender, receiver, term, prevLogIndex, prevLogTerm)
+        self.vote = vote
+
+    def __repr__(self):
+        msg = super().__repr__()
+        msg += f" v={self.vote}"
+        return msg
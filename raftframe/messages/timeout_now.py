@@ -0,0 +1,10 @@
+from .base_message import BaseMessage
+
+
+class TimeoutNowMessage(BaseMessage):
+    """
+    Leader telling the receiver to start an election right away, because
+    it is handing leadership over. The receiver's log is up to date with
+    the leader's when this is sent.
+    """
+    code = "timeout_now"
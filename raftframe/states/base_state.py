@@ -3,6 +3,10 @@ import logging
 from enum import Enum
 from raftframe.messages.append_entries import AppendEntriesMessage, AppendResponseMessage
 from raftframe.messages.request_vote import RequestVoteMessage, RequestVoteResponseMessage
+from raftframe.messages.request_vote import PreVoteMessage, PreVoteResponseMessage
+from raftframe.messages.install_snapshot import InstallSnapshotMessage, InstallSnapshotResponseMessage
+from raftframe.messages.read_index import ReadIndexMessage, ReadIndexResponseMessage
+from raftframe.messages.timeout_now import TimeoutNowMessage
 
 class StateCode(str, Enum):
 
@@ -88,6 +92,27 @@ class BaseState:
         code = RequestVoteResponseMessage.get_code()
         route = self.on_vote_response
         self.routes[code] = route
+        code = InstallSnapshotMessage.get_code()
+        route = self.on_install_snapshot
+        self.routes[code] = route
+        code = InstallSnapshotResponseMessage.get_code()
+        route = self.on_install_snapshot_response
+        self.routes[code] = route
+        code = ReadIndexMessage.get_code()
+        route = self.on_read_index
+        self.routes[code] = route
+        code = ReadIndexResponseMessage.get_code()
+        route = self.on_read_index_response
+        self.routes[code] = route
+        code = PreVoteMessage.get_code()
+        route = self.on_pre_vote_request
+        self.routes[code] = route
+        code = PreVoteResponseMessage.get_code()
+        route = self.on_pre_vote_response
+        self.routes[code] = route
+        code = TimeoutNowMessage.get_code()
+        route = self.on_timeout_now
+        self.routes[code] = route
 
     async def start(self):
         # child classes not required to have this method, but if they do,
@@ -99,14 +124,53 @@ class BaseState:
         # they should call this one (i.e. super().stop())
         self.stopped = True
 
+    async def command_applied(self, index, result, error):
+        # Called by the hull after the command in the log record at index
+        # has been processed. Child classes not required to have this method.
+        pass
+
+    async def membership_changed(self):
+        # Called by the hull when the cluster config in the log has
+        # changed. Child classes not required to have this method.
+        pass
+
+    async def get_term_at(self, index):
+        # Term of the record at index. It might be the last one in the
+        # snapshot, any before that are gone, so None.
+        if index < 1:
+            return 0
+        if index < self.log.get_metadata().first_index:
+            snapshot = await self.log.get_snapshot()
+            if index == snapshot.index:
+                return snapshot.term
+            return None
+        rec = await self.log.read(index)
+        return rec.term
+
     async def run_after(self, delay, target):
         await self.hull.state_run_after(delay, target)
 
     async def cancel_run_after(self):
         await self.hull.cancel_state_run_after()
         
+    def has_live_leader(self):
+        # True if a leader lease might be in use, child classes decide
+        return False
+
     async def on_message(self, message):
-        if message.term > await self.log.get_term():
+        if (message.get_code() == RequestVoteMessage.get_code() and self.has_live_leader()
+            and not message.transfer):
+            # Raft thesis section 4.2.3, ignore the election, don't even take
+            # the new term, so a live leader's lease stays safe. Unless the
+            # leader asked for this election, then it has given up the lease.
+            self.logger.info('%s rejecting vote request from %s, leader is live',
+                             self.hull.get_my_uri(), message.sender)
+            await self.send_reject_vote_response(message)
+            return None
+        if message.get_code() in (PreVoteMessage.get_code(), PreVoteResponseMessage.get_code()):
+            # The term in these is only a proposal, nobody has it yet
+            return await self.routes[message.get_code()](message)
+        if message.term > self.log.get_metadata().term:
             self.logger.debug('%s received message from higher term, calling self.term_expired',
                               self.hull.get_my_uri())
             res = await self.term_expired(message)
@@ -140,7 +204,7 @@ class BaseState:
         await self.hull.record_message_problem(message, problem)
 
     async def on_vote_response(self, message):
-        if self.state_code == "LEADER" and message.term == await self.log.get_term():
+        if self.state_code == "LEADER" and message.term == self.log.get_metadata().term:
             self.logger.info('request_vote_response leftover from finished election, ignoring')
             return
         problem = 'request_vote_response not implemented in the class '
@@ -148,19 +212,97 @@ class BaseState:
         self.logger.warning(problem)
         await self.hull.record_message_problem(message, problem)
         
+    async def on_pre_vote_request(self, message):
+        # Only servers that have lost track of the leader say yes
+        self.logger.info('%s in state %s voting false on pre vote from %s', self.hull.get_my_uri(),
+                         self.state_code, message.sender)
+        await self.send_pre_vote_response(message, False)
+
+    async def on_pre_vote_response(self, message):
+        self.logger.info('pre_vote_response leftover from finished pre vote, ignoring')
+
+    async def log_is_up_to_date(self, message):
+        # Raft paper section 5.4.1, other log is at least as up to date
+        # as ours if its last term is higher, or same and it is no shorter
+        last_term = self.log.get_metadata().last_term
+        if message.prevLogTerm != last_term:
+            return message.prevLogTerm > last_term
+        return message.prevLogIndex >= self.log.get_metadata().last_index
+
+    async def send_pre_vote_response(self, message, vote):
+        reply = PreVoteResponseMessage(message.receiver,
+                                       message.sender,
+                                       term=message.term,
+                                       prevLogIndex=self.log.get_metadata().last_index,
+                                       prevLogTerm=self.log.get_metadata().last_term,
+                                       vote=vote)
+        await self.hull.send_response(message, reply)
+
+    async def on_timeout_now(self, message):
+        problem = 'timeout_now not implemented in the class '
+        problem += f'"{self.__class__.__name__}", ignoring'
+        self.logger.warning(problem)
+        await self.hull.record_message_problem(message, problem)
+
+    async def on_install_snapshot(self, message):
+        problem = 'install_snapshot not implemented in the class '
+        problem += f'"{self.__class__.__name__}", sending rejection'
+        self.logger.warning(problem)
+        await self.send_reject_snapshot_response(message)
+        await self.hull.record_message_problem(message, problem)
+
+    async def on_install_snapshot_response(self, message):
+        problem = 'install_snapshot_response not implemented in the class '
+        problem += f'"{self.__class__.__name__}", sending rejection'
+        self.logger.warning(problem)
+        await self.hull.record_message_problem(message, problem)
+
+    async def on_read_index(self, message):
+        # only the leader can answer these
+        await self.send_read_index_response(message, None, 'not leader')
+
+    async def on_read_index_response(self, message):
+        problem = 'read_index_response not implemented in the class '
+        problem += f'"{self.__class__.__name__}", sending rejection'
+        self.logger.warning(problem)
+        await self.hull.record_message_problem(message, problem)
+
+    async def send_read_index_response(self, message, read_index, error):
+        reply = ReadIndexResponseMessage(message.receiver,
+                                         message.sender,
+                                         term=self.log.get_metadata().term,
+                                         prevLogIndex=self.log.get_metadata().last_index,
+                                         prevLogTerm=self.log.get_metadata().last_term,
+                                         requestId=message.requestId,
+                                         readIndex=read_index,
+                                         error=error)
+        await self.hull.send_response(message, reply)
+
     async def send_reject_append_response(self, message):
         data = dict(success=False,
-                    last_index=await self.log.get_last_index(),
-                    last_term=await self.log.get_last_term())
+                    last_index=self.log.get_metadata().last_index,
+                    last_term=self.log.get_metadata().last_term)
         reply = AppendResponseMessage(message.receiver,
                                       message.sender,
-                                      term=await self.log.get_term(),
+                                      term=self.log.get_metadata().term,
                                       entries=message.entries,
                                       results=[],
                                       prevLogTerm=message.prevLogTerm,
                                       prevLogIndex=message.prevLogIndex,
-                                      myPrevLogTerm=await self.log.get_last_term(),
-                                      myPrevLogIndex=await self.log.get_last_index())
+                                      myPrevLogTerm=self.log.get_metadata().last_term,
+                                      myPrevLogIndex=self.log.get_metadata().last_index,
+                                      serial=message.serial)
+        await self.hull.send_response(message, reply)
+
+    async def send_reject_snapshot_response(self, message):
+        reply = InstallSnapshotResponseMessage(message.receiver,
+                                               message.sender,
+                                               term=self.log.get_metadata().term,
+                                               prevLogIndex=message.prevLogIndex,
+                                               prevLogTerm=message.prevLogTerm,
+                                               offset=message.offset,
+                                               nextOffset=0,
+                                               done=False)
         await self.hull.send_response(message, reply)
 
     async def send_reject_vote_response(self, message):
@@ -168,8 +310,8 @@ class BaseState:
         reply = RequestVoteResponseMessage(message.receiver,
                                            message.sender,
                                            term=message.term,
-                                           prevLogIndex=await self.log.get_last_index(),
-                                           prevLogTerm=await self.log.get_last_term(),
+                                           prevLogIndex=self.log.get_metadata().last_index,
+                                           prevLogTerm=self.log.get_metadata().last_term,
                                            vote=False)
         await self.hull.send_response(message, reply)
 
@@ -2,27 +2,86 @@ import asyncio
 import random
 import logging
 from raftframe.states.base_state import StateCode, Substate, BaseState
-from raftframe.messages.request_vote import RequestVoteMessage
+from raftframe.messages.request_vote import RequestVoteMessage, PreVoteMessage
 
 class Candidate(BaseState):
 
-    def __init__(self, hull):
+    def __init__(self, hull, transfer=False):
         super().__init__(hull, StateCode.candidate)
         self.term = None
+        # leader asked us to run, skip pre vote and tell the voters
+        self.transfer = transfer
         self.votes = dict()
         self.reply_count = 0
+        # True while finding out if we could win, term not raised yet
+        self.pre_voting = False
         self.logger = logging.getLogger("Candidate")
 
     async def start(self):
-        self.term = await self.log.get_term()
+        self.term = self.log.get_metadata().term
         await super().start()
-        await self.start_campaign()
-        
+        await self.start_round()
+
+    async def start_round(self):
+        if self.hull.get_pre_vote() and not self.transfer:
+            await self.start_pre_vote()
+        else:
+            await self.start_campaign()
+
+    async def start_pre_vote(self):
+        self.pre_voting = True
+        self.votes = dict()
+        self.reply_count = 0
+        for node_id in self.hull.get_voter_ids():
+            if node_id == self.hull.get_my_uri():
+                self.votes[node_id] = True
+            else:
+                self.votes[node_id] = None
+                message = PreVoteMessage(sender=self.hull.get_my_uri(),
+                                         receiver=node_id,
+                                         term=self.term + 1,
+                                         prevLogTerm=self.log.get_metadata().last_term,
+                                         prevLogIndex=self.log.get_metadata().last_index)
+                await self.hull.send_message(message)
+        timeout = self.hull.get_election_timeout()
+        self.logger.debug("%s setting pre vote timeout to %f", self.hull.get_my_uri(), timeout)
+        await self.run_after(timeout, self.election_timed_out)
+
+    async def on_pre_vote_response(self, message):
+        if not self.pre_voting or message.term != self.term + 1:
+            self.logger.info("candidate %s ignoring out of date pre vote", self.hull.get_my_uri())
+            return
+        self.votes[message.sender] = message.vote
+        self.logger.info("candidate %s pre vote result %s from %s", self.hull.get_my_uri(),
+                         message.vote, message.sender)
+        self.reply_count += 1
+        if self.vote_won():
+            self.logger.info("candidate %s won pre vote, starting election", self.hull.get_my_uri())
+            await self.cancel_run_after()
+            await self.start_campaign()
+            return
+        if self.vote_lost():
+            self.logger.info("candidate %s pre vote lost, trying again", self.hull.get_my_uri())
+            await self.cancel_run_after()
+            await self.run_after(self.hull.get_election_timeout(), self.start_pre_vote)
+            return
+
+    async def on_pre_vote_request(self, message):
+        # no leader here, so only the logs matter
+        if message.term <= self.log.get_metadata().term:
+            vote = False
+        else:
+            vote = await self.log_is_up_to_date(message)
+        self.logger.info("candidate %s pre voting %s on %s", self.hull.get_my_uri(), vote, message.sender)
+        await self.send_pre_vote_response(message, vote)
+
     async def start_campaign(self):
+        self.pre_voting = False
         self.term += 1
+        self.votes = dict()
         self.reply_count = 0
         await self.log.set_term(self.term)
-        for node_id in self.hull.get_cluster_node_ids():
+        for node_id in self.hull.get_voter_ids():
             if node_id == self.hull.get_my_uri():
                 self.votes[node_id] = True
             else:
@@ -30,15 +89,18 @@ class Candidate(BaseState):
                 message = RequestVoteMessage(sender=self.hull.get_my_uri(),
                                              receiver=node_id,
                                              term=self.term,
-                                             prevLogTerm=await self.log.get_term(),
-                                             prevLogIndex=await self.log.get_last_index())
+                                             prevLogTerm=self.log.get_metadata().last_term,
+                                             prevLogIndex=self.log.get_metadata().last_index,
+                                             transfer=self.transfer)
                 await self.hull.send_message(message)
+        # only the first election counts as the transfer
+        self.transfer = False
         timeout =self.hull.get_election_timeout()
         self.logger.debug("%s setting election timeout to %f", self.hull.get_my_uri(), timeout)
         await self.run_after(timeout, self.election_timed_out)
         
     async def on_vote_response(self, message):
-        if message.term < self.term:
+        if self.pre_voting or message.term < self.term:
             self.logger.info("candidate %s ignoring out of date vote", self.hull.get_my_uri())
             return
         self.votes[message.sender] = message.vote
@@ -51,16 +113,26 @@ class Candidate(BaseState):
                 tally += 1
         self.logger.info("candidate %s voting results with %d votes in, wins = %d (includes self)",
                          self.hull.get_my_uri(), self.reply_count + 1, tally)
-        if tally > len(self.votes) / 2:
+        if self.vote_won():
             await self.cancel_run_after()
             await self.hull.win_vote(self.term)
             return
-        if self.reply_count + 1 > len(self.votes) / 2:
+        if self.vote_lost():
             self.logger.info("candidate %s campaign lost, trying again", self.hull.get_my_uri())
             await self.cancel_run_after()
-            await self.run_after(self.hull.get_election_timeout(), self.start_campaign)            
+            await self.run_after(self.hull.get_election_timeout(), self.start_round)
             return
 
+    def vote_won(self):
+        # during a membership change, both old and new have to say yes
+        yes = [nid for nid, vote in self.votes.items() if vote == True]
+        return self.hull.is_election_quorum(yes)
+
+    def vote_lost(self):
+        # can't win even if everybody still to answer says yes
+        maybe = [nid for nid, vote in self.votes.items() if vote != False]
+        return not self.hull.is_election_quorum(maybe)
+
     async def term_expired(self, message):
         await self.hull.demote_and_handle(message)
         return None
@@ -68,16 +140,24 @@ class Candidate(BaseState):
     async def on_append_entries(self, message):
         self.logger.info("candidate %s got append entries from %s", self.hull.get_my_uri(),
                          message.sender)
-        if message.term == await self.log.get_term():
+        if message.term == self.log.get_metadata().term:
             self.logger.info("candidate %s at term %d yielding to %s term %d", self.hull.get_my_uri(),
-                             await self.log.get_term(), message.sender, message.term)
+                             self.log.get_metadata().term, message.sender, message.term)
             await self.hull.demote_and_handle(message)
             return
         await self.send_reject_append_response(message)
+
+    async def on_install_snapshot(self, message):
+        self.logger.info("candidate %s got install snapshot from %s", self.hull.get_my_uri(),
+                         message.sender)
+        if message.term == self.log.get_metadata().term:
+            await self.hull.demote_and_handle(message)
+            return
+        await self.send_reject_snapshot_response(message)
         
     async def election_timed_out(self):
         self.logger.info("--!!!!!--candidate %s campaign timedout, trying again", self.hull.get_my_uri())
-        await self.start_campaign()
+        await self.start_round()
         
         
 
@@ -1,11 +1,12 @@
 import time
-import traceback
+import asyncio
 import logging
-import json
-from raftframe.log.log_api import LogRec
+from raftframe.log.log_api import LogRec, SnapshotRec
 from raftframe.states.base_state import StateCode, Substate, BaseState
 from raftframe.messages.append_entries import AppendResponseMessage
 from raftframe.messages.request_vote import RequestVoteResponseMessage
+from raftframe.messages.install_snapshot import InstallSnapshotResponseMessage
+from raftframe.messages.read_index import ReadIndexMessage
 
 class Follower(BaseState):
 
@@ -19,78 +20,185 @@ class Follower(BaseState):
         # Needs to be as recent as configured maximum silence period, or we raise hell.
         # Pretend we just got a call, that gives possible actual leader time to ping us
         self.last_leader_contact = time.time()
+        # snapshot being received from leader, and where the next chunk goes
+        self.snapshot_transfer = None
+        self.snapshot_offset = 0
+        # request id -> future for reads waiting on the leader's read index
+        self.read_requests = dict()
+        self.read_request_id = 0
         self.logger = logging.getLogger("Follower")
 
     async def start(self):
         await super().start()
         self.last_leader_contact = time.time()
         await self.run_after(self.hull.get_leader_lost_timeout(), self.contact_checker)
+
+    async def stop(self):
+        await super().stop()
+        for waiter in self.read_requests.values():
+            if not waiter.done():
+                waiter.set_exception(Exception('Follower stopped before read index arrived'))
+        self.read_requests = dict()
+
+    async def apply_query(self, query, timeout=1.0):
+        # Leader tells us what commit index to read at, once we have
+        # applied that much we can answer from local state
+        self.read_request_id += 1
+        request_id = self.read_request_id
+        waiter = asyncio.get_event_loop().create_future()
+        self.read_requests[request_id] = waiter
+        message = ReadIndexMessage(sender=self.hull.get_my_uri(),
+                                   receiver=self.leader_uri,
+                                   term=self.log.get_metadata().term,
+                                   prevLogIndex=self.log.get_metadata().last_index,
+                                   prevLogTerm=self.log.get_metadata().last_term,
+                                   requestId=request_id)
+        await self.hull.send_message(message)
+        try:
+            read_index = await asyncio.wait_for(waiter, timeout=timeout)
+        except asyncio.TimeoutError:
+            raise Exception(f'Read index not received from leader in {timeout} seconds')
+        finally:
+            self.read_requests.pop(request_id, None)
+        await self.hull.wait_for_applied(read_index, timeout)
+        return await self.hull.get_processor().process_query(query)
+
+    async def on_read_index_response(self, message):
+        waiter = self.read_requests.get(message.requestId, None)
+        # caller may have timed out
+        if waiter is None or waiter.done():
+            return
+        if message.error is not None:
+            waiter.set_exception(Exception(f'Leader could not provide read index, {message.error}'))
+        else:
+            waiter.set_result(message.readIndex)
         
     async def on_append_entries(self, message):
         self.logger.debug("%s append term = %d prev_index = %d local_term = %d local_index = %d",
                           self.hull.get_my_uri(),  message.term,
-                          message.prevLogIndex, await self.log.get_term(), await self.log.get_last_index())
+                          message.prevLogIndex, self.log.get_metadata().term, self.log.get_metadata().last_index)
 
         # Very rare case, sender thinks it is leader but has old term, probably
         # a network partition, or some kind of latency problem with the claimant's
         # operations that made us have an election. Te1ll the sender it is not leader any more.
-        if message.term < await self.log.get_term():
+        if message.term < self.log.get_metadata().term:
             await self.send_reject_append_response(message)
             return
         self.last_leader_contact = time.time()
         # We know message.term == term cause we can never get here with
         # a higher term, we'd have updated ours first.
-        if (message.prevLogIndex == await self.log.get_last_index() and message.entries == []):
-            if self.leader_uri != message.sender:
-                self.leader_uri = message.sender
-                self.last_vote = message
-                self.logger.info("%s accepting new leader %s", self.hull.get_my_uri(),
-                                 self.leader_uri)
-            else:
-                self.logger.debug("%s heartbeat from leader %s", self.hull.get_my_uri(),
-                                  message.sender)
-            await self.send_append_entries_response(message, None)
-            return
-        if (message.prevLogIndex > await self.log.get_last_index() and message.entries == []):
-            # we are behind, request a catch up
+        if self.leader_uri != message.sender:
+            self.leader_uri = message.sender
+            self.last_vote = message
+            self.logger.info("%s accepting new leader %s", self.hull.get_my_uri(),
+                             self.leader_uri)
+        last_index = self.log.get_metadata().last_index
+        if message.prevLogIndex > last_index:
+            # we are behind, request a catch up. If there are entries
+            # we can't save them, they don't follow our last record
             self.logger.debug("%s log at leader %s is ahead, asking for catchup",
                               self.hull.get_my_uri(), message.sender)
-            await self.ask_for_catchup(message)
+            await self.ask_for_catchup(message, last_index)
             return
-        
-        # We know message.prevLogIndex is > self.last_index
-        # because protocol guarantees it is not less (if code is correct)
-        # because then we would be the leader, or some other server would
-        # be, and the term would be wrong and we would reject this message above.
-        # We know index is not equal cause of two checks above in first and
-        # third if statement clauses
-        self.logger.debug("new records")
-        processor = self.hull.get_processor()
-        recs = []
-        for command in message.entries:
-            result = None
-            error = None
-            try:
-                result, error = await processor.process_command(command)
-                if error is None:
-                    self.logger.debug("processor ran no error")
-                else:
-                    self.logger.warning("processor ran but had an error")
-            except Exception as e:
-                trace = traceback.format_exc()
-                msg = f"processor caused exception {trace}"
-                error = trace
-                self.logger.error(trace)
-            recs.append(dict(result=result, error=error))
-            run_result = dict(command=command,
-                              result=result,
-                              error=error)
-            if error is None:
-                new_rec = LogRec(term=await self.log.get_term(),
-                                 user_data=json.dumps(run_result))
-                await self.log.append([new_rec,])
-        await self.send_append_entries_response(message, recs)
-        return
+        prev_term = await self.get_term_at(message.prevLogIndex)
+        # records in our snapshot are committed, so they always match
+        if prev_term is not None and prev_term != message.prevLogTerm:
+            # Our record there came from a leader that did not get it
+            # committed, back up and let the leader tell us what goes there
+            self.logger.info("%s log at index %d does not match leader %s",
+                             self.hull.get_my_uri(), message.prevLogIndex, message.sender)
+            await self.ask_for_catchup(message, message.prevLogIndex - 1)
+            return
+        if message.entries == []:
+            self.logger.debug("%s heartbeat from leader %s", self.hull.get_my_uri(),
+                              message.sender)
+        # Records are only saved here, they get applied once the leader
+        # tells us they are committed. We may already have some of them
+        # when a catchup and a new push overlap, or records from an old
+        # leader that have to be replaced.
+        existing = dict()
+        first_index = self.log.get_metadata().first_index
+        overlap_start = max(first_index, message.prevLogIndex + 1)
+        overlap_end = min(last_index, message.prevLogIndex + len(message.entries))
+        if overlap_start <= overlap_end:
+            for rec in await self.log.read_range(overlap_start, overlap_end):
+                existing[rec.index] = rec.term
+        new_recs = []
+        truncated_at = None
+        index = message.prevLogIndex
+        for entry in message.entries:
+            index += 1
+            if index <= last_index and truncated_at is None:
+                # records in our snapshot are committed, so they match
+                if index < first_index or existing[index] == entry.term:
+                    continue
+                # The first conflict, this record and all after it came
+                # from a leader that didn't get them committed
+                self.logger.info("%s discarding records from index %d, they conflict with leader %s",
+                                 self.hull.get_my_uri(), index, message.sender)
+                await self.log.truncate_from(index)
+                truncated_at = index
+            new_recs.append(LogRec(code=entry.code,
+                                   term=entry.term,
+                                   user_data=entry.user_data))
+        if new_recs:
+            await self.log.append(new_recs)
+        if truncated_at is not None and truncated_at <= self.hull.get_membership().index:
+            # the config record we were using is gone, so find the latest again
+            await self.hull.load_membership()
+        elif new_recs:
+            await self.hull.records_saved(new_recs)
+        # Our log matches the leader's up to the end of the message, so
+        # anything it says is committed up to there can be applied
+        matched = message.prevLogIndex + len(message.entries)
+        if matched > self.log.get_metadata().durable_index:
+            # The leader counts our answer toward a commit, so the records
+            # must survive a crash before we give it. That goes for ones
+            # saved by an earlier message that are still waiting on a sync.
+            await self.log.flush()
+        await self.hull.set_commit_index(min(message.leaderCommit, matched))
+        await self.send_append_entries_response(message, matched)
+
+    async def on_install_snapshot(self, message):
+        if message.term < self.log.get_metadata().term:
+            await self.send_reject_snapshot_response(message)
+            return
+        self.last_leader_contact = time.time()
+        if self.leader_uri != message.sender:
+            self.leader_uri = message.sender
+            self.last_vote = message
+            self.logger.info("%s accepting new leader %s", self.hull.get_my_uri(),
+                             self.leader_uri)
+        if message.prevLogIndex <= self.hull.get_applied_index():
+            # we already have everything in it, maybe an old duplicate 
+            await self.send_snapshot_response(message, message.offset + len(message.data), True)
+            return
+        transfer = self.snapshot_transfer
+        if (transfer is None or transfer.index != message.prevLogIndex
+            or transfer.term != message.prevLogTerm):
+            if message.offset != 0:
+                # Missed the start, or leader moved on to a new snapshot
+                await self.send_snapshot_response(message, 0, False)
+                return
+            self.logger.info("%s receiving snapshot at index %d from leader %s",
+                             self.hull.get_my_uri(), message.prevLogIndex, message.sender)
+            transfer = SnapshotRec(index=message.prevLogIndex, term=message.prevLogTerm,
+                                   config=message.config)
+            self.snapshot_transfer = transfer
+            self.snapshot_offset = 0
+        if message.offset != self.snapshot_offset:
+            # a chunk got lost, tell the leader where to resume
+            self.logger.debug("%s snapshot chunk at %d not expected, resume at %d",
+                              self.hull.get_my_uri(), message.offset, self.snapshot_offset)
+            await self.send_snapshot_response(message, self.snapshot_offset, False)
+            return
+        await self.hull.get_processor().write_snapshot_chunk(transfer, message.offset,
+                                                             memoryview(message.data))
+        self.snapshot_offset += len(message.data)
+        if message.done:
+            await self.hull.install_received_snapshot(transfer)
+            self.snapshot_transfer = None
+        await self.send_snapshot_response(message, self.snapshot_offset, message.done)
 
     async def on_vote_request(self, message):
         if self.last_vote is not None:
@@ -103,13 +211,15 @@ class Follower(BaseState):
             # we have a new vote with a higher term, so forget about the last term's vote
             self.last_vote = None
             
-        # Leadership claims have to be for max log commit index of
-        # at least the same as our local copy
-        last_index = await self.log.get_last_index()
-        # If the messages claim for log index or term are not at least as high
-        # as our local values, then vote no.
-        if message.prevLogIndex < last_index or message.term < await self.log.get_term():
-            self.logger.info("%s voting false on %s", self.hull.get_my_uri(),
+        # Raft paper section 5.4.1, the candidate's log has to be at least
+        # as up to date as ours, by last term first and then by length,
+        # otherwise it could overwrite committed records once elected
+        if message.term < self.log.get_metadata().term:
+            self.logger.info("%s voting false on %s, old term", self.hull.get_my_uri(),
+                             message.sender)
+            vote = False
+        elif not await self.log_is_up_to_date(message):
+            self.logger.info("%s voting false on %s, log not up to date", self.hull.get_my_uri(),
                              message.sender)
             vote = False
         else: # both term and index proposals are acceptable, so vote yes
@@ -118,6 +228,38 @@ class Follower(BaseState):
             vote = True
         await self.send_vote_response_message(message, votedYes=vote)
             
+    async def on_pre_vote_request(self, message):
+        # Say no if we still hear from the leader, that's what keeps
+        # a server that was cut off from deposing it when it comes back
+        if (self.leader_uri is not None
+            and time.time() - self.last_leader_contact < self.hull.get_leader_lost_timeout()):
+            self.logger.info("%s pre voting false on %s, leader %s is live", self.hull.get_my_uri(),
+                             message.sender, self.leader_uri)
+            vote = False
+        elif message.term <= self.log.get_metadata().term:
+            vote = False
+        else:
+            vote = await self.log_is_up_to_date(message)
+        self.logger.info("%s pre voting %s on %s", self.hull.get_my_uri(), vote, message.sender)
+        await self.send_pre_vote_response(message, vote)
+
+    async def on_timeout_now(self, message):
+        # Leader is handing over to us, no need to wait for it to go quiet
+        if message.sender != self.leader_uri or message.term != self.log.get_metadata().term:
+            self.logger.info("%s ignoring timeout now from %s, not our leader", self.hull.get_my_uri(),
+                             message.sender)
+            return
+        self.logger.info("%s leader %s transferring leadership, starting election",
+                         self.hull.get_my_uri(), message.sender)
+        await self.hull.start_campaign(transfer=True)
+
+    def has_live_leader(self):
+        # Leader may be serving reads on a lease that counts on us
+        # not electing anybody else until we lose touch with it
+        if not self.hull.get_leader_lease() or self.leader_uri is None:
+            return False
+        return time.time() - self.last_leader_contact < self.hull.get_leader_lost_timeout()
+
     async def term_expired(self, message):
         # Raft protocol says all participants should record the highest term
         # value that they receive in a message. Always means an election has
@@ -128,44 +270,74 @@ class Follower(BaseState):
         return message
 
 
-    async def ask_for_catchup(self, message):
+    async def ask_for_catchup(self, message, index):
+        # tell the leader we match its log up to index, at most
         append_response = AppendResponseMessage(sender=self.hull.get_my_uri(),
                                                 receiver=message.sender,
-                                                term=await self.log.get_term(),
+                                                term=self.log.get_metadata().term,
                                                 entries=[],
                                                 results=[],
                                                 prevLogIndex=message.prevLogIndex,
                                                 prevLogTerm=message.prevLogTerm,
-                                                myPrevLogIndex=await self.log.get_last_index(),
-                                                myPrevLogTerm=await self.log.get_last_term())
+                                                myPrevLogIndex=index,
+                                                myPrevLogTerm=await self.get_term_at(index),
+                                                serial=message.serial)
         await self.hull.send_response(message, append_response)
         
     async def leader_lost(self):
+        if self.hull.get_my_uri() not in self.hull.get_voter_ids():
+            # Not a voting member, maybe a learner, not added yet or
+            # already removed, so just wait for a leader to call
+            await self.run_after(self.hull.get_leader_lost_timeout(), self.contact_checker)
+            return
+        delay = self.hull.get_priority_delay()
+        if delay > 0:
+            # give higher priority servers the first chance
+            self.logger.debug("%s lost leader, waiting %f before campaign", self.hull.get_my_uri(), delay)
+            await self.run_after(delay, self.priority_campaign)
+            return
+        await self.hull.start_campaign()
+
+    async def priority_campaign(self):
+        # somebody may have won while we waited
+        if time.time() - self.last_leader_contact < self.hull.get_leader_lost_timeout():
+            await self.run_after(self.hull.get_leader_lost_timeout(), self.contact_checker)
+            return
         await self.hull.start_campaign()
         
     async def send_vote_response_message(self, message, votedYes=True):
         vote_response = RequestVoteResponseMessage(sender=self.hull.get_my_uri(),
                                                    receiver=message.sender,
                                                    term=message.term,
-                                                   prevLogIndex=await self.log.get_last_index(),
-                                                   prevLogTerm=await self.log.get_last_term(),
+                                                   prevLogIndex=self.log.get_metadata().last_index,
+                                                   prevLogTerm=self.log.get_metadata().last_term,
                                                    vote=votedYes)
         await self.hull.send_response(message, vote_response)
         
-    async def send_append_entries_response(self, message, new_records):
-        if new_records is None:
-            new_records = []
+    async def send_append_entries_response(self, message, matched):
         append_response = AppendResponseMessage(sender=self.hull.get_my_uri(),
                                                 receiver=message.sender,
-                                                term=await self.log.get_term(),
+                                                term=self.log.get_metadata().term,
                                                 entries=message.entries,
-                                                results=new_records,
+                                                results=[],
                                                 prevLogIndex=message.prevLogIndex,
                                                 prevLogTerm=message.prevLogTerm,
-                                                myPrevLogIndex=await self.log.get_last_index(),
-                                                myPrevLogTerm=await self.log.get_last_term())
+                                                myPrevLogIndex=matched,
+                                                myPrevLogTerm=await self.get_term_at(matched),
+                                                serial=message.serial)
         await self.hull.send_response(message, append_response)
 
+    async def send_snapshot_response(self, message, next_offset, done):
+        response = InstallSnapshotResponseMessage(sender=self.hull.get_my_uri(),
+                                                  receiver=message.sender,
+                                                  term=self.log.get_metadata().term,
+                                                  prevLogIndex=message.prevLogIndex,
+                                                  prevLogTerm=message.prevLogTerm,
+                                                  offset=message.offset,
+                                                  nextOffset=next_offset,
+                                                  done=done)
+        await self.hull.send_response(message, response)
+
     async def contact_checker(self):
         max_time = self.hull.get_leader_lost_timeout()
         e_time = time.time() - self.last_leader_contact
@@ -1,205 +1,942 @@
 import logging
 import asyncio
 import time
-import json
-import traceback
-from dataclasses import dataclass
+from bisect import bisect_left, insort
+from dataclasses import dataclass, field
 from typing import Dict, List, Any
-from enum import Enum
 from raftframe.states.base_state import StateCode, BaseState
-from raftframe.log.log_api import LogRec
+from raftframe.log.log_api import LogRec, RecordCode, SnapshotRec, record_size
 from raftframe.messages.append_entries import AppendEntriesMessage
+from raftframe.messages.install_snapshot import InstallSnapshotMessage
+from raftframe.messages.timeout_now import TimeoutNowMessage
+from raftframe.hull.membership import Membership, node_weight
 
-class PushStatusCode(str, Enum):
-    sent = "SENT"
-    acked = "ACKED"
-
-@dataclass
-class PushRecord:
-    status: PushStatusCode
-    result: None
-    
 @dataclass
 class CommandTracker:
     term: int
     prevIndex: int
     prevTerm: int
     commands: List[str]
-    finished: bool
-    pushes: Dict[str, PushRecord]
+    # one per command, resolved with that command's result once applied
+    waiters: List[asyncio.Future] = field(default_factory=list)
+    # log records for the commands, once saved
+    records: List[LogRec] = field(default_factory=list)
+    size: int = 0
+    code: RecordCode = RecordCode.client
+
+class MatchOrder:
+    """
+    Match index of every voter, this server included, kept sorted so that the
+    highest index that a commit quorum has is found without a rescan. There is
+    one list per set of voters, two while a membership change is joint. The
+    quorum is more than fraction of the voting weight in the set.
+    """
+
+    def __init__(self, voter_sets, match_index, weights=None, fraction=0.5):
+        self.voter_sets = [set(voters) for voters in voter_sets]
+        self.orders = [sorted((match_index.get(uri, 0), uri) for uri in voters)
+                       for voters in voter_sets]
+        self.weights = weights
+        self.fraction = fraction
+
+    def update(self, uri, old_index, new_index):
+        for voters, order in zip(self.voter_sets, self.orders):
+            if uri in voters:
+                del order[bisect_left(order, (old_index, uri))]
+                insort(order, (new_index, uri))
+
+    def quorum_index(self):
+        # lowest of the quorum indexes of the sets
+        return min(self.set_quorum_index(order) for order in self.orders)
+
+    def set_quorum_index(self, order):
+        if self.weights is None:
+            # same weights, so it is a fixed position from the top
+            count = int(len(order) * self.fraction) + 1
+            return order[len(order) - count][0]
+        need = sum(node_weight(self.weights, uri) for index, uri in order) * self.fraction
+        have = 0
+        for index, uri in reversed(order):
+            have += node_weight(self.weights, uri)
+            if have > need:
+                return index
+        return 0
+
+@dataclass
+class SnapshotTransfer:
+    snapshot: SnapshotRec
+    # where the next chunk to be sent starts
+    next_offset: int = 0
+    # how much the follower has told us it has
+    acked_offset: int = 0
+    # where we last went back to after a lost chunk
+    resumed_offset: int = None
+    done_sent: bool = False
+
+
+class FollowerReplicator:
+    """
+    Sends log records to one follower from its own task, starting at the
+    leader's next index for that follower, so new commands and catchup
+    both go out this way. No more than the configured window of messages
+    and bytes are allowed to wait for a response, so a slow or unreachable
+    follower just falls behind, it does not hold up the others.
+    """
+
+    def __init__(self, leader, nid):
+        self.leader = leader
+        self.nid = nid
+        # prevLogIndex of unanswered messages -> (size, send time)
+        self.in_flight = dict()
+        self.in_flight_bytes = 0
+        # only when the follower needs records that are in our snapshot
+        self.transfer = None
+        # offset of unanswered snapshot chunks -> (size, send time)
+        self.chunks_in_flight = dict()
+        self.wakeup = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = None
+        self.logger = logging.getLogger("Leader")
+
+    def start(self):
+        self.task = asyncio.get_event_loop().create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def window_open(self):
+        hull = self.leader.hull
+        count = len(self.in_flight) + len(self.chunks_in_flight)
+        if count == 0:
+            return True
+        if count >= hull.get_max_in_flight_messages():
+            return False
+        return self.in_flight_bytes < hull.get_max_in_flight_bytes()
+
+    def response_received(self, message):
+        # True if this answers a message we were waiting on
+        rec = self.in_flight.pop(message.prevLogIndex, None)
+        if rec is None:
+            return False
+        self.in_flight_bytes -= rec[0]
+        return True
+
+    def back_up(self, index):
+        # Follower does not have what we sent, so start over from the index
+        # it needs. Anything sent after that is going to fail too.
+        self.leader.next_index[self.nid] = index
+        for prev_index in list(self.in_flight.keys()):
+            if prev_index >= index - 1:
+                size, send_time = self.in_flight.pop(prev_index)
+                self.in_flight_bytes -= size
+
+    def expire_in_flight(self, max_age):
+        # Follower has not answered in too long, the messages are
+        # probably lost. Open the window and start again from
+        # the last thing we know it has.
+        now = time.time()
+        for size, send_time in list(self.in_flight.values()) + list(self.chunks_in_flight.values()):
+            if now - send_time > max_age:
+                self.logger.debug("%s in flight messages to %s expired",
+                                  self.leader.hull.get_my_uri(), self.nid)
+                self.in_flight = dict()
+                self.chunks_in_flight = dict()
+                self.in_flight_bytes = 0
+                self.leader.next_index[self.nid] = self.leader.match_index[self.nid] + 1
+                if self.transfer is not None:
+                    self.transfer.next_offset = self.transfer.acked_offset
+                    self.transfer.done_sent = False
+                self.wakeup.set()
+                return
+
+    def snapshot_response(self, message):
+        # True if the follower has installed the snapshot
+        rec = self.chunks_in_flight.pop(message.offset, None)
+        if rec is not None:
+            self.in_flight_bytes -= rec[0]
+        transfer = self.transfer
+        if transfer is None or message.prevLogIndex != transfer.snapshot.index:
+            return False
+        if message.done:
+            self.transfer = None
+            for size, send_time in self.chunks_in_flight.values():
+                self.in_flight_bytes -= size
+            self.chunks_in_flight = dict()
+            return True
+        if message.nextOffset > message.offset:
+            transfer.acked_offset = max(transfer.acked_offset, message.nextOffset)
+        elif rec is not None and message.nextOffset != transfer.resumed_offset:
+            # Follower did not get everything before this chunk, resume from
+            # where it says. Chunks sent after this one will be rejected too,
+            # and will say the same thing, so they don't count.
+            self.logger.debug("%s resuming snapshot to %s at %d", self.leader.hull.get_my_uri(),
+                              self.nid, message.nextOffset)
+            transfer.next_offset = message.nextOffset
+            transfer.acked_offset = message.nextOffset
+            transfer.resumed_offset = message.nextOffset
+            transfer.done_sent = False
+            for offset in list(self.chunks_in_flight.keys()):
+                if offset >= message.nextOffset:
+                    size, send_time = self.chunks_in_flight.pop(offset)
+                    self.in_flight_bytes -= size
+        return False
+
+    async def run(self):
+        while not self.leader.stopped:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            await self.send_more()
+
+    async def send_more(self):
+        async with self.lock:
+            while self.window_open() and not self.leader.stopped:
+                if not await self.send_next():
+                    break
+
+    async def send_next(self):
+        leader = self.leader
+        start_index = leader.next_index[self.nid]
+        if start_index > leader.log.get_metadata().last_index:
+            return False
+        if self.transfer is not None or start_index < leader.log.get_metadata().first_index:
+            # records it needs have been replaced by a snapshot
+            return await self.send_snapshot_chunk()
+        # New commands are still in memory, older records have to
+        # come from the log
+        tracker = leader.pending_commands.get(start_index - 1, None)
+        if tracker is not None:
+            entries = tracker.records
+            prev_term = tracker.prevTerm
+            size = tracker.size
+        else:
+            entries, size = await leader.read_catchup(start_index)
+            prev_term = await leader.get_term_at(start_index - 1)
+        self.in_flight[start_index - 1] = (size, time.time())
+        self.in_flight_bytes += size
+        leader.next_index[self.nid] = start_index + len(entries)
+        await leader.send_append_entries(self.nid, start_index - 1, prev_term, entries)
+        return True
+
+    async def send_snapshot_chunk(self):
+        leader = self.leader
+        if self.transfer is None:
+            snapshot = await leader.log.get_snapshot()
+            self.logger.info("%s sending snapshot at index %d to %s", leader.hull.get_my_uri(),
+                             snapshot.index, self.nid)
+            self.transfer = SnapshotTransfer(snapshot=snapshot)
+        transfer = self.transfer
+        if transfer.done_sent:
+            return False
+        # Each message gets its own buffer, since it stays around until sent
+        chunk_size = leader.hull.get_snapshot_chunk_size()
+        buffer = memoryview(bytearray(chunk_size))
+        offset = transfer.next_offset
+        count = await leader.hull.get_processor().read_snapshot_chunk(transfer.snapshot,
+                                                                      offset, buffer)
+        done = count < chunk_size
+        self.chunks_in_flight[offset] = (count, time.time())
+        self.in_flight_bytes += count
+        transfer.next_offset += count
+        transfer.done_sent = done
+        await leader.send_snapshot_chunk(self.nid, transfer.snapshot, offset, buffer[:count], done)
+        return True
+
 
-    
 class Leader(BaseState):
 
     def __init__(self, hull, term):
         super().__init__(hull, StateCode.leader)
+        self.term = term
         self.last_broadcast_time = 0
-        self.pending_command = None
-        self.old_commands = dict()  # commands that have not yet got all response, but are committed
+        # commands saved and sent but not yet committed, keyed by prevIndex,
+        # in prevIndex order since they are created that way
+        self.pending_commands = dict()
+        # commands collected but not yet saved, only when batching is configured
+        self.open_batch = None
+        self.batch_handle = None
+        # log index -> future for the caller waiting on that command's result
+        self.command_waiters = dict()
+        self.append_lock = asyncio.Lock()
+        # Raft paper's nextIndex and matchIndex, per follower. The next index
+        # is the first record that has not been sent to the follower, the match
+        # index is the highest index the follower has told us matches our log
+        self.next_index = dict()
+        self.match_index = dict()
+        self.replicators = dict()
+        # last durable index in our own log, our match index, and the first
+        # index of this term, only records from there on can be committed by count
+        self.own_match = 0
+        self.term_first_index = None
+        self.match_order = None
+        # Each append entries message gets the next serial number, followers
+        # echo it, so we know which of them recognized us as leader after
+        # a given message was sent
+        self.message_serial = 0
+        self.acked_serial = dict()
+        # (first serial that counts, future) for reads waiting to
+        # confirm leadership
+        self.read_waiters = []
+        # first serial of the heartbeat round those reads are waiting on
+        self.read_round_serial = None
+        # resolved when a record of this term has been applied
+        self.term_start_waiter = None
+        # (first serial, send time) of heartbeat rounds not yet answered by a quorum
+        self.broadcast_times = []
+        # monotonic clock time, local reads are safe until then
+        self.lease_expires = 0
+        # follower -> time of last response in our term, for check quorum
+        self.last_ack_time = dict()
+        # set while handing over to a higher priority server
+        self.priority_transfer_task = None
+        # server -> time before which we don't try handing over to it again,
+        # after a transfer to it failed
+        self.priority_holds = dict()
+        # server we are handing leadership to, no new commands while set,
+        # and the log index it has to reach before we tell it to take over
+        self.transfer_target = None
+        self.transfer_index = None
+        self.transfer_waiter = None
+        # resolved when a membership change is committed in its final config
+        self.membership_waiter = None
+        # (follower, index, future) for callers waiting for a follower to catch up
+        self.match_waiters = []
         self.logger = logging.getLogger("Leader")
 
     async def start(self):
         await super().start()
+        last_index = self.log.get_metadata().last_index
+        self.own_match = await self.log.flush()
+        self.term_first_index = last_index + 1
+        for nid in self.hull.get_cluster_node_ids():
+            if nid == self.hull.get_my_uri():
+                continue
+            self.next_index[nid] = last_index + 1
+            self.match_index[nid] = 0
+            # give everyone a full timeout to answer
+            self.last_ack_time[nid] = time.time()
+            self.get_replicator(nid)
+        self.build_match_order()
         await self.run_after(self.hull.get_heartbeat_period(), self.send_heartbeats)
         await self.send_heartbeats()
+        membership = self.hull.get_membership()
+        if membership.is_joint():
+            # last leader didn't get to finish the change
+            if membership.index <= self.hull.get_commit_index():
+                await self.save_config(Membership(nodes=list(membership.nodes),
+                                                  learners=list(membership.learners)))
+            else:
+                # Records from earlier terms only get committed along with
+                # one of ours, and the joint config finishes once applied
+                await self.commit_term_start()
+
+    async def stop(self):
+        await super().stop()
+        if self.batch_handle:
+            self.batch_handle.cancel()
+            self.batch_handle = None
+        for replicator in self.replicators.values():
+            replicator.stop()
+        # nobody is going to report results for these now, let the callers know
+        waiters = list(self.command_waiters.values())
+        if self.open_batch:
+            waiters += self.open_batch.waiters
+        waiters += [waiter for serial, waiter in self.read_waiters]
+        if self.membership_waiter is not None:
+            waiters.append(self.membership_waiter)
+            self.membership_waiter = None
+        waiters += [waiter for nid, index, waiter in self.match_waiters]
+        self.match_waiters = []
+        if self.transfer_waiter is not None and not self.transfer_waiter.done():
+            # this is what a transfer is waiting for
+            self.transfer_waiter.set_result(True)
+        self.command_waiters = dict()
+        self.read_waiters = []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_exception(Exception('Leader stopped before command was applied'))
 
     async def apply_command(self, command, timeout=1.0):
         self.logger.info("%s requested command sequence", self.hull.get_my_uri())
-        if self.pending_command:
-            self.logger.info("%s waiting for completion of pending command", self.hull.get_my_uri())
-            start_time = time.time()
-            while self.pending_command and time.time() - start_time < timeout:
-                await asyncio.sleep(0.001)
-        if self.pending_command:
-            msg = f'command already pending not completed in {timeout} seconds, command was'
-            msg += f" {self.pending_command.commands}"
-            raise Exception(msg)
-        self.logger.info("%s starting command sequence for index %d", self.hull.get_my_uri(),
-                         await self.log.get_last_index())
-        consensus_condition = asyncio.Condition()
-        self.pending_command = CommandTracker(term=await self.log.get_term(),
-                                              prevIndex=await self.log.get_last_index(),
-                                              prevTerm=await self.log.get_last_term(),
-                                              finished=False,
-                                              pushes=dict(),
-                                              commands=[command,])
-
-        run_result = None
-        await self.send_entries()
-        async def done_check(tracker):
-            while not tracker.finished:
-                try:
-                    await asyncio.sleep(0.0001)
-                except asyncio.CancelledError:
-                    return
+        tracker = self.open_batch
+        if tracker is None:
+            tracker = self.new_tracker()
+        waiter = asyncio.get_event_loop().create_future()
+        tracker.waiters.append(waiter)
+        tracker.commands.append(command)
+        tracker.size += len(command.encode())
+        if (self.hull.get_command_batch_window() == 0
+            or len(tracker.commands) >= self.hull.get_command_batch_max_count()
+            or tracker.size >= self.hull.get_command_batch_max_bytes()):
+            await self.send_batch()
+        elif self.batch_handle is None:
+            loop = asyncio.get_event_loop()
+            self.batch_handle = loop.call_later(self.hull.get_command_batch_window(),
+                                                lambda: asyncio.create_task(self.send_batch()))
         try:
-            await asyncio.wait_for(asyncio.create_task(done_check(self.pending_command)), timeout=timeout)
+            return await asyncio.wait_for(waiter, timeout=timeout)
         except asyncio.TimeoutError:
+            # The command stays in the log, it may still get committed and
+            # applied, we just can't wait any longer for it.
             msg = f'Requested command sequence not completed in {timeout} seconds'
             raise Exception(msg)
+
+    def new_tracker(self):
+        # log position gets filled in when the batch is saved
+        self.open_batch = CommandTracker(term=self.term,
+                                         prevIndex=0,
+                                         prevTerm=0,
+                                         commands=[])
+        return self.open_batch
+
+    async def send_batch(self):
+        if self.batch_handle:
+            self.batch_handle.cancel()
+            self.batch_handle = None
+        tracker = self.open_batch
+        if tracker is None or self.stopped:
+            return
+        self.open_batch = None
+        await self.save_and_send(tracker)
+
+    async def save_and_send(self, tracker):
+        # Commands are pipelined, each batch is saved to the log following
+        # the last one, even though that one may not be committed yet.
+        async with self.append_lock:
+            tracker.prevIndex = self.log.get_metadata().last_index
+            tracker.prevTerm = self.log.get_metadata().last_term
+            for pos, command in enumerate(tracker.commands):
+                tracker.records.append(LogRec(code=tracker.code,
+                                              index=tracker.prevIndex + pos + 1,
+                                              term=tracker.term,
+                                              user_data=command))
+            await self.log.append(tracker.records)
+            self.pending_commands[tracker.prevIndex] = tracker
+            await self.hull.records_saved(tracker.records)
+        self.logger.info("%s saved command sequence at index %d", self.hull.get_my_uri(),
+                         tracker.prevIndex + 1)
+        for pos, waiter in enumerate(tracker.waiters):
+            self.command_waiters[tracker.prevIndex + pos + 1] = waiter
+        # followers can start on the records while we make them durable
+        await self.send_entries(tracker)
+        await self.set_own_match(await self.log.flush())
+
+    async def set_own_match(self, index):
+        # Our own log only counts toward a commit up to where it is durable,
+        # with group syncing one flush can cover many concurrent commands
+        if index <= self.own_match or self.stopped:
+            return
+        old_index = self.own_match
+        self.own_match = index
+        self.match_order.update(self.hull.get_my_uri(), old_index, index)
+        # we might be the only voter
+        await self.advance_commit()
+
+    def build_match_order(self):
+        match_index = dict(self.match_index)
+        match_index[self.hull.get_my_uri()] = self.own_match
+        membership = self.hull.get_membership()
+        voter_sets = [membership.nodes]
+        if membership.is_joint():
+            voter_sets.append(membership.old_nodes)
+        self.match_order = MatchOrder(voter_sets, match_index, self.hull.get_node_weights(),
+                                      self.hull.get_commit_quorum())
+
+    async def set_match_index(self, nid, index):
+        # Follower log matches ours up to index
+        old_index = self.match_index[nid]
+        if index <= old_index:
+            return
+        self.match_index[nid] = index
+        self.match_order.update(nid, old_index, index)
+        await self.advance_commit()
+
+    async def advance_commit(self):
+        # Everything up to the highest index that a majority of voters have
+        # is committed, as long as that one is from this term (Raft paper
+        # section 5.4.2). Older records get committed along with it.
+        commit_index = self.match_order.quorum_index()
+        if commit_index <= self.hull.get_commit_index() or commit_index < self.term_first_index:
+            return
+        while self.pending_commands:
+            tracker = self.pending_commands[next(iter(self.pending_commands))]
+            if tracker.prevIndex + len(tracker.records) > commit_index:
+                break
+            del self.pending_commands[tracker.prevIndex]
+        # current state is "committed" as defined in raft paper, commands can
+        # be applied
+        self.logger.info('%s got consensus through index %d', self.hull.get_my_uri(),
+                         commit_index)
+        await self.hull.set_commit_index(commit_index)
+
+    async def command_applied(self, index, result, error):
+        waiter = self.command_waiters.pop(index, None)
+        # caller may have timed out
+        if waiter is not None and not waiter.done():
+            waiter.set_result((result, error))
+        membership = self.hull.get_membership()
+        if index == membership.index:
+            await self.membership_committed(membership)
+
+    async def change_membership(self, node_uris, learners, timeout):
+        membership = self.hull.get_membership()
+        if (self.membership_waiter is not None or membership.is_joint()
+            or membership.index > self.hull.get_commit_index()):
+            raise Exception('Cluster membership change already in progress')
+        self.membership_waiter = asyncio.get_event_loop().create_future()
+        waiter = self.membership_waiter
+        if set(node_uris) == set(membership.nodes):
+            # only learners changing, quorums are the same
+            await self.save_config(Membership(nodes=list(node_uris), learners=list(learners)))
+        else:
+            # Old and new both have to agree on everything until the
+            # joint config is committed, then the new one takes over
+            await self.save_config(Membership(nodes=list(node_uris), old_nodes=list(membership.nodes),
+                                              learners=list(learners)))
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            # it carries on without us
+            raise Exception(f'Cluster membership change not done in {timeout} seconds')
+
+    async def wait_for_match(self, nid, index, timeout):
+        if nid not in self.match_index:
+            raise Exception(f'{nid} is not getting records from this leader')
+        if self.match_index[nid] >= index:
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self.match_waiters.append((nid, index, waiter))
+        try:
+            await asyncio.wait_for(waiter, timeout=timeout)
+        except asyncio.TimeoutError:
+            raise Exception(f'{nid} did not catch up to index {index} in {timeout} seconds')
+
+    def check_match_waiters(self, nid):
+        waiting = []
+        for rec in self.match_waiters:
+            if rec[0] != nid or rec[1] > self.match_index[nid]:
+                waiting.append(rec)
+            elif not rec[2].done():
+                rec[2].set_result(True)
+        self.match_waiters = waiting
+
+    async def save_config(self, membership):
+        self.logger.info("%s saving cluster config %s", self.hull.get_my_uri(), membership)
+        tracker = CommandTracker(term=self.term,
+                                 prevIndex=0,
+                                 prevTerm=0,
+                                 commands=[membership.to_json()],
+                                 code=RecordCode.cluster_confit)
+        await self.save_and_send(tracker)
+
+    async def membership_changed(self):
+        # new servers start getting records right away
+        for nid in self.hull.get_cluster_node_ids():
+            if nid != self.hull.get_my_uri() and nid not in self.replicators:
+                self.last_ack_time[nid] = time.time()
+                self.get_replicator(nid)
+        self.build_match_order()
+
+    async def membership_committed(self, membership):
+        if membership.is_joint():
+            await self.save_config(Membership(nodes=list(membership.nodes),
+                                              learners=list(membership.learners)))
+            return
+        self.logger.info("%s cluster membership change done, %s", self.hull.get_my_uri(), membership)
+        for nid in list(self.replicators.keys()):
+            if nid not in membership.all_nodes():
+                self.replicators.pop(nid).stop()
+                for table in (self.next_index, self.match_index, self.last_ack_time, self.acked_serial):
+                    table.pop(nid, None)
+        if self.membership_waiter is not None:
+            if not self.membership_waiter.done():
+                self.membership_waiter.set_result(True)
+            self.membership_waiter = None
+        if self.hull.get_my_uri() not in membership.nodes:
+            # we've been removed, the others can elect one of their own
+            self.logger.info("%s not in cluster anymore, resigning", self.hull.get_my_uri())
+            await self.hull.demote_and_handle()
+
+    async def transfer_leadership(self, target_uri, timeout):
+        if target_uri == self.hull.get_my_uri() or target_uri not in self.hull.get_voter_ids():
+            raise Exception(f'Cannot transfer leadership to {target_uri}, not a voting follower')
+        if self.transfer_target is not None:
+            raise Exception(f'Leadership transfer to {self.transfer_target} already in progress')
+        self.transfer_target = target_uri
+        self.transfer_waiter = asyncio.get_event_loop().create_future()
+        # The target can win with votes that ignore leases, so no heartbeat
+        # round sent before or during the transfer may count for one
+        self.revoke_lease()
+        # anything collected so far still goes out, then the target
+        # needs to catch up to the end of the log
+        await self.send_batch()
+        async with self.append_lock:
+            self.transfer_index = self.log.get_metadata().last_index
+        self.logger.info("%s transferring leadership to %s at index %d", self.hull.get_my_uri(),
+                         target_uri, self.transfer_index)
+        await self.check_transfer(target_uri)
+        if self.transfer_index is not None:
+            # If earlier pushes to it got lost we won't hear until the next
+            # heartbeat, so send it one now to find out what it needs
+            await self.send_append_entries(target_uri, self.transfer_index,
+                                           await self.get_term_at(self.transfer_index), [])
+        try:
+            await asyncio.wait_for(asyncio.shield(self.transfer_waiter), timeout)
+        except asyncio.TimeoutError:
+            # target didn't get elected, so carry on being leader
+            self.logger.warning("%s leadership transfer to %s timed out", self.hull.get_my_uri(),
+                                target_uri)
+            self.transfer_target = None
+            self.transfer_index = None
+            self.transfer_waiter = None
+            # it may have won anyway, a new lease needs rounds sent from here
+            self.revoke_lease()
+            raise Exception(f'Leadership transfer to {target_uri} not done in {timeout} seconds')
+
+    async def check_transfer(self, nid):
+        # once the target has our whole log it can win the election
+        if nid != self.transfer_target or self.transfer_index is None:
+            return
+        if self.match_index[nid] < self.transfer_index:
+            await self.get_replicator(nid).send_more()
+            return
+        self.transfer_index = None
+        # It will get votes even from servers that still hear from us,
+        # so our lease is no good from here
+        self.revoke_lease()
+        message = TimeoutNowMessage(sender=self.hull.get_my_uri(),
+                                    receiver=nid,
+                                    term=self.log.get_metadata().term,
+                                    prevLogIndex=self.log.get_metadata().last_index,
+                                    prevLogTerm=self.log.get_metadata().last_term)
+        await self.hull.send_message(message)
+
+    def check_priority_transfer(self):
+        # Hand over to the highest priority server above us that is
+        # answering and has everything that is committed
+        if self.transfer_target is not None:
+            return
+        if self.priority_transfer_task is not None and not self.priority_transfer_task.done():
+            return
+        my_priority = self.hull.get_election_priority()
+        best = None
+        limit = time.time() - self.hull.get_leader_lost_timeout()
+        for nid in self.next_index:
+            if nid not in self.hull.get_voter_ids():
+                continue
+            priority = self.hull.get_election_priority(nid)
+            if priority <= my_priority or self.last_ack_time[nid] < limit:
+                continue
+            if nid not in self.acked_serial:
+                # not heard from it yet this term
+                continue
+            if self.match_index[nid] < self.hull.get_commit_index():
+                continue
+            if self.priority_holds.get(nid, 0) > time.time():
+                continue
+            if best is None or priority > self.hull.get_election_priority(best):
+                best = nid
+        if best is None:
+            return
+        self.logger.info("%s handing leadership to higher priority %s", self.hull.get_my_uri(), best)
+        loop = asyncio.get_event_loop()
+        self.priority_transfer_task = loop.create_task(self.priority_transfer(best))
+
+    async def priority_transfer(self, nid):
+        try:
+            await self.transfer_leadership(nid, self.hull.get_election_timeout_min())
+        except Exception as e:
+            # Commands are refused while a transfer runs, so don't keep
+            # retrying one that can't win
+            self.logger.warning("%s priority transfer failed, %s", self.hull.get_my_uri(), e)
+            self.priority_holds[nid] = time.time() + 3 * self.hull.get_election_timeout_min()
+
+    async def apply_query(self, query, timeout=1.0):
+        read_index = await self.read_index(timeout)
+        await self.hull.wait_for_applied(read_index, timeout)
+        return await self.hull.get_processor().process_query(query)
+
+    async def read_index(self, timeout=1.0):
+        # Raft paper section 8, a commit index that is safe to read at, without
+        # adding anything to the log. Once we have one of our own records
+        # committed, nothing committed before now can be missing, and if a quorum
+        # still follows us after we record the index, nobody else has committed
+        # anything newer.
+        await self.wait_for_term_start(timeout)
+        read_index = self.hull.get_commit_index()
+        if not self.lease_valid():
+            await self.confirm_leadership(timeout)
+        return read_index
+
+    def lease_valid(self):
+        if not self.hull.get_leader_lease() or self.stopped or self.transfer_target is not None:
+            return False
+        return time.monotonic() < self.lease_expires
+
+    def has_live_leader(self):
+        return self.lease_valid()
+
+    def revoke_lease(self):
+        # heartbeat rounds already sent can't renew it either
+        self.lease_expires = 0
+        self.broadcast_times = []
+
+    def update_lease(self):
+        # Followers will not elect anyone else until the leader lost timeout
+        # has passed since they heard from us, so the lease can run that long
+        # from when the most recent heartbeats that a quorum answered were sent.
+        confirmed = None
+        for pos, (serial, sent_time) in enumerate(self.broadcast_times):
+            if not self.quorum_acked(serial):
+                break
+            confirmed = pos
+        if confirmed is None:
+            return
+        sent_time = self.broadcast_times[confirmed][1]
+        self.broadcast_times = self.broadcast_times[confirmed + 1:]
+        duration = self.hull.get_leader_lost_timeout() * (1 - self.hull.get_lease_clock_drift())
+        self.lease_expires = sent_time + duration
+
+    async def on_read_index(self, message):
+        # Confirming leadership needs other messages to be handled, so
+        # it can't be done here
+        asyncio.get_event_loop().create_task(self.answer_read_index(message))
+
+    async def answer_read_index(self, message):
         try:
-            self.logger.info("%s applying command committed at index %d", self.hull.get_my_uri(),
-                             await self.log.get_last_index())
-            processor = self.hull.get_processor()
-            result,error = await processor.process_command(command)
+            read_index = await self.read_index()
         except Exception as e:
-            error = traceback.format_exc()
-            result = None
-        run_result = dict(command=command,
-                          result=result,
-                          error=error)
-        new_rec = LogRec(term=await self.log.get_term(),
-                         user_data=json.dumps(run_result))
-        await self.log.append([new_rec,])
-        return result, error
-        
+            await self.send_read_index_response(message, None, str(e))
+            return
+        await self.send_read_index_response(message, read_index, None)
+
+    async def wait_for_term_start(self, timeout):
+        if await self.get_term_at(self.hull.get_commit_index()) == self.term:
+            return
+        await self.commit_term_start()
+        try:
+            # shared by all reads waiting for it, one timing out must not cancel it
+            await asyncio.wait_for(asyncio.shield(self.term_start_waiter), timeout=timeout)
+        except asyncio.TimeoutError:
+            raise Exception(f'Term start record not committed in {timeout} seconds')
+
+    async def commit_term_start(self):
+        if self.term_start_waiter is not None:
+            return
+        # nothing of ours committed yet, so commit an empty record
+        tracker = CommandTracker(term=self.term,
+                                 prevIndex=0,
+                                 prevTerm=0,
+                                 commands=[None],
+                                 code=RecordCode.no_op)
+        self.term_start_waiter = asyncio.get_event_loop().create_future()
+        tracker.waiters.append(self.term_start_waiter)
+        await self.save_and_send(tracker)
+
+    async def confirm_leadership(self, timeout):
+        # Reads that arrive together share a round of heartbeats, any that
+        # arrive while one is going have to wait for the next one
+        waiter = asyncio.get_event_loop().create_future()
+        self.read_waiters.append((self.message_serial + 1, waiter))
+        if self.read_round_serial is None:
+            await self.start_read_round()
+        try:
+            await asyncio.wait_for(waiter, timeout=timeout)
+        except asyncio.TimeoutError:
+            raise Exception(f'Leadership not confirmed in {timeout} seconds')
+
+    async def start_read_round(self):
+        self.read_round_serial = self.message_serial + 1
+        await self.broadcast_heartbeats()
+        # there may be nobody else to ask
+        await self.check_read_waiters()
+
+    async def check_read_waiters(self):
+        if self.read_round_serial is None:
+            return
+        waiting = []
+        for serial, waiter in self.read_waiters:
+            if not self.quorum_acked(serial):
+                waiting.append((serial, waiter))
+            elif not waiter.done():
+                waiter.set_result(True)
+        self.read_waiters = waiting
+        if self.quorum_acked(self.read_round_serial):
+            self.read_round_serial = None
+            if self.read_waiters:
+                await self.start_read_round()
+
+    def quorum_acked(self, serial):
+        # this server counts too, if it is a voting member
+        acked = [self.hull.get_my_uri()]
+        for nid, acked_serial in self.acked_serial.items():
+            if acked_serial >= serial:
+                acked.append(nid)
+        return self.hull.is_quorum(acked)
+
+    def get_replicator(self, nid):
+        # cluster membership can change, so make these as needed
+        replicator = self.replicators.get(nid, None)
+        if replicator is None:
+            replicator = FollowerReplicator(self, nid)
+            self.replicators[nid] = replicator
+            if nid not in self.next_index:
+                self.next_index[nid] = 1
+                self.match_index[nid] = 0
+            replicator.start()
+        return replicator
+
+    def quorum_in_contact(self):
+        # Raft thesis section 6.2, check quorum. If a majority hasn't answered
+        # in an election timeout, they may have elected someone else already
+        limit = time.time() - self.hull.get_election_timeout_min()
+        in_contact = [self.hull.get_my_uri()]
+        for nid, ack_time in self.last_ack_time.items():
+            if ack_time > limit:
+                in_contact.append(nid)
+        return self.hull.is_quorum(in_contact)
+
     async def send_heartbeats(self):
+        if not self.quorum_in_contact():
+            self.logger.warning("%s lost contact with quorum, resigning", self.hull.get_my_uri())
+            await self.hull.demote_and_handle()
+            return
+        self.check_priority_transfer()
         silent_time = time.time() - self.last_broadcast_time
         remaining_time = self.hull.get_heartbeat_period() - silent_time
         if  remaining_time > 0:
             self.logger.debug("%s resched heartbeats time left %f", self.hull.get_my_uri, remaining_time)
             await self.run_after(remaining_time, self.send_heartbeats)
             return
-        if self.pending_command:
-            wait_time = self.hull.get_heartbeat_period() / 50.0
-            self.logger.debug("%s pending command, resched heartbeats time left %f",
-                              self.hull.get_my_uri, wait_time)
-            await self.run_after(wait_time, self.send_heartbeats)
-            return
+        await self.broadcast_heartbeats()
+        await self.run_after(self.hull.get_heartbeat_period(), self.send_heartbeats)
+
+    async def broadcast_heartbeats(self):
+        if self.hull.get_leader_lease():
+            self.broadcast_times.append((self.message_serial + 1, time.monotonic()))
         for nid in self.hull.get_cluster_node_ids():
             if nid == self.hull.get_my_uri():
                 continue
+            # heartbeats are not subject to the push window, they are how we
+            # find out that a follower that stopped answering is back
+            self.get_replicator(nid).expire_in_flight(self.hull.get_leader_lost_timeout())
             message = AppendEntriesMessage(sender=self.hull.get_my_uri(),
                                            receiver=nid,
-                                           term=await self.log.get_term(),
+                                           term=self.log.get_metadata().term,
                                            entries=[],
-                                           prevLogTerm=await self.log.get_term(),
-                                           prevLogIndex=await self.log.get_last_index())
+                                           prevLogTerm=self.log.get_metadata().last_term,
+                                           prevLogIndex=self.log.get_metadata().last_index,
+                                           leaderCommit=self.hull.get_commit_index(),
+                                           serial=self.next_serial())
             self.logger.debug("%s sending heartbeat to %s", message.sender, message.receiver)
             await self.hull.send_message(message)
         self.last_broadcast_time = time.time()
-        
-    async def send_entries(self):
-        self.command_finished = False
-        tracker = self.pending_command
-        for nid in self.hull.get_cluster_node_ids():
-            if nid == self.hull.get_my_uri():
-                continue
-            tracker.pushes[nid] = PushRecord(status=PushStatusCode.sent, result=None)
-            message = AppendEntriesMessage(sender=self.hull.get_my_uri(),
-                                           receiver=nid,
-                                           term=tracker.term,
-                                           entries=tracker.commands,
-                                           prevLogTerm=tracker.prevTerm,
-                                           prevLogIndex=tracker.prevIndex)
-            self.logger.info("sending %s", message)
-            await self.hull.send_message(message)
-        self.last_broadcast_time = time.time()
-        
-    async def catch_follower_up(self, message):
-        if message.prevLogIndex == message.myPrevLogIndex:
-            return
-        # get the first log record they are missing, send that one
-        rec = await self.log.read(message.myPrevLogIndex + 1)
-        command = json.loads(rec.user_data)['command']
-        entries = [command,]
+
+    def next_serial(self):
+        self.message_serial += 1
+        return self.message_serial
+
+    async def send_entries(self, tracker):
+        # Each follower's replicator sends when its window allows. That
+        # includes servers being removed, until the removal is committed.
+        for nid, replicator in self.replicators.items():
+            replicator.wakeup.set()
+
+    async def send_append_entries(self, nid, prev_index, prev_term, entries):
         message = AppendEntriesMessage(sender=self.hull.get_my_uri(),
-                                       receiver=message.sender,
-                                       term=await self.log.get_term(),
+                                       receiver=nid,
+                                       term=self.log.get_metadata().term,
                                        entries=entries,
-                                       prevLogTerm=await self.log.get_term(),
-                                       prevLogIndex=await self.log.get_last_index())
-        self.logger.info("sending catchup %s", message)
+                                       prevLogTerm=prev_term,
+                                       prevLogIndex=prev_index,
+                                       leaderCommit=self.hull.get_commit_index(),
+                                       serial=self.next_serial())
+        self.logger.info("sending %s", message)
+        await self.hull.send_message(message)
+
+    async def send_snapshot_chunk(self, nid, snapshot, offset, data, done):
+        message = InstallSnapshotMessage(sender=self.hull.get_my_uri(),
+                                         receiver=nid,
+                                         term=self.log.get_metadata().term,
+                                         prevLogIndex=snapshot.index,
+                                         prevLogTerm=snapshot.term,
+                                         offset=offset,
+                                         data=data,
+                                         done=done,
+                                         config=snapshot.config)
+        self.logger.debug("sending %s", message)
         await self.hull.send_message(message)
-        
+
+    async def read_catchup(self, start_index):
+        # read as many of the records a follower is missing as
+        # the configured limits allow
+        last_index = self.log.get_metadata().last_index
+        end_index = min(last_index, start_index + self.hull.get_catchup_max_entries() - 1)
+        entries = await self.log.read_range(start_index, end_index,
+                                            self.hull.get_catchup_max_bytes())
+        return entries, sum(record_size(rec) for rec in entries)
+
+    def response_replicator(self, message):
+        # Replicator for a response we should act on. None if the term is
+        # not ours, higher terms have already demoted us and a lower one is
+        # an answer to an earlier leader, or if the server is no longer in
+        # the cluster, a late answer must not start replicating to it again
+        if message.term != self.term:
+            self.logger.info("%s ignoring %s from %s, term %d is not ours", self.hull.get_my_uri(),
+                             message.get_code(), message.sender, message.term)
+            return None
+        replicator = self.replicators.get(message.sender, None)
+        if replicator is None:
+            self.logger.info("%s ignoring %s from %s, not in the cluster", self.hull.get_my_uri(),
+                             message.get_code(), message.sender)
+        return replicator
+
     async def on_append_entries_response(self, message):
-        current = True
-        if self.pending_command is None:
-            current = False
-        elif self.pending_command.prevIndex > message.prevLogIndex:
-            current = False
-        if not current:
-            # maybe some old push that hasn't recorded all replies yet
-            old_rec = self.old_commands.get(message.prevLogIndex, None)
-            if not old_rec:
-                # prolly just a heartbeat, but check to see if catchup needed
-                if message.prevLogIndex > message.myPrevLogIndex:
-                    await self.catch_follower_up(message)
-                return
-            tracker = old_rec
-        else:
-            tracker = self.pending_command
-        if message.prevLogIndex != tracker.prevIndex or message.prevLogTerm != tracker.prevTerm:
-            self.logger.error("%s got append entries response that can't be identifed", self.hull.get_my_uri())
+        replicator = self.response_replicator(message)
+        if replicator is None:
             return
-        tracker.pushes[message.sender] = "acked"
-        acked = 0
-        for nid in self.hull.get_cluster_node_ids():
-            if nid == self.hull.get_my_uri():
-                continue
-            if tracker.pushes[nid] == "acked":
-                acked += 1
-        if current:
-            if acked  + 1 > len(tracker.pushes) / 2: # this server counts too
-                self.logger.info('%s got consensus on index %d, applying command', self.hull.get_my_uri(),
-                                 message.prevLogIndex + 1)
-                # current state is "committed" as defined in raft paper, command can
-                # be applied
-                tracker.finished = True
-                self.pending_command = None
-                self.old_commands[tracker.prevIndex] = tracker
-        else:
-            # this is an old one, remove it if last reply
-            if acked == len(tracker.pushes):
-                del self.old_commands[tracker.prevIndex]
-        
+        self.last_ack_time[message.sender] = time.time()
+        answered = replicator.response_received(message)
+        # any answer with our term means the follower still follows us
+        if message.serial > self.acked_serial.get(message.sender, 0):
+            self.acked_serial[message.sender] = message.serial
+            if self.hull.get_leader_lease():
+                self.update_lease()
+            await self.check_read_waiters()
+        if message.myPrevLogIndex >= message.prevLogIndex:
+            # follower log matches ours up to the index it reports
+            if message.myPrevLogIndex > self.match_index[message.sender]:
+                await self.set_match_index(message.sender, message.myPrevLogIndex)
+                await self.check_transfer(message.sender)
+                self.check_match_waiters(message.sender)
+        elif answered or len(message.entries) == 0 or len(replicator.in_flight) == 0:
+            # Follower is missing records, or has some that don't match ours,
+            # so start over from what it says it needs. If we are still waiting
+            # on other pushes to it then those will tell us the same thing, unless
+            # they got lost, which a failed heartbeat tells us might be the case.
+            self.logger.debug("%s follower %s needs records from %d", self.hull.get_my_uri(),
+                              message.sender, message.myPrevLogIndex + 1)
+            replicator.back_up(message.myPrevLogIndex + 1)
+        await replicator.send_more()
+
+    async def on_install_snapshot_response(self, message):
+        replicator = self.response_replicator(message)
+        if replicator is None:
+            return
+        self.last_ack_time[message.sender] = time.time()
+        if replicator.snapshot_response(message):
+            self.logger.info("%s follower %s installed snapshot at index %d", self.hull.get_my_uri(),
+                             message.sender, message.prevLogIndex)
+            self.next_index[message.sender] = message.prevLogIndex + 1
+            if message.prevLogIndex > self.match_index[message.sender]:
+                await self.set_match_index(message.sender, message.prevLogIndex)
+                await self.check_transfer(message.sender)
+                self.check_match_waiters(message.sender)
+        await replicator.send_more()
+
     async def term_expired(self, message):
         await self.log.set_term(message.term)
         await self.hull.demote_and_handle(message)
         # don't reprocess message
         return None
-
-
-
-
-
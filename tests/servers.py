@@ -1,4 +1,5 @@
 import asyncio
+import json
 import logging
 import time
 import pytest
@@ -13,6 +14,7 @@ from raftframe.messages.request_vote import RequestVoteMessage,RequestVoteRespon
 from raftframe.messages.append_entries import AppendEntriesMessage, AppendResponseMessage
 from raftframe.messages.base_message import BaseMessage
 from dev_tools.memory_log_v2 import MemoryLog
+from raftframe.log.log_api import SnapshotRec
 from raftframe.hull.api import PilotAPI
 
 def setup_logging():
@@ -80,6 +82,13 @@ async def cluster_maker():
     if the_cluster is not None:
         await the_cluster.cleanup()
     
+async def send_heartbeats(leader_node):
+    # With auto comms running, send heartbeats right away and give them time
+    # to get delivered so followers learn the commit index and apply commands
+    leader_node.hull.state.last_broadcast_time = 0
+    await leader_node.hull.state.send_heartbeats()
+    await asyncio.sleep(0.01)
+
 class simpleOps():
     total = 0
     explode = False
@@ -105,6 +114,11 @@ class simpleOps():
         logger.debug("command %s returning %s no error", command, result)
         return result, None
 
+    async def process_query(self, query):
+        if query != "total":
+            return None, "invalid query"
+        return self.total, None
+
 
 class PauseTrigger:
 
@@ -467,7 +481,6 @@ class NetManager:
             return
         for uri,node in self.full_cluster.nodes.items():
             self.full_cluster.add_node(node)
-            node.hull.cluster_config.node_uris =  list(self.full_cluster.nodes.keys())
         self.segments = None
                 
         
@@ -488,6 +501,7 @@ class PausingServer(PilotAPI):
         self.trigger = None
         self.break_on_message_code = None
         self.network = None
+        self.snapshot_chunks = None
 
     def set_configs(self, local_config, cluster_config):
         self.cluster_config = cluster_config
@@ -503,6 +517,36 @@ class PausingServer(PilotAPI):
     async def process_command(self, command):
         return await self.operations.process_command(command)
         
+    # Part of PilotAPI
+    async def process_query(self, query):
+        return await self.operations.process_query(query)
+
+    # Part of PilotAPI
+    async def take_snapshot(self, index, term):
+        data = json.dumps(dict(total=self.operations.total)).encode()
+        return SnapshotRec(index=index, term=term, data=data)
+
+    # Part of PilotAPI
+    async def restore_snapshot(self, snapshot):
+        self.operations.total = json.loads(snapshot.data)['total']
+
+    # Part of PilotAPI
+    async def read_snapshot_chunk(self, snapshot, offset, buffer):
+        chunk = snapshot.data[offset:offset + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    # Part of PilotAPI
+    async def write_snapshot_chunk(self, snapshot, offset, chunk):
+        if offset == 0:
+            self.snapshot_chunks = bytearray()
+        self.snapshot_chunks += chunk
+
+    # Part of PilotAPI
+    async def finish_snapshot_transfer(self, snapshot):
+        return SnapshotRec(index=snapshot.index, term=snapshot.term,
+                           data=bytes(self.snapshot_chunks))
+        
     # Part of PilotAPI
     async def send_message(self, target, msg):
         self.logger.debug("queueing out msg %s", msg)
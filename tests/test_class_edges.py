@@ -6,6 +6,8 @@ import time
 from raftframe.hull.hull import Hull
 from raftframe.messages.request_vote import RequestVoteMessage,RequestVoteResponseMessage
 from raftframe.messages.append_entries import AppendEntriesMessage, AppendResponseMessage
+from raftframe.log.log_api import LogRec, SnapshotRec
+from dev_tools.memory_log_v2 import MemoryLog
 
 from tests.servers import PausingCluster, cluster_maker
 from tests.servers import setup_logging
@@ -22,3 +24,23 @@ async def test_bogus_pilot(cluster_maker):
         pass
     with pytest.raises(Exception):
         Hull(ts_1.cluster_config, ts_1.local_config, BadPilot())
+
+async def test_log_metadata():
+    log = MemoryLog()
+    meta = log.get_metadata()
+    assert (meta.term, meta.last_index, meta.last_term, meta.first_index) == (0, 0, 0, 1)
+    await log.set_term(1)
+    await log.append([LogRec(term=1, user_data="a"), LogRec(term=1, user_data="b")])
+    await log.incr_term()
+    await log.replace_or_append(LogRec(index=3, term=2, user_data="c"))
+    # same object, kept current by the log
+    assert log.get_metadata() is meta
+    assert meta.term == await log.get_term() == 2
+    assert meta.last_index == await log.get_last_index() == 3
+    assert meta.last_term == await log.get_last_term() == 2
+    await log.replace_or_append(LogRec(index=3, term=1, user_data="c"))
+    assert meta.last_term == 1
+    await log.install_snapshot(SnapshotRec(index=5, term=2))
+    assert meta.first_index == await log.get_first_index() == 6
+    assert meta.last_index == 5
+    assert meta.last_term == 2
@@ -12,7 +12,8 @@ from servers import WhenHasLogIndex
 from servers import WhenInMessageCount, WhenElectionDone
 from servers import WhenAllMessagesForwarded, WhenAllInMessagesHandled
 from servers import PausingCluster, cluster_maker
-from servers import setup_logging
+from servers import setup_logging, send_heartbeats
+from raftframe.states.leader import MatchOrder
 
 setup_logging()
 
@@ -52,9 +53,14 @@ async def test_command_1(cluster_maker):
     res1,err1 = command_result['result']
     assert res1 is not None
     assert err1 is None
+    assert ts_3.operations.total == 1
+    # followers have the record, but only apply it once the leader
+    # tells them it is committed, next heartbeat will do it
+    assert ts_1.operations.total == 0
+    assert ts_2.operations.total == 0
+    await send_heartbeats(ts_3)
     assert ts_1.operations.total == 1
     assert ts_2.operations.total == 1
-    assert ts_3.operations.total == 1
     term = await ts_3.hull.log.get_term()
     index = await ts_3.hull.log.get_last_index()
     assert index == 1
@@ -85,85 +91,350 @@ async def test_command_1(cluster_maker):
     await cluster.deliver_all_pending()
     assert ts_1.hull.get_state_code() == "FOLLOWER"
 
-    # Have a follower blow up, control the messages so that
-    # leader only sends two append_entries, then check
-    # for bad state on exploded follower. Then defuse
-    # the exploder and trigger hearbeat. This should
-    # result in replay of command to follower, which should
-    # then catch up and the the correct state
-
-    command_result = None
-    async def command_runner(ts):
-        nonlocal command_result
-        logger.debug('running command in background')
-        try:
-            command_result = await ts.hull.apply_command("add 1")
-        except Exception as e:
-            logger.debug('running command in background error %s', traceback.format_exc())
-            
-        logger.debug('running command in background done')
-    
+    # Have a follower blow up when it applies commands. It still
+    # saves the records, so the leader still gets consensus, but
+    # it can't apply them until the problem goes away. Then the
+    # next message from the leader should make it retry and
+    # apply all of them in order.
     ts_1.operations.explode = True
-    orig_index = await ts_3.hull.get_log().get_last_index()
-    ts_3.set_trigger(WhenHasLogIndex(orig_index + 1))
-    # also have to fiddle the heartbeat timer or the messages won't be sent
-    loop = asyncio.get_event_loop()
-    logger.debug('------------------------ Starting command runner ---')
-    loop.create_task(command_runner(ts_3))
-    logger.debug('------------------------ Starting run_till_triggers with others ---')
-    await ts_3.run_till_triggers(free_others=True)
-    ts_3.clear_triggers()
-    assert command_result is not None
-    res1,err1 = command_result['result']
-    assert res1 is not None
-    assert err1 is None
+    await cluster.start_auto_comms()
+    for i in range(3):
+        command_result = await ts_3.hull.apply_command("add 1")
+        res1,err1 = command_result['result']
+        assert res1 is not None
+        assert err1 is None
+    await send_heartbeats(ts_3)
     assert ts_1.operations.exploded == True
-
-    assert ts_2.operations.total == 2
-    assert ts_3.operations.total == 2
+    assert ts_2.operations.total == 4
+    assert ts_3.operations.total == 4
     assert ts_1.operations.total == 1
+    assert await ts_1.hull.get_log().get_last_index() == 4
+    assert ts_1.hull.get_commit_index() == 4
+    assert ts_1.hull.get_applied_index() == 1
+
+    # now send heartbeats and ensure that exploded follower catches up
+    ts_1.operations.explode = False
+    await send_heartbeats(ts_3)
+    assert ts_1.operations.total == 4
+    assert ts_1.hull.get_applied_index() == 4
+    await cluster.stop_auto_comms()
+
+async def test_command_pipeline_1(cluster_maker):
+    cluster = cluster_maker(3)
+    cluster.set_configs()
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
 
-    # do it a couple more times so we can test that catch up function works
-    # when follower is behind more than one record
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+
+    logger = logging.getLogger(__name__)
+    await cluster.start()
+    await ts_3.hull.start_campaign()
+    ts_1.set_trigger(WhenElectionDone())
+    ts_2.set_trigger(WhenElectionDone())
+    ts_3.set_trigger(WhenElectionDone())
+        
+    await asyncio.gather(ts_1.run_till_triggers(),
+                         ts_2.run_till_triggers(),
+                         ts_3.run_till_triggers())
     
-    orig_index = await ts_3.hull.get_log().get_last_index()
-    ts_3.set_trigger(WhenHasLogIndex(orig_index + 1))
-    # also have to fiddle the heartbeat timer or the messages won't be sent
-    loop = asyncio.get_event_loop()
-    logger.debug('------------------------ Starting command runner ---')
-    loop.create_task(command_runner(ts_3))
-    logger.debug('------------------------ Starting run_till_triggers with others ---')
-    await ts_3.run_till_triggers(free_others=True)
+    ts_1.clear_triggers()
+    ts_2.clear_triggers()
     ts_3.clear_triggers()
-    assert command_result is not None
-    res1,err1 = command_result['result']
+    assert ts_3.hull.get_state_code() == "LEADER"
+    logger.info('------------------------ Election done')
 
-    assert ts_2.operations.total == 3
-    assert ts_3.operations.total == 3
-    assert ts_1.operations.total == 1
+    # Start several commands without letting any messages move,
+    # they should all be in flight at once, each at its own index
+    loop = asyncio.get_event_loop()
+    tasks = []
+    for i in range(5):
+        tasks.append(loop.create_task(ts_3.hull.apply_command("add 1")))
+    await asyncio.sleep(0.001)
+    leader = ts_3.hull.state
+    assert list(leader.pending_commands.keys()) == [0, 1, 2, 3, 4]
+    assert len(ts_3.out_messages) == 10
 
-    orig_index = await ts_3.hull.get_log().get_last_index()
-    ts_3.set_trigger(WhenHasLogIndex(orig_index + 1))
-    # also have to fiddle the heartbeat timer or the messages won't be sent
+    await cluster.start_auto_comms()
+    results = await asyncio.gather(*tasks)
+    # applied in index order, so the running total tells the order
+    assert [res['result'][0] for res in results] == [1, 2, 3, 4, 5]
+    await send_heartbeats(ts_3)
+    assert ts_1.operations.total == 5
+    assert ts_2.operations.total == 5
+    assert ts_3.operations.total == 5
+    assert await ts_3.hull.log.get_last_index() == 5
+    assert await ts_1.hull.log.get_last_index() == 5
+    assert await ts_2.hull.log.get_last_index() == 5
+    assert len(leader.pending_commands) == 0
+    await cluster.stop_auto_comms()
+
+async def test_command_batch_1(cluster_maker):
+    cluster = cluster_maker(3)
+    config = cluster.build_cluster_config()
+    config.command_batch_window = 0.01
+    config.command_batch_max_count = 3
+    cluster.set_configs(config)
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+
+    logger = logging.getLogger(__name__)
+    await cluster.start()
+    await ts_3.hull.start_campaign()
+    ts_1.set_trigger(WhenElectionDone())
+    ts_2.set_trigger(WhenElectionDone())
+    ts_3.set_trigger(WhenElectionDone())
+        
+    await asyncio.gather(ts_1.run_till_triggers(),
+                         ts_2.run_till_triggers(),
+                         ts_3.run_till_triggers())
+    
+    ts_1.clear_triggers()
+    ts_2.clear_triggers()
+    ts_3.clear_triggers()
+    assert ts_3.hull.get_state_code() == "LEADER"
+    logger.info('------------------------ Election done')
+
+    # First three should fill a batch and go out at once, the
+    # other two should wait for the batch window
     loop = asyncio.get_event_loop()
-    logger.debug('------------------------ Starting command runner ---')
-    loop.create_task(command_runner(ts_3))
-    logger.debug('------------------------ Starting run_till_triggers with others ---')
-    await ts_3.run_till_triggers(free_others=True)
+    tasks = []
+    for i in range(5):
+        tasks.append(loop.create_task(ts_3.hull.apply_command(f"add {i + 1}")))
+    # let the follower replication tasks run
+    await asyncio.sleep(0.001)
+    assert len(ts_3.out_messages) == 2
+    assert len(ts_3.out_messages[0].entries) == 3
+    await asyncio.sleep(0.015)
+    assert len(ts_3.out_messages) == 4
+    assert len(ts_3.out_messages[2].entries) == 2
+    assert ts_3.out_messages[2].prevLogIndex == 3
+
+    await cluster.start_auto_comms()
+    results = await asyncio.gather(*tasks)
+    # each caller gets its own result, applied in order
+    assert [res['result'][0] for res in results] == [1, 3, 6, 10, 15]
+    await send_heartbeats(ts_3)
+    assert ts_1.operations.total == 15
+    assert ts_2.operations.total == 15
+    assert await ts_3.hull.log.get_last_index() == 5
+    assert await ts_1.hull.log.get_last_index() == 5
+    assert await ts_2.hull.log.get_last_index() == 5
+    await cluster.stop_auto_comms()
+
+async def test_command_waiters_1(cluster_maker):
+    cluster = cluster_maker(3)
+    cluster.set_configs()
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+
+    logger = logging.getLogger(__name__)
+    await cluster.start()
+    await ts_3.hull.start_campaign()
+    ts_1.set_trigger(WhenElectionDone())
+    ts_2.set_trigger(WhenElectionDone())
+    ts_3.set_trigger(WhenElectionDone())
+        
+    await asyncio.gather(ts_1.run_till_triggers(),
+                         ts_2.run_till_triggers(),
+                         ts_3.run_till_triggers())
+    
+    ts_1.clear_triggers()
+    ts_2.clear_triggers()
     ts_3.clear_triggers()
-    assert command_result is not None
-    res1,err1 = command_result['result']
+    assert ts_3.hull.get_state_code() == "LEADER"
+    logger.info('------------------------ Election done')
 
-    assert ts_2.operations.total == 4
-    assert ts_3.operations.total == 4
-    assert ts_1.operations.total == 1
+    # No messages moving, so this can't commit in time
+    leader = ts_3.hull.state
+    with pytest.raises(Exception):
+        await leader.apply_command("add 1", timeout=0.01)
+    # still pending, and it still gets applied once acks arrive
+    # without tripping over the abandoned waiter
+    assert len(leader.pending_commands) == 1
+    await cluster.deliver_all_pending()
+    assert len(leader.pending_commands) == 0
+    # applying happens in its own task
+    await asyncio.sleep(0.001)
+    assert ts_3.operations.total == 1
 
-    # now send heartbeats and ensure that exploded follower catches up
+    # A caller waiting when the leader gets demoted should
+    # hear about it right away, not at the timeout
+    loop = asyncio.get_event_loop()
+    task = loop.create_task(leader.apply_command("add 1", timeout=10))
+    await asyncio.sleep(0)
+    start_time = time.time()
+    await ts_3.hull.demote_and_handle()
+    with pytest.raises(Exception):
+        await task
+    assert time.time() - start_time < 1
+
+def test_match_order_1():
+    order = MatchOrder([['a', 'b', 'c']], dict(a=5, b=3, c=1))
+    assert order.quorum_index() == 3
+    order.update('c', 1, 4)
+    assert order.quorum_index() == 4
+    # joint config, the old set is holding it back
+    order = MatchOrder([['a', 'b', 'c'], ['a', 'd', 'e']], dict(a=9, b=8, c=8, d=2, e=1))
+    assert order.quorum_index() == 2
+    order.update('e', 1, 7)
+    assert order.quorum_index() == 7
+
+async def test_commit_by_match_1(cluster_maker):
+    cluster = cluster_maker(3)
+    cluster.set_configs()
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_state_code() == "LEADER"
+    leader = ts_1.hull.state
+
+    # Nobody answers, so nothing commits
+    cluster.net_mgr.split_network([{uri_1: ts_1}, {uri_2: ts_2, uri_3: ts_3}])
+    await cluster.start_auto_comms()
+    loop = asyncio.get_event_loop()
+    tasks = [loop.create_task(ts_1.hull.apply_command("add 1")) for i in range(3)]
+    await asyncio.sleep(0.01)
+    assert ts_1.hull.get_commit_index() == 0
+    assert len(leader.pending_commands) == 3
+    await cluster.stop_auto_comms()
+
+    # After the heal, one catch up message and one answer to it
+    # should commit all three at once
+    cluster.net_mgr.unsplit()
+    cluster.net_mgr.split_network([{uri_1: ts_1, uri_2: ts_2}, {uri_3: ts_3}])
+    await send_heartbeats(ts_1)
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_commit_index() == 3
+    assert len(leader.pending_commands) == 0
+    results = await asyncio.gather(*tasks)
+    assert [res['result'][0] for res in results] == [1, 2, 3]
+
+async def test_stale_response_1(cluster_maker):
+    # Answers to an earlier leader's messages must not move the
+    # current leader's view of the follower
+    cluster = cluster_maker(3)
+    cluster.set_configs()
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    ts_1 = cluster.nodes[uri_1]
+
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    await ts_1.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_state_code() == "LEADER"
+    await cluster.start_auto_comms()
+    command_result = await ts_1.hull.apply_command("add 1")
+    assert command_result['result'][0] == 1
+    await send_heartbeats(ts_1)
+    leader = ts_1.hull.state
+    assert leader.term == 2
+    assert leader.match_index[uri_2] == 1
+    assert leader.next_index[uri_2] == 2
+
+    # one that would back next index up, one that would claim more matches
+    backup = AppendResponseMessage(sender=uri_2, receiver=uri_1, term=1, prevLogIndex=1,
+                                   prevLogTerm=1, entries=[], results=[],
+                                   myPrevLogIndex=0, myPrevLogTerm=0, serial=1000)
+    await leader.on_append_entries_response(backup)
+    assert leader.next_index[uri_2] == 2
+    assert leader.acked_serial[uri_2] < 1000
+    ahead = AppendResponseMessage(sender=uri_2, receiver=uri_1, term=1, prevLogIndex=0,
+                                  prevLogTerm=0, entries=[], results=[],
+                                  myPrevLogIndex=5, myPrevLogTerm=1)
+    await leader.on_append_entries_response(ahead)
+    assert leader.match_index[uri_2] == 1
+    await cluster.stop_auto_comms()
+
+async def test_leader_apply_failure_1(cluster_maker):
+    # The leader's pilot blows up on a command. The leader tries again on
+    # its own even though nothing new gets committed, and the caller only
+    # hears back once the command has really been applied, exactly once.
+    cluster = cluster_maker(3)
+    cluster.set_configs()
+    uri_1 = cluster.node_uris[0]
+    ts_1 = cluster.nodes[uri_1]
+
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_state_code() == "LEADER"
+    await cluster.start_auto_comms()
+    command_result = await ts_1.hull.apply_command("add 1")
+    assert command_result['result'] == (1, None)
+
+    ts_1.hull.cluster_config.heartbeat_period = 0.05
+    ts_1.operations.explode = True
+    loop = asyncio.get_event_loop()
+    task = loop.create_task(ts_1.hull.apply_command("add 1"))
+    await asyncio.sleep(0.2)
+    assert ts_1.operations.exploded
+    assert not task.done()
+    assert ts_1.hull.get_commit_index() == 2
+    assert ts_1.hull.get_applied_index() == 1
+
+    await cluster.stop_auto_comms()
     ts_1.operations.explode = False
-    ts_3.hull.state.last_broadcast_time = 0
-    logger.debug('---------Sending heartbeat and starting run_till_triggers with others ---')
-    await ts_3.hull.state.send_heartbeats()
-    cur_index = await ts_3.hull.get_log().get_last_index()
-    ts_1.set_trigger(WhenHasLogIndex(cur_index))
-    await ts_1.run_till_triggers(free_others=True)
-    assert ts_1.operations.total == 4
+    command_result = await task
+    assert command_result['result'] == (2, None)
+    assert ts_1.operations.total == 2
+    assert ts_1.hull.get_applied_index() == 2
+
+async def test_follower_durable_ack_1(cluster_maker):
+    # A heartbeat that covers records still waiting on a sync has to
+    # wait for it too, the leader counts the answer toward a commit
+    cluster = cluster_maker(3)
+    cluster.set_configs()
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_state_code() == "LEADER"
+    await cluster.start_auto_comms()
+    await ts_1.hull.apply_command("add 1")
+    await cluster.stop_auto_comms()
+
+    log = ts_2.hull.log
+    meta = log.get_metadata()
+    assert meta.last_index == 1
+    meta.durable_index = 0
+    flushes = []
+    async def flush():
+        flushes.append(meta.last_index)
+        meta.durable_index = meta.last_index
+        return meta.durable_index
+    log.flush = flush
+    await ts_1.hull.state.broadcast_heartbeats()
+    await cluster.deliver_all_pending()
+    assert flushes == [1]
+    # nothing more to sync, so the next one doesn't wait
+    await ts_1.hull.state.broadcast_heartbeats()
+    await cluster.deliver_all_pending()
+    assert flushes == [1]
@@ -7,7 +7,7 @@ from raftframe.messages.request_vote import RequestVoteMessage,RequestVoteRespon
 from raftframe.messages.append_entries import AppendEntriesMessage, AppendResponseMessage
 
 from servers import PausingCluster, cluster_maker
-from servers import setup_logging
+from servers import setup_logging, send_heartbeats
 
 setup_logging()
 
@@ -236,3 +236,262 @@ async def test_reelection_3(cluster_maker):
     
     
     
+
+async def test_pre_vote_1(cluster_maker):
+    cluster = cluster_maker(3)
+    config = cluster.build_cluster_config()
+    config.pre_vote = True
+    cluster.set_configs(config)
+    await cluster.start()
+    
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+
+    await ts_1.hull.start_campaign()
+    # pre votes, then the real ones, then the term start heartbeats
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_state_code() == "LEADER"
+    assert ts_2.hull.state.leader_uri == uri_1
+    assert ts_3.hull.state.leader_uri == uri_1
+    assert await ts_1.hull.get_term() == 1
+
+    # Cut ts_3 off and let it try to get elected a few times,
+    # it never hears back so its term should not move
+    cluster.net_mgr.split_network([{uri_1: ts_1, uri_2: ts_2}, {uri_3: ts_3}])
+    await ts_3.hull.state.leader_lost()
+    assert ts_3.hull.get_state_code() == "CANDIDATE"
+    await cluster.deliver_all_pending()
+    for i in range(3):
+        await ts_3.hull.state.election_timed_out()
+        await cluster.deliver_all_pending()
+    assert await ts_3.hull.get_term() == 1
+
+    # After the heal the others still hear from the leader so they
+    # say no, and the leader keeps its job
+    cluster.net_mgr.unsplit()
+    await ts_3.hull.state.election_timed_out()
+    await cluster.deliver_all_pending()
+    assert ts_3.hull.get_state_code() == "CANDIDATE"
+    assert ts_3.hull.state.votes[uri_1] == False
+    assert ts_3.hull.state.votes[uri_2] == False
+    assert ts_1.hull.get_state_code() == "LEADER"
+    assert await ts_1.hull.get_term() == 1
+
+    # next heartbeat brings it back in line
+    await send_heartbeats(ts_1)
+    await cluster.deliver_all_pending()
+    assert ts_3.hull.get_state_code() == "FOLLOWER"
+    assert ts_3.hull.state.leader_uri == uri_1
+    assert await ts_3.hull.get_term() == 1
+    
+    # Once the followers lose the leader too, pre vote lets the
+    # election go ahead
+    await ts_1.hull.demote_and_handle(None)
+    ts_2.hull.state.last_leader_contact = 0
+    ts_3.hull.state.last_leader_contact = 0
+    await ts_2.hull.state.leader_lost()
+    await cluster.deliver_all_pending()
+    assert ts_2.hull.get_state_code() == "LEADER"
+    assert await ts_2.hull.get_term() == 2
+
+async def test_transfer_leadership_1(cluster_maker):
+    cluster = cluster_maker(3)
+    config = cluster.build_cluster_config()
+    config.pre_vote = True
+    config.leader_lease = True
+    cluster.set_configs(config)
+    await cluster.start()
+    
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+
+    await ts_1.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_state_code() == "LEADER"
+    await cluster.start_auto_comms()
+
+    # ts_2 misses a command, so it has to be caught up first
+    cluster.net_mgr.split_network([{uri_1: ts_1, uri_3: ts_3}, {uri_2: ts_2}])
+    await ts_1.hull.apply_command("add 1")
+    assert await ts_2.hull.log.get_last_index() == 0
+    cluster.net_mgr.unsplit()
+
+    # Nobody has lost touch with the leader, but the election goes
+    # ahead anyway, pre vote and leases don't stop it
+    await ts_1.hull.transfer_leadership(uri_2, timeout=1)
+    assert ts_2.hull.get_state_code() == "LEADER"
+    assert ts_1.hull.get_state_code() == "FOLLOWER"
+    assert await ts_2.hull.get_term() == 2
+    assert await ts_2.hull.log.get_last_index() == 1
+    await send_heartbeats(ts_2)
+    assert ts_3.hull.state.leader_uri == uri_2
+    command_result = await ts_1.hull.apply_command("add 1")
+    assert command_result['redirect'] == uri_2
+    with pytest.raises(Exception):
+        await ts_1.hull.transfer_leadership(uri_3)
+
+    # If the target can't be reached the leader gives up, and
+    # goes back to accepting commands
+    cluster.net_mgr.split_network([{uri_2: ts_2, uri_3: ts_3}, {uri_1: ts_1}])
+    loop = asyncio.get_event_loop()
+    task = loop.create_task(ts_2.hull.transfer_leadership(uri_1, timeout=0.05))
+    await asyncio.sleep(0.01)
+    command_result = await ts_2.hull.apply_command("add 1")
+    assert command_result['retry'] is not None
+    with pytest.raises(Exception):
+        await task
+    assert ts_2.hull.get_state_code() == "LEADER"
+    command_result = await ts_2.hull.apply_command("add 1")
+    assert command_result['result'] is not None
+    await send_heartbeats(ts_2)
+    await cluster.stop_auto_comms()
+
+    # Heartbeats sent before the transfer but answered after it
+    # can't give the leader back its lease when it gives up, the
+    # target may have been elected in the meantime
+    leader = ts_2.hull.state
+    assert leader.lease_valid()
+    leader.lease_expires = 0
+    await leader.broadcast_heartbeats()
+    task = loop.create_task(ts_2.hull.transfer_leadership(uri_1, timeout=0.05))
+    await asyncio.sleep(0.01)
+    await cluster.deliver_all_pending()
+    with pytest.raises(Exception):
+        await task
+    assert ts_2.hull.get_state_code() == "LEADER"
+    assert not leader.lease_valid()
+    # rounds sent from now on count again
+    await cluster.start_auto_comms()
+    await send_heartbeats(ts_2)
+    assert leader.lease_valid()
+    await cluster.stop_auto_comms()
+
+async def test_election_priority_1(cluster_maker):
+    cluster = cluster_maker(3)
+    config = cluster.build_cluster_config()
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+    config.election_priorities = {uri_2: 2, uri_3: 1}
+    cluster.set_configs(config)
+    await cluster.start()
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+
+    # three levels, so each gets a third of the range, highest first
+    assert ts_2.hull.get_election_timeout_band() == (10000, 10000 + 10000/3)
+    assert ts_3.hull.get_election_timeout_band() == (10000 + 10000/3, 10000 + 20000/3)
+    assert ts_1.hull.get_election_timeout_band() == (10000 + 20000/3, 20000)
+    for i in range(10):
+        assert ts_2.hull.get_election_timeout() < ts_3.hull.get_election_timeout()
+        assert ts_3.hull.get_election_timeout() < ts_1.hull.get_election_timeout()
+    assert ts_2.hull.get_priority_delay() == 0
+    assert ts_1.hull.get_priority_delay() == pytest.approx(20000/3)
+
+    # lower priority server waits before campaigning
+    ts_1.hull.state.last_leader_contact = 0
+    await ts_1.hull.state.leader_lost()
+    assert ts_1.hull.get_state_code() == "FOLLOWER"
+    assert ts_1.hull.state_run_after_target == ts_1.hull.state.priority_campaign
+
+    # If it wins anyway, it hands over to the top priority
+    # server at the next heartbeat
+    await ts_1.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_state_code() == "LEADER"
+    await cluster.start_auto_comms()
+    await ts_1.hull.apply_command("add 1")
+    leader = ts_1.hull.state
+    await send_heartbeats(ts_1)
+    await leader.priority_transfer_task
+    assert ts_2.hull.get_state_code() == "LEADER"
+    assert ts_1.hull.get_state_code() == "FOLLOWER"
+    # and it stays there
+    await send_heartbeats(ts_2)
+    assert ts_2.hull.get_state_code() == "LEADER"
+    assert ts_2.hull.state.priority_transfer_task is None
+    await cluster.stop_auto_comms()
+
+async def test_election_priority_2(cluster_maker):
+    # A server that isn't a voter gets the whole range, even when its
+    # priority isn't one the voters have
+    cluster = cluster_maker(4)
+    config = cluster.build_cluster_config()
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+    uri_4 = cluster.node_uris[3]
+    config.node_uris = [uri_1, uri_2, uri_3]
+    config.election_priorities = {uri_2: 2, uri_3: 1, uri_4: 5}
+    cluster.set_configs(config)
+    await cluster.start()
+
+    ts_2 = cluster.nodes[uri_2]
+    ts_4 = cluster.nodes[uri_4]
+    assert uri_4 not in ts_4.hull.get_voter_ids()
+    assert ts_4.hull.get_election_timeout_band() == (10000, 20000)
+    assert 10000 <= ts_4.hull.get_election_timeout() <= 20000
+    assert ts_4.hull.get_priority_delay() == 0
+    assert ts_2.hull.get_election_timeout_band() == (10000, 10000 + 10000/3)
+
+async def test_election_priority_3(cluster_maker):
+    # A higher priority server that answers but can't win doesn't get
+    # handed leadership again at every heartbeat
+    cluster = cluster_maker(3)
+    config = cluster.build_cluster_config(election_timeout_min=0.05,
+                                          election_timeout_max=0.1)
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    config.election_priorities = {uri_2: 2}
+    cluster.set_configs(config)
+    await cluster.start()
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    # it never acts on the go ahead
+    ts_2.hull.explode_on_message_code = "timeout_now"
+
+    await ts_1.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_state_code() == "LEADER"
+    await cluster.start_auto_comms()
+    await ts_1.hull.apply_command("add 1")
+    leader = ts_1.hull.state
+    await send_heartbeats(ts_1)
+    first_task = leader.priority_transfer_task
+    await first_task
+    assert ts_1.hull.get_state_code() == "LEADER"
+    assert leader.priority_holds[uri_2] > time.time()
+
+    # held off, so no new transfer and commands go through. The
+    # transfer took an election timeout, so check quorum needs fresh
+    # answers first.
+    await leader.broadcast_heartbeats()
+    await asyncio.sleep(0.01)
+    await send_heartbeats(ts_1)
+    assert leader.priority_transfer_task is first_task
+    assert leader.transfer_target is None
+    command_result = await ts_1.hull.apply_command("add 1")
+    assert command_result['result'] is not None
+
+    # once the hold runs out it gets another go
+    ts_2.hull.explode_on_message_code = None
+    leader.priority_holds[uri_2] = 0
+    await leader.broadcast_heartbeats()
+    await asyncio.sleep(0.01)
+    await send_heartbeats(ts_1)
+    await leader.priority_transfer_task
+    assert ts_2.hull.get_state_code() == "LEADER"
+    await cluster.stop_auto_comms()
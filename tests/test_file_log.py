@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+import os
+import asyncio
+import pytest
+from raftframe.log.log_api import LogRec, SnapshotRec, RecordCode
+from raftframe.log.log_api import DurabilityPolicy, DurabilityMode
+from raftframe.log.file_log import FileLog, HEADER
+from dev_tools.memory_log_v2 import MemoryLog
+
+from servers import setup_logging
+
+setup_logging()
+
+async def test_file_log_1(tmp_path):
+    # small segments and index interval, to make them roll and be used
+    log = FileLog(segment_size=256, index_interval=3)
+    await log.start(tmp_path)
+    meta = log.get_metadata()
+    assert (meta.term, meta.last_index, meta.last_term, meta.first_index) == (0, 0, 0, 1)
+    assert await log.read() is None
+    await log.set_term(1)
+    recs = [LogRec(term=1, user_data=f"command {i}") for i in range(1, 21)]
+    recs.append(LogRec(code=RecordCode.no_op, term=1))
+    recs.append(LogRec(term=1, user_data=b"\x00\x01binary"))
+    await log.append(recs)
+    assert meta.last_index == 22
+    assert len(log.segments) > 2
+    assert (await log.read(7)).user_data == "command 7"
+    assert (await log.read(21)).user_data is None
+    assert (await log.read(21)).code == RecordCode.no_op
+    assert (await log.read()).user_data == b"\x00\x01binary"
+    with pytest.raises(Exception):
+        await log.read(23)
+
+    # replacing in the middle keeps the records after it
+    await log.incr_term()
+    await log.replace_or_append(LogRec(index=4, term=2, user_data="changed"))
+    assert (await log.read(4)).user_data == "changed"
+    assert (await log.read(4)).term == 2
+    assert (await log.read(5)).user_data == "command 5"
+    assert meta.last_index == 22
+    # a record bigger than the segment size gets its own
+    big = "x" * 1000
+    await log.append([LogRec(term=2, user_data=big)])
+    assert (await log.read(23)).user_data == big
+    await log.close()
+
+    log = FileLog(segment_size=256, index_interval=3)
+    await log.start(tmp_path)
+    meta = log.get_metadata()
+    assert (meta.term, meta.last_index, meta.last_term, meta.first_index) == (2, 23, 2, 1)
+    for index in range(5, 21):
+        assert (await log.read(index)).user_data == f"command {index}"
+
+    # sealed segments wholly in the snapshot get deleted
+    seg_count = len(log.segments)
+    await log.install_snapshot(SnapshotRec(index=10, term=1, data=b"state", config="{}"))
+    assert len(log.segments) < seg_count
+    assert log.segments[0].first_index <= 11
+    assert meta.first_index == 11
+    assert meta.last_index == 23
+    with pytest.raises(Exception):
+        await log.read(10)
+    assert (await log.read(11)).user_data == "command 11"
+    await log.close()
+
+    log = FileLog(segment_size=256, index_interval=3)
+    await log.start(tmp_path)
+    meta = log.get_metadata()
+    assert (meta.first_index, meta.last_index, meta.last_term) == (11, 23, 2)
+    snap = await log.get_snapshot()
+    assert (snap.index, snap.term, snap.data, snap.config) == (10, 1, b"state", "{}")
+    # snapshot term doesn't match the record, everything goes
+    await log.install_snapshot(SnapshotRec(index=15, term=3, data=None))
+    assert (meta.first_index, meta.last_index, meta.last_term) == (16, 15, 3)
+    assert log.segments == []
+    await log.append([LogRec(term=3, user_data="after")])
+    assert (await log.read(16)).user_data == "after"
+    await log.close()
+
+async def test_file_log_torn(tmp_path):
+    log = FileLog(segment_size=4096, index_interval=2)
+    await log.start(tmp_path)
+    await log.append([LogRec(term=1, user_data=f"command {i}") for i in range(1, 6)])
+    seg = log.segments[-1]
+    path = seg.path
+    # damage the last record, as a write cut short would
+    offset = seg.find(5)
+    await log.close()
+    with open(path, "r+b") as f:
+        f.seek(offset + HEADER.size)
+        f.write(b"zz")
+
+    log = FileLog(segment_size=4096, index_interval=2)
+    await log.start(tmp_path)
+    meta = log.get_metadata()
+    assert meta.last_index == 4
+    await log.append([LogRec(term=1, user_data="again")])
+    assert (await log.read(5)).user_data == "again"
+    await log.close()
+
+async def test_file_log_allocated(tmp_path):
+    if not hasattr(os, "posix_fallocate"):
+        pytest.skip("no posix_fallocate here")
+    # the whole segment is on disk, not a sparse file, so running out
+    # of space can't show up later as a write into the map
+    size = 1024 * 1024
+    log = FileLog(segment_size=size)
+    await log.start(tmp_path)
+    await log.append([LogRec(term=1, user_data="a")])
+    assert os.stat(log.segments[0].path).st_blocks * 512 >= size
+    await log.close()
+
+async def test_durability_1(tmp_path):
+
+    def count_syncs(log):
+        counter = dict(syncs=0)
+        orig = log.syncer.sync_func
+        async def counting():
+            counter['syncs'] += 1
+            await orig()
+        log.syncer.sync_func = counting
+        return counter
+
+    # every append is synced before it returns
+    log = FileLog(durability=DurabilityPolicy())
+    await log.start(tmp_path / "every")
+    await log.append([LogRec(term=1, user_data="a")])
+    assert log.get_metadata().durable_index == 1
+    assert await log.flush() == 1
+    await log.close()
+
+    # group syncs are shared by everybody waiting in flush
+    log = FileLog(durability=DurabilityPolicy(DurabilityMode.group, group_ms=50))
+    await log.start(tmp_path)
+    counter = count_syncs(log)
+    meta = log.get_metadata()
+    async def command(value):
+        await log.append([LogRec(term=1, user_data=value)])
+        return await log.flush()
+    results = await asyncio.gather(*[command(f"c{i}") for i in range(5)])
+    assert meta.durable_index == 5
+    assert counter['syncs'] == 1
+    assert results == [5] * 5
+    # replacing a record means it isn't durable until the next sync
+    await log.replace_or_append(LogRec(index=3, term=2, user_data="x"))
+    assert meta.durable_index == 2
+    assert await log.flush() == 5
+    assert counter['syncs'] == 2
+    await log.close()
+
+    # enough bytes and the sync happens right away
+    log = FileLog(durability=DurabilityPolicy(DurabilityMode.group, group_ms=10000, group_bytes=100))
+    await log.start(tmp_path / "bytes")
+    counter = count_syncs(log)
+    await log.append([LogRec(term=1, user_data="a")])
+    assert log.get_metadata().durable_index == 0
+    await log.append([LogRec(term=1, user_data="b" * 100)])
+    assert log.get_metadata().durable_index == 2
+    assert counter['syncs'] == 1
+    await log.close()
+
+    # never syncing counts everything as durable at once
+    log = FileLog(durability=DurabilityPolicy(DurabilityMode.none))
+    await log.start(tmp_path / "none")
+    counter = count_syncs(log)
+    await log.append([LogRec(term=1, user_data="a")])
+    assert await log.flush() == 1
+    await log.close()
+    assert counter['syncs'] == 0
+
+async def test_read_range_1(tmp_path):
+    for log in (MemoryLog(), FileLog(segment_size=256, index_interval=3)):
+        if isinstance(log, MemoryLog):
+            await log.start(None, tmp_path)
+        else:
+            log_dir = tmp_path / log.__class__.__name__
+            log_dir.mkdir()
+            await log.start(log_dir)
+        await log.append([LogRec(term=1, user_data=f"{i:02d}") for i in range(1, 31)])
+        recs = await log.read_range(5, 9)
+        assert [rec.index for rec in recs] == [5, 6, 7, 8, 9]
+        assert recs[0].user_data == "05"
+        assert len(await log.read_range(25)) == 6
+        assert len(await log.read_range(25, 100)) == 6
+        assert await log.read_range(31) == []
+        # two bytes each, the first one always comes back
+        assert len(await log.read_range(1, None, 7)) == 3
+        assert len(await log.read_range(1, None, 1)) == 1
+        assert [rec.index for rec in await log.read_range(9, 14, 6)] == [9, 10, 11]
+
+        seen = [rec.index async for rec in log.iter_from(3)]
+        assert seen == list(range(3, 31))
+        seen = [rec.user_data async for rec in log.iter_from(28, 29)]
+        assert seen == ["28", "29"]
+        # records added along the way show up
+        seen = []
+        async for rec in log.iter_from(29):
+            seen.append(rec.index)
+            if rec.index == 30:
+                await log.append([LogRec(term=1, user_data="31")])
+        assert seen == [29, 30, 31]
+
+        await log.install_snapshot(SnapshotRec(index=20, term=1, data=b""))
+        with pytest.raises(Exception):
+            await log.read_range(20)
+        assert [rec.index for rec in await log.read_range(21, 22)] == [21, 22]
+        if not isinstance(log, MemoryLog):
+            await log.close()
+
+async def test_truncate_from_1(tmp_path):
+    for log in (MemoryLog(), FileLog(segment_size=256, index_interval=3)):
+        if isinstance(log, MemoryLog):
+            await log.start(None, tmp_path)
+        else:
+            log_dir = tmp_path / log.__class__.__name__
+            log_dir.mkdir()
+            await log.start(log_dir)
+        meta = log.get_metadata()
+        await log.append([LogRec(term=1, user_data=f"{i:02d}") for i in range(1, 21)])
+        await log.append([LogRec(term=2, user_data=f"{i:02d}") for i in range(21, 31)])
+        await log.truncate_from(31)
+        assert meta.last_index == 30
+        await log.truncate_from(22)
+        assert (meta.last_index, meta.last_term) == (21, 2)
+        with pytest.raises(Exception):
+            await log.read(22)
+        # spans several segments in the file log
+        await log.truncate_from(6)
+        assert (meta.last_index, meta.last_term) == (5, 1)
+        assert meta.durable_index == 5
+        await log.append([LogRec(term=3, user_data="new")])
+        assert (await log.read(6)).user_data == "new"
+        assert [rec.index for rec in await log.read_range(1)] == [1, 2, 3, 4, 5, 6]
+        await log.install_snapshot(SnapshotRec(index=3, term=1, data=b""))
+        with pytest.raises(Exception):
+            await log.truncate_from(3)
+        await log.truncate_from(4)
+        assert (meta.last_index, meta.last_term) == (3, 1)
+        if not isinstance(log, MemoryLog):
+            await log.close()
+            # and it stays that way
+            await log.start(log_dir)
+            assert (meta.first_index, meta.last_index, meta.last_term) == (4, 3, 1)
+            await log.close()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+import asyncio
+import logging
+import pytest
+from raftframe.log.log_api import RecordCode
+from raftframe.hull.membership import Membership
+from raftframe.messages.append_entries import AppendResponseMessage
+from servers import setup_logging, send_heartbeats
+
+setup_logging()
+
+from servers import PausingCluster, cluster_maker
+
+def test_joint_quorum_1():
+    membership = Membership(nodes=['a', 'b', 'c'])
+    assert membership.is_quorum(['a', 'b'])
+    assert not membership.is_quorum(['a', 'd'])
+    joint = Membership(nodes=['c', 'd', 'e'], old_nodes=['a', 'b', 'c'])
+    assert joint.all_nodes() == ['a', 'b', 'c', 'd', 'e']
+    # majority of old alone, or of new alone, is not enough
+    assert not joint.is_quorum(['a', 'b'])
+    assert not joint.is_quorum(['d', 'e'])
+    assert joint.is_quorum(['a', 'c', 'd'])
+    same = Membership.from_json(joint.to_json(), 7)
+    assert same == Membership(nodes=['c', 'd', 'e'], old_nodes=['a', 'b', 'c'], index=7)
+    
+async def test_membership_change_1(cluster_maker):
+    cluster = cluster_maker(4)
+    config = cluster.build_cluster_config()
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+    uri_4 = cluster.node_uris[3]
+    # the last one starts out as a spare
+    config.node_uris = [uri_1, uri_2, uri_3]
+    cluster.set_configs(config)
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+    ts_4 = cluster.nodes[uri_4]
+
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_state_code() == "LEADER"
+    assert ts_4.hull.state.leader_uri is None
+    # spare doesn't try to get elected
+    ts_4.hull.state.last_leader_contact = 0
+    await ts_4.hull.state.leader_lost()
+    assert ts_4.hull.get_state_code() == "FOLLOWER"
+    with pytest.raises(Exception):
+        await ts_2.hull.change_membership([uri_1, uri_2, uri_3, uri_4])
+
+    await cluster.start_auto_comms()
+    await ts_1.hull.apply_command("add 1")
+
+    # Add the spare while commands keep coming
+    all_uris = [uri_1, uri_2, uri_3, uri_4]
+    results = await asyncio.gather(ts_1.hull.change_membership(all_uris),
+                                   ts_1.hull.apply_command("add 1"),
+                                   ts_1.hull.apply_command("add 1"))
+    assert [res['result'][0] for res in results[1:]] == [2, 3]
+    # joint config, then the new one
+    codes = [(await ts_1.hull.log.read(i)).code for i in range(1, 6)]
+    assert codes.count(RecordCode.cluster_confit) == 2
+    await send_heartbeats(ts_1)
+    for ts in [ts_1, ts_2, ts_3, ts_4]:
+        membership = ts.hull.get_membership()
+        assert membership.nodes == all_uris
+        assert not membership.is_joint()
+        assert ts.operations.total == 3
+    assert ts_4.hull.state.leader_uri == uri_1
+
+    # Now remove the leader, it should step down once the new
+    # config is committed, and not try to get elected again
+    results = await asyncio.gather(ts_1.hull.change_membership([uri_2, uri_3, uri_4]),
+                                   return_exceptions=True)
+    assert results == [None]
+    assert ts_1.hull.get_state_code() == "FOLLOWER"
+    ts_1.hull.state.last_leader_contact = 0
+    await ts_1.hull.state.leader_lost()
+    assert ts_1.hull.get_state_code() == "FOLLOWER"
+
+    # the rest carry on without it
+    await ts_4.hull.state.leader_lost()
+    await asyncio.sleep(0.01)
+    assert ts_4.hull.get_state_code() == "LEADER"
+    command_result = await ts_4.hull.apply_command("add 1")
+    assert command_result['result'] == (4, None)
+    await send_heartbeats(ts_4)
+    assert ts_2.operations.total == 4
+    assert ts_3.operations.total == 4
+    assert ts_1.operations.total == 3
+    await cluster.stop_auto_comms()
+
+async def test_learner_1(cluster_maker):
+    cluster = cluster_maker(4)
+    config = cluster.build_cluster_config()
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+    uri_4 = cluster.node_uris[3]
+    config.node_uris = [uri_1, uri_2, uri_3]
+    cluster.set_configs(config)
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+    ts_4 = cluster.nodes[uri_4]
+
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_state_code() == "LEADER"
+    await cluster.start_auto_comms()
+    for i in range(3):
+        await ts_1.hull.apply_command("add 1")
+
+    # Adding a learner needs no joint config, quorum doesn't change
+    await ts_1.hull.add_learner(uri_4)
+    membership = ts_1.hull.get_membership()
+    assert membership.nodes == [uri_1, uri_2, uri_3]
+    assert membership.learners == [uri_4]
+    assert await ts_1.hull.log.get_last_index() == 4
+    await send_heartbeats(ts_1)
+    assert ts_4.operations.total == 3
+    assert ts_4.hull.get_membership() == membership
+    assert ts_4.hull.get_voter_ids() == [uri_1, uri_2, uri_3]
+    # learners don't campaign
+    ts_4.hull.state.last_leader_contact = 0
+    await ts_4.hull.state.leader_lost()
+    assert ts_4.hull.get_state_code() == "FOLLOWER"
+    # and can't be handed leadership
+    with pytest.raises(Exception):
+        await ts_1.hull.transfer_leadership(uri_4)
+
+    # The learner's ack doesn't count, so with the other two cut off
+    # nothing can commit
+    cluster.net_mgr.split_network([{uri_1: ts_1, uri_4: ts_4}, {uri_2: ts_2, uri_3: ts_3}])
+    with pytest.raises(Exception):
+        await ts_1.hull.state.apply_command("add 1", timeout=0.05)
+    assert ts_1.operations.total == 3
+    await ts_1.hull.state.get_replicator(uri_4).send_more()
+    assert ts_1.hull.state.match_index[uri_4] == 5
+    cluster.net_mgr.unsplit()
+    await send_heartbeats(ts_1)
+    await send_heartbeats(ts_1)
+    assert ts_1.operations.total == 4
+
+    # learners can serve reads
+    query_result = await ts_4.hull.apply_query("total")
+    assert query_result['result'] == (4, None)
+
+    # once caught up it can be promoted to voter
+    with pytest.raises(Exception):
+        await ts_1.hull.promote_learner(uri_3)
+    await ts_1.hull.promote_learner(uri_4)
+    membership = ts_1.hull.get_membership()
+    assert membership.nodes == [uri_1, uri_2, uri_3, uri_4]
+    assert membership.learners == []
+    assert not membership.is_joint()
+    await cluster.stop_auto_comms()
+
+async def test_membership_snapshot_1(cluster_maker):
+    # A server that catches up from a snapshot taken after a membership
+    # change has to get the new membership with it
+    cluster = cluster_maker(4)
+    config = cluster.build_cluster_config()
+    config.snapshot_max_entries = 3
+    cluster.set_configs(config)
+    uri_1, uri_2, uri_3, uri_4 = cluster.node_uris
+    ts_1, ts_2, ts_3, ts_4 = [cluster.nodes[uri] for uri in cluster.node_uris]
+
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_state_code() == "LEADER"
+
+    # the last one misses the removal of the third, and enough
+    # commands for it to be snapshotted away
+    cluster.net_mgr.split_network([{uri_1: ts_1, uri_2: ts_2, uri_3: ts_3}, {uri_4: ts_4}])
+    await cluster.start_auto_comms()
+    await ts_1.hull.change_membership([uri_1, uri_2, uri_4])
+    for i in range(4):
+        await ts_1.hull.apply_command("add 1")
+    snapshot = await ts_1.hull.log.get_snapshot()
+    assert snapshot is not None
+    assert await ts_4.hull.log.get_last_index() == 0
+
+    cluster.net_mgr.unsplit()
+    await send_heartbeats(ts_1)
+    await send_heartbeats(ts_1)
+    assert ts_4.operations.total == 4
+    assert (await ts_4.hull.log.get_snapshot()).config is not None
+    assert ts_4.hull.get_membership().nodes == [uri_1, uri_2, uri_4]
+    # and still after reading it back, as on restart
+    await ts_4.hull.load_membership()
+    membership = ts_4.hull.get_membership()
+    assert membership.nodes == [uri_1, uri_2, uri_4]
+    assert not membership.is_joint()
+    await cluster.stop_auto_comms()
+
+async def test_removed_late_response_1(cluster_maker):
+    # A late answer from a server that has been removed must not
+    # start records flowing to it again
+    cluster = cluster_maker(3)
+    cluster.set_configs()
+    uri_1, uri_2, uri_3 = cluster.node_uris
+    ts_1 = cluster.nodes[uri_1]
+
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_state_code() == "LEADER"
+    await cluster.start_auto_comms()
+    await ts_1.hull.change_membership([uri_1, uri_2])
+    leader = ts_1.hull.state
+    assert uri_3 not in leader.replicators
+
+    late = AppendResponseMessage(sender=uri_3, receiver=uri_1, term=leader.term, prevLogIndex=0,
+                                 prevLogTerm=0, entries=[], results=[],
+                                 myPrevLogIndex=0, myPrevLogTerm=0)
+    await leader.on_append_entries_response(late)
+    assert uri_3 not in leader.replicators
+    await cluster.stop_auto_comms()
+
+async def test_joint_new_leader_1(cluster_maker):
+    # A leader that takes over with a joint config it can't know is
+    # committed finishes the change without any commands coming in
+    cluster = cluster_maker(3)
+    cluster.set_configs()
+    uri_1, uri_2, uri_3 = cluster.node_uris
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_state_code() == "LEADER"
+
+    # only uri_2 gets the joint config, and its answer is lost
+    loop = asyncio.get_event_loop()
+    task = loop.create_task(ts_1.hull.change_membership([uri_1, uri_2], timeout=0.5))
+    await asyncio.sleep(0.01)
+    for msg in list(ts_1.out_messages):
+        if msg.receiver == uri_2 and msg.entries:
+            await ts_1.flush_one_out_message(msg)
+    ts_1.clear_out_msgs()
+    await ts_2.do_next_in_msg()
+    ts_2.clear_out_msgs()
+    membership = ts_2.hull.get_membership()
+    assert membership.is_joint()
+    assert ts_2.hull.get_commit_index() < membership.index
+
+    await ts_2.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_2.hull.get_state_code() == "LEADER"
+    with pytest.raises(Exception):
+        await task
+    membership = ts_2.hull.get_membership()
+    assert membership.nodes == [uri_1, uri_2]
+    assert not membership.is_joint()
+    # and the next change can go ahead once that is committed
+    await cluster.start_auto_comms()
+    await send_heartbeats(ts_2)
+    assert ts_2.hull.get_commit_index() >= membership.index
+    await ts_2.hull.change_membership([uri_1, uri_2, uri_3])
+    assert ts_2.hull.get_membership().nodes == [uri_1, uri_2, uri_3]
+    await cluster.stop_auto_comms()
+
+async def test_joint_truncated_1(cluster_maker):
+    # An old leader's joint config that never got committed is cut
+    # when the new leader's records replace it, and the config before
+    # it applies again
+    cluster = cluster_maker(3)
+    cluster.set_configs()
+    uri_1, uri_2, uri_3 = cluster.node_uris
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_state_code() == "LEADER"
+    cluster.net_mgr.split_network([{uri_1: ts_1}, {uri_2: ts_2, uri_3: cluster.nodes[uri_3]}])
+    await cluster.start_auto_comms()
+    with pytest.raises(Exception):
+        await ts_1.hull.change_membership([uri_1, uri_2], timeout=0.01)
+    assert ts_1.hull.get_membership().is_joint()
+
+    await ts_2.hull.start_campaign()
+    await asyncio.sleep(0.01)
+    assert ts_2.hull.get_state_code() == "LEADER"
+    await ts_2.hull.apply_command("add 1")
+    cluster.net_mgr.unsplit()
+    await send_heartbeats(ts_2)
+    assert ts_1.hull.get_state_code() == "FOLLOWER"
+    assert (await ts_1.hull.log.read(1)).user_data == "add 1"
+    assert ts_1.hull.get_membership() == Membership(nodes=[uri_1, uri_2, uri_3])
+    await cluster.stop_auto_comms()
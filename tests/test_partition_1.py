@@ -5,7 +5,9 @@ import pytest
 import time
 from raftframe.messages.request_vote import RequestVoteMessage,RequestVoteResponseMessage
 from raftframe.messages.append_entries import AppendEntriesMessage, AppendResponseMessage
-from servers import setup_logging
+from raftframe.hull.membership import Membership
+from raftframe.states.leader import MatchOrder
+from servers import setup_logging, send_heartbeats
 
 setup_logging()
 
@@ -61,6 +63,7 @@ async def test_partition_1(cluster_maker):
     res1,err1 = command_result['result']
     assert res1 is not None
     assert err1 is None
+    await send_heartbeats(ts_1)
     assert ts_1.operations.total == 1
     assert ts_2.operations.total == 1
     assert ts_3.operations.total == 1
@@ -83,6 +86,7 @@ async def test_partition_1(cluster_maker):
     res1,err1 = command_result['result']
     assert res1 is not None
     assert err1 is None
+    await send_heartbeats(ts_1)
     assert ts_1.operations.total == 2
     assert ts_2.operations.total == 2
     assert ts_3.operations.total == 2
@@ -95,6 +99,7 @@ async def test_partition_1(cluster_maker):
     res1,err1 = command_result['result']
     assert res1 is not None
     assert err1 is None
+    await send_heartbeats(ts_1)
     assert ts_1.operations.total == 3
     assert ts_2.operations.total == 3
     assert ts_3.operations.total == 3
@@ -129,23 +134,21 @@ async def test_partition_1(cluster_maker):
         assert await node.do_next_in_msg() is not None
         assert await node.do_next_out_msg() is not None
 
-        # now we should ping pong till good
         # leader gets the news
         assert await ts_1.do_next_in_msg() is not None
-        # respond with log record
-        assert await ts_1.do_next_out_msg() is not None
-        # processing it
+        # respond with all the missing log records in one message
+        catchup = await ts_1.do_next_out_msg()
+        assert catchup is not None
+        assert len(catchup.entries) == 2
+        assert catchup.prevLogIndex == 1
+        # processing it, records are committed already so they get applied
         assert await node.do_next_in_msg() is not None
-        assert node.operations.total == 2
-        # THANK YOU SIR, MAY I HAVE ANOTHER!!!!???
+        await asyncio.sleep(0.001)
+        assert node.operations.total == 3
         assert await node.do_next_out_msg() is not None
-        # leader considers
+        # leader considers, and has nothing more to send
         assert await ts_1.do_next_in_msg() is not None
-        # leader response
-        assert await ts_1.do_next_out_msg() is not None
-        # processing it
-        assert await node.do_next_in_msg() is not None
-        assert node.operations.total == 3
+        assert await ts_1.do_next_out_msg() is None
         # Life is good
     
     if False:
@@ -158,3 +161,387 @@ async def test_partition_1(cluster_maker):
         assert ts_1.operations.total == 4
         assert ts_2.operations.total == 4
         assert ts_3.operations.total == 4
+
+async def test_catchup_limits_1(cluster_maker):
+    cluster = cluster_maker(3)
+    config = cluster.build_cluster_config()
+    config.catchup_max_entries = 2
+    cluster.set_configs(config)
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+
+    logger = logging.getLogger(__name__)
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    ts_1.set_trigger(WhenElectionDone())
+    ts_2.set_trigger(WhenElectionDone())
+    ts_3.set_trigger(WhenElectionDone())
+        
+    await asyncio.gather(ts_1.run_till_triggers(),
+                         ts_2.run_till_triggers(),
+                         ts_3.run_till_triggers())
+    
+    ts_1.clear_triggers()
+    ts_2.clear_triggers()
+    ts_3.clear_triggers()
+    assert ts_1.hull.get_state_code() == "LEADER"
+
+    part1 = {uri_1: ts_1,
+             uri_2: ts_2}
+    part2 = {uri_3: ts_3}
+    cluster.net_mgr.split_network([part1, part2])
+    await cluster.start_auto_comms()
+    for i in range(5):
+        command_result = await ts_1.hull.apply_command("add 1")
+        assert command_result['result'][0] == i + 1
+    await cluster.stop_auto_comms()
+    assert ts_3.operations.total == 0
+    cluster.net_mgr.unsplit()
+    ts_1.hull.state.last_broadcast_time = 0
+    await ts_1.hull.state.send_heartbeats()
+    in_ledger, out_ledger = await cluster.deliver_all_pending()
+    await asyncio.sleep(0.001)
+    # Should only need three catchup messages, limited to two entries each
+    catchups = [msg for msg in in_ledger
+                if msg.receiver == uri_3 and msg.get_code() == AppendEntriesMessage.get_code()
+                and len(msg.entries) > 0]
+    assert [len(msg.entries) for msg in catchups] == [2, 2, 1]
+    assert ts_3.operations.total == 5
+    assert await ts_3.hull.log.get_last_index() == 5
+    assert ts_1.hull.state.match_index[uri_3] == 5
+
+async def test_push_window_1(cluster_maker):
+    cluster = cluster_maker(3)
+    config = cluster.build_cluster_config()
+    config.max_in_flight_messages = 2
+    cluster.set_configs(config)
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+
+    logger = logging.getLogger(__name__)
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    ts_1.set_trigger(WhenElectionDone())
+    ts_2.set_trigger(WhenElectionDone())
+    ts_3.set_trigger(WhenElectionDone())
+        
+    await asyncio.gather(ts_1.run_till_triggers(),
+                         ts_2.run_till_triggers(),
+                         ts_3.run_till_triggers())
+    
+    ts_1.clear_triggers()
+    ts_2.clear_triggers()
+    ts_3.clear_triggers()
+    assert ts_1.hull.get_state_code() == "LEADER"
+    leader = ts_1.hull.state
+
+    # With no responses, each follower should only get two pushes
+    loop = asyncio.get_event_loop()
+    tasks = []
+    for i in range(6):
+        tasks.append(loop.create_task(ts_1.hull.apply_command("add 1")))
+    await asyncio.sleep(0.001)
+    assert len([msg for msg in ts_1.out_messages if msg.receiver == uri_2]) == 2
+    assert len([msg for msg in ts_1.out_messages if msg.receiver == uri_3]) == 2
+    assert leader.next_index[uri_2] == 3
+    
+    # Now cut off one follower, the other one should keep
+    # things moving and the lost one should not hold it up
+    part1 = {uri_1: ts_1,
+             uri_2: ts_2}
+    part2 = {uri_3: ts_3}
+    cluster.net_mgr.split_network([part1, part2])
+    await cluster.start_auto_comms()
+    results = await asyncio.gather(*tasks)
+    assert [res['result'][0] for res in results] == [1, 2, 3, 4, 5, 6]
+    await send_heartbeats(ts_1)
+    assert ts_2.operations.total == 6
+    assert ts_3.operations.total == 0
+    assert len(leader.replicators[uri_2].in_flight) == 0
+    assert len(leader.replicators[uri_3].in_flight) == 2
+    # nothing more goes to the lost follower while the window is shut
+    command_result = await ts_1.hull.apply_command("add 1")
+    assert command_result['result'][0] == 7
+    assert leader.next_index[uri_3] == 3
+    assert len(leader.replicators[uri_3].in_flight) == 2
+    await cluster.stop_auto_comms()
+
+async def test_partition_conflict_1(cluster_maker):
+    cluster = cluster_maker(3)
+    cluster.set_configs()
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+
+    logger = logging.getLogger(__name__)
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    ts_1.set_trigger(WhenElectionDone())
+    ts_2.set_trigger(WhenElectionDone())
+    ts_3.set_trigger(WhenElectionDone())
+        
+    await asyncio.gather(ts_1.run_till_triggers(),
+                         ts_2.run_till_triggers(),
+                         ts_3.run_till_triggers())
+    
+    ts_1.clear_triggers()
+    ts_2.clear_triggers()
+    ts_3.clear_triggers()
+    assert ts_1.hull.get_state_code() == "LEADER"
+
+    # Cut off the leader, it saves a record but can't commit it
+    part1 = {uri_1: ts_1}
+    part2 = {uri_2: ts_2,
+             uri_3: ts_3}
+    cluster.net_mgr.split_network([part1, part2])
+    await cluster.start_auto_comms()
+    with pytest.raises(Exception):
+        await ts_1.hull.state.apply_command("add 1", timeout=0.01)
+    old_rec = await ts_1.hull.log.read(1)
+    assert ts_1.operations.total == 0
+    
+    # The others elect a new leader and commit a record at the same index
+    await ts_2.hull.start_campaign()
+    start_time = time.time()
+    while ts_2.hull.get_state_code() != "LEADER" and time.time() - start_time < 1:
+        await asyncio.sleep(0.001)
+    assert ts_2.hull.get_state_code() == "LEADER"
+    command_result = await ts_2.hull.apply_command("sub 1")
+    assert command_result['result'][0] == -1
+
+    # When the old leader hears from the new one, it should
+    # replace its uncommitted record with the committed one
+    cluster.net_mgr.unsplit()
+    await send_heartbeats(ts_2)
+    assert ts_1.hull.get_state_code() == "FOLLOWER"
+    new_rec = await ts_1.hull.log.read(1)
+    assert new_rec.term > old_rec.term
+    assert new_rec.user_data == "sub 1"
+    assert await ts_1.hull.log.get_last_index() == 1
+    assert ts_1.operations.total == -1
+    await cluster.stop_auto_comms()
+
+async def test_partition_conflict_2(cluster_maker):
+    # Like the one above, but the old leader has more uncommitted records
+    # than the new leader sends, they all have to go
+    cluster = cluster_maker(3)
+    cluster.set_configs()
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    ts_1.set_trigger(WhenElectionDone())
+    ts_2.set_trigger(WhenElectionDone())
+    ts_3.set_trigger(WhenElectionDone())
+        
+    await asyncio.gather(ts_1.run_till_triggers(),
+                         ts_2.run_till_triggers(),
+                         ts_3.run_till_triggers())
+    
+    ts_1.clear_triggers()
+    ts_2.clear_triggers()
+    ts_3.clear_triggers()
+    assert ts_1.hull.get_state_code() == "LEADER"
+
+    part1 = {uri_1: ts_1}
+    part2 = {uri_2: ts_2,
+             uri_3: ts_3}
+    cluster.net_mgr.split_network([part1, part2])
+    await cluster.start_auto_comms()
+    for i in range(3):
+        with pytest.raises(Exception):
+            await ts_1.hull.state.apply_command("add 1", timeout=0.01)
+    assert await ts_1.hull.log.get_last_index() == 3
+    
+    await ts_2.hull.start_campaign()
+    start_time = time.time()
+    while ts_2.hull.get_state_code() != "LEADER" and time.time() - start_time < 1:
+        await asyncio.sleep(0.001)
+    assert ts_2.hull.get_state_code() == "LEADER"
+    command_result = await ts_2.hull.apply_command("sub 1")
+    assert command_result['result'][0] == -1
+
+    # no config record gets cut, so no need to look for one
+    scans = []
+    orig_membership_at = ts_1.hull.membership_at
+    async def membership_at(index):
+        scans.append(index)
+        return await orig_membership_at(index)
+    ts_1.hull.membership_at = membership_at
+
+    cluster.net_mgr.unsplit()
+    await send_heartbeats(ts_2)
+    assert ts_1.hull.get_state_code() == "FOLLOWER"
+    assert await ts_1.hull.log.get_last_index() == 1
+    assert (await ts_1.hull.log.read(1)).user_data == "sub 1"
+    assert scans == []
+    assert ts_1.operations.total == -1
+    # and it carries on normally from there
+    command_result = await ts_2.hull.apply_command("add 5")
+    assert command_result['result'][0] == 4
+    await send_heartbeats(ts_2)
+    assert await ts_1.hull.log.get_last_index() == 2
+    assert ts_1.operations.total == 4
+    await cluster.stop_auto_comms()
+
+async def test_election_restriction_1(cluster_maker):
+    # A server with a longer log whose last term is older must not win,
+    # its records would replace a committed one (Raft paper section 5.4.1)
+    cluster = cluster_maker(3)
+    cluster.set_configs()
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_state_code() == "LEADER"
+
+    # old leader saves three records it can't commit
+    cluster.net_mgr.split_network([{uri_1: ts_1}, {uri_2: ts_2, uri_3: ts_3}])
+    await cluster.start_auto_comms()
+    for i in range(3):
+        with pytest.raises(Exception):
+            await ts_1.hull.state.apply_command("add 1", timeout=0.01)
+    assert await ts_1.hull.log.get_last_index() == 3
+
+    # the others commit one record in a later term
+    await ts_2.hull.start_campaign()
+    start_time = time.time()
+    while ts_2.hull.get_state_code() != "LEADER" and time.time() - start_time < 1:
+        await asyncio.sleep(0.001)
+    assert ts_2.hull.get_state_code() == "LEADER"
+    command_result = await ts_2.hull.apply_command("sub 1")
+    assert command_result['result'][0] == -1
+    assert (await ts_3.hull.log.read(1)).term == 2
+
+    # the old leader runs a few times on its own, so its term is the highest
+    await ts_1.hull.start_campaign()
+    await ts_1.hull.start_campaign()
+    assert await ts_1.hull.log.get_term() > 2
+
+    # now it can only reach the server with the committed record
+    cluster.net_mgr.split_network([{uri_1: ts_1, uri_3: ts_3}, {uri_2: ts_2}])
+    await ts_1.hull.start_campaign()
+    await asyncio.sleep(0.05)
+    assert ts_1.hull.get_state_code() != "LEADER"
+    assert await ts_3.hull.log.get_last_index() == 1
+    assert (await ts_3.hull.log.read(1)).term == 2
+    assert (await ts_3.hull.log.read(1)).user_data == "sub 1"
+    await cluster.stop_auto_comms()
+
+async def test_check_quorum_1(cluster_maker):
+    cluster = cluster_maker(3)
+    config = cluster.build_cluster_config()
+    config.election_timeout_min = 0.05
+    config.election_timeout_max = 0.1
+    cluster.set_configs(config)
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_state_code() == "LEADER"
+    await cluster.start_auto_comms()
+
+    # answered heartbeats keep it in office
+    await asyncio.sleep(0.03)
+    await send_heartbeats(ts_1)
+    await asyncio.sleep(0.03)
+    await send_heartbeats(ts_1)
+    assert ts_1.hull.get_state_code() == "LEADER"
+
+    # Cut off from the others, a command can't commit, and once the
+    # election timeout passes the leader resigns and the caller
+    # hears about it, rather than waiting out the full timeout
+    cluster.net_mgr.split_network([{uri_1: ts_1}, {uri_2: ts_2, uri_3: ts_3}])
+    leader = ts_1.hull.state
+    task = asyncio.get_event_loop().create_task(leader.apply_command("add 1", timeout=10))
+    await asyncio.sleep(0.06)
+    start_time = time.time()
+    await send_heartbeats(ts_1)
+    assert ts_1.hull.get_state_code() == "FOLLOWER"
+    with pytest.raises(Exception):
+        await task
+    assert time.time() - start_time < 1
+    command_result = await ts_1.hull.apply_command("add 1")
+    assert command_result['result'] is None
+    await cluster.stop_auto_comms()
+
+async def test_flexible_quorum_1(cluster_maker):
+    cluster = cluster_maker(5)
+    config = cluster.build_cluster_config()
+    # these don't always overlap, so they are not allowed
+    config.commit_quorum = 0.3
+    config.election_quorum = 0.6
+    with pytest.raises(Exception):
+        cluster.set_configs(config)
+    # commit with two of five, elect with four
+    config.election_quorum = 0.7
+    cluster.set_configs(config)
+    uris = cluster.node_uris
+    ts_1, ts_2, ts_3, ts_4, ts_5 = [cluster.nodes[uri] for uri in uris]
+
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_1.hull.get_state_code() == "LEADER"
+
+    # Leader and one nearby replica are enough to commit
+    cluster.net_mgr.split_network([{uris[0]: ts_1, uris[1]: ts_2},
+                                   {uris[2]: ts_3, uris[3]: ts_4, uris[4]: ts_5}])
+    await cluster.start_auto_comms()
+    command_result = await ts_1.hull.apply_command("add 1")
+    assert command_result['result'] == (1, None)
+    assert ts_1.hull.get_commit_index() == 1
+
+    # but a plain majority can't elect anybody, since it might
+    # not include a server that has the committed record
+    await ts_3.hull.start_campaign()
+    await asyncio.sleep(0.01)
+    assert ts_3.hull.get_state_code() == "CANDIDATE"
+    assert [ts_3.hull.state.votes[uri] for uri in uris[2:]] == [True, True, True]
+    await cluster.stop_auto_comms()
+
+def test_weighted_quorum_1():
+    weights = {'a': 3}
+    membership = Membership(nodes=['a', 'b', 'c', 'd'])
+    # a alone has half of the weight, not more
+    assert not membership.is_quorum(['a'], weights)
+    assert membership.is_quorum(['a', 'd'], weights)
+    assert not membership.is_quorum(['b', 'c', 'd'], weights)
+    order = MatchOrder([['a', 'b', 'c', 'd']], dict(a=2, b=5, c=6, d=7), weights)
+    assert order.quorum_index() == 2
+    order.update('a', 2, 6)
+    assert order.quorum_index() == 6
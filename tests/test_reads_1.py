@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+import asyncio
+import logging
+import pytest
+from raftframe.log.log_api import RecordCode
+from servers import setup_logging
+
+setup_logging()
+
+from servers import WhenElectionDone
+from servers import PausingCluster, cluster_maker
+
+async def test_read_index_1(cluster_maker):
+    cluster = cluster_maker(3)
+    cluster.set_configs()
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+
+    logger = logging.getLogger(__name__)
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    ts_1.set_trigger(WhenElectionDone())
+    ts_2.set_trigger(WhenElectionDone())
+    ts_3.set_trigger(WhenElectionDone())
+        
+    await asyncio.gather(ts_1.run_till_triggers(),
+                         ts_2.run_till_triggers(),
+                         ts_3.run_till_triggers())
+    
+    ts_1.clear_triggers()
+    ts_2.clear_triggers()
+    ts_3.clear_triggers()
+    assert ts_1.hull.get_state_code() == "LEADER"
+
+    await cluster.start_auto_comms()
+    # Nothing committed in this term yet, so the first read
+    # needs an empty record committed first
+    query_result = await ts_1.hull.apply_query("total")
+    assert query_result['result'] == (0, None)
+    rec = await ts_1.hull.log.read(1)
+    assert rec.code == RecordCode.no_op
+    assert ts_1.hull.get_commit_index() == 1
+
+    for i in range(3):
+        await ts_1.hull.apply_command("add 1")
+    query_result = await ts_1.hull.apply_query("total")
+    assert query_result['result'] == (3, None)
+    # reads don't go in the log
+    assert await ts_1.hull.log.get_last_index() == 4
+    await cluster.stop_auto_comms()
+
+    # Reads that arrive together share one round of heartbeats
+    loop = asyncio.get_event_loop()
+    tasks = []
+    for i in range(5):
+        tasks.append(loop.create_task(ts_1.hull.apply_query("total")))
+    await asyncio.sleep(0.001)
+    assert len(ts_1.out_messages) == 2
+    assert all(len(msg.entries) == 0 for msg in ts_1.out_messages)
+    await cluster.start_auto_comms()
+    results = await asyncio.gather(*tasks)
+    assert [res['result'][0] for res in results] == [3, 3, 3, 3, 3]
+
+    # followers get the read index from the leader, then answer
+    # once they have applied that much
+    query_result = await ts_2.hull.apply_query("total")
+    assert query_result['result'] == (3, None)
+    assert query_result['redirect'] is None
+
+    # A follower that has missed the latest command has to wait
+    # until it has it before it can answer
+    cluster.net_mgr.split_network([{uri_1: ts_1, uri_2: ts_2}, {uri_3: ts_3}])
+    await ts_1.hull.apply_command("add 1")
+    assert ts_3.operations.total == 3
+    cluster.net_mgr.unsplit()
+    query_result = await ts_3.hull.apply_query("total")
+    assert query_result['result'] == (4, None)
+    assert ts_3.operations.total == 4
+    
+    # A leader that has lost touch with the others can't know that
+    # nobody else has been elected, so it can't answer
+    part1 = {uri_1: ts_1}
+    part2 = {uri_2: ts_2,
+             uri_3: ts_3}
+    cluster.net_mgr.split_network([part1, part2])
+    with pytest.raises(Exception):
+        await ts_1.hull.state.apply_query("total", timeout=0.05)
+    await cluster.stop_auto_comms()
+
+async def test_lease_read_1(cluster_maker):
+    cluster = cluster_maker(3)
+    config = cluster.build_cluster_config()
+    config.leader_lease = True
+    cluster.set_configs(config)
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+
+    logger = logging.getLogger(__name__)
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    ts_1.set_trigger(WhenElectionDone())
+    ts_2.set_trigger(WhenElectionDone())
+    ts_3.set_trigger(WhenElectionDone())
+        
+    await asyncio.gather(ts_1.run_till_triggers(),
+                         ts_2.run_till_triggers(),
+                         ts_3.run_till_triggers())
+    
+    ts_1.clear_triggers()
+    ts_2.clear_triggers()
+    ts_3.clear_triggers()
+    assert ts_1.hull.get_state_code() == "LEADER"
+    leader = ts_1.hull.state
+    # heartbeats at election time got answered
+    assert leader.lease_valid()
+
+    await cluster.start_auto_comms()
+    await ts_1.hull.apply_command("add 1")
+    await cluster.stop_auto_comms()
+
+    # With the lease, reads need no messages at all
+    query_result = await ts_1.hull.apply_query("total")
+    assert query_result['result'] == (1, None)
+    assert len(ts_1.out_messages) == 0
+
+    # Once the lease runs out, reads go back to asking a quorum,
+    # and the answers renew it
+    leader.lease_expires = 0
+    loop = asyncio.get_event_loop()
+    task = loop.create_task(ts_1.hull.apply_query("total"))
+    await asyncio.sleep(0.001)
+    assert len(ts_1.out_messages) == 2
+    await cluster.deliver_all_pending()
+    query_result = await task
+    assert query_result['result'] == (1, None)
+    assert leader.lease_valid()
+
+    # Servers that hear from the leader ignore elections, even the leader
+    orig_term = await ts_1.hull.log.get_term()
+    await ts_3.hull.start_campaign()
+    await cluster.deliver_all_pending()
+    assert ts_3.hull.get_state_code() == "CANDIDATE"
+    assert ts_2.hull.get_state_code() == "FOLLOWER"
+    assert ts_1.hull.get_state_code() == "LEADER"
+    assert await ts_2.hull.log.get_term() == orig_term
+    assert await ts_1.hull.log.get_term() == orig_term
+    assert leader.lease_valid()
+
+    # Demotion gives up the lease
+    await ts_1.hull.demote_and_handle()
+    assert not leader.lease_valid()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+import asyncio
+import json
+import logging
+import pytest
+from servers import setup_logging, send_heartbeats
+
+setup_logging()
+
+from servers import WhenElectionDone
+from servers import PausingCluster, cluster_maker
+
+async def test_snapshot_1(cluster_maker):
+    cluster = cluster_maker(3)
+    config = cluster.build_cluster_config()
+    config.snapshot_max_entries = 3
+    cluster.set_configs(config)
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+
+    logger = logging.getLogger(__name__)
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    ts_1.set_trigger(WhenElectionDone())
+    ts_2.set_trigger(WhenElectionDone())
+    ts_3.set_trigger(WhenElectionDone())
+        
+    await asyncio.gather(ts_1.run_till_triggers(),
+                         ts_2.run_till_triggers(),
+                         ts_3.run_till_triggers())
+    
+    ts_1.clear_triggers()
+    ts_2.clear_triggers()
+    ts_3.clear_triggers()
+    assert ts_1.hull.get_state_code() == "LEADER"
+
+    await cluster.start_auto_comms()
+    for i in range(5):
+        command_result = await ts_1.hull.apply_command("add 1")
+        assert command_result['result'][0] == i + 1
+    await send_heartbeats(ts_1)
+    term = await ts_1.hull.log.get_term()
+    # everybody took a snapshot at three, and kept the rest
+    for node in [ts_1, ts_2, ts_3]:
+        assert node.operations.total == 5
+        snapshot = await node.hull.log.get_snapshot()
+        assert snapshot.index == 3
+        assert snapshot.term == term
+        assert json.loads(snapshot.data)['total'] == 3
+        assert await node.hull.log.get_first_index() == 4
+        assert await node.hull.log.get_last_index() == 5
+        with pytest.raises(Exception):
+            await node.hull.log.read(3)
+        assert (await node.hull.log.read(4)).user_data == "add 1"
+
+    # One more makes the count hit the limit again, so the whole
+    # log is covered by the snapshot, and things still work
+    command_result = await ts_1.hull.apply_command("add 1")
+    assert command_result['result'][0] == 6
+    await send_heartbeats(ts_1)
+    for node in [ts_1, ts_2, ts_3]:
+        assert (await node.hull.log.get_snapshot()).index == 6
+        assert await node.hull.log.get_first_index() == 7
+        assert await node.hull.log.get_last_index() == 6
+        assert await node.hull.log.get_last_term() == term
+    command_result = await ts_1.hull.apply_command("add 1")
+    assert command_result['result'][0] == 7
+    await send_heartbeats(ts_1)
+    assert ts_2.operations.total == 7
+    await cluster.stop_auto_comms()
+
+    # A restarted server gets its state back from the snapshot and
+    # only applies the records after it
+    ts_3.set_configs(ts_3.local_config, ts_3.cluster_config)
+    assert ts_3.operations.total == 0
+    await ts_3.start()
+    assert ts_3.operations.total == 6
+    assert ts_3.hull.get_applied_index() == 6
+    await cluster.start_auto_comms()
+    await send_heartbeats(ts_1)
+    assert ts_3.operations.total == 7
+    assert ts_3.hull.get_applied_index() == 7
+    await cluster.stop_auto_comms()
+
+async def test_install_snapshot_1(cluster_maker):
+    cluster = cluster_maker(3)
+    config = cluster.build_cluster_config()
+    config.snapshot_max_entries = 3
+    config.snapshot_chunk_size = 4
+    cluster.set_configs(config)
+    uri_1 = cluster.node_uris[0]
+    uri_2 = cluster.node_uris[1]
+    uri_3 = cluster.node_uris[2]
+
+    ts_1 = cluster.nodes[uri_1]
+    ts_2 = cluster.nodes[uri_2]
+    ts_3 = cluster.nodes[uri_3]
+
+    logger = logging.getLogger(__name__)
+    await cluster.start()
+    await ts_1.hull.start_campaign()
+    ts_1.set_trigger(WhenElectionDone())
+    ts_2.set_trigger(WhenElectionDone())
+    ts_3.set_trigger(WhenElectionDone())
+        
+    await asyncio.gather(ts_1.run_till_triggers(),
+                         ts_2.run_till_triggers(),
+                         ts_3.run_till_triggers())
+    
+    ts_1.clear_triggers()
+    ts_2.clear_triggers()
+    ts_3.clear_triggers()
+    assert ts_1.hull.get_state_code() == "LEADER"
+
+    # Leave one follower out while the others snapshot
+    # away the records it needs
+    part1 = {uri_1: ts_1,
+             uri_2: ts_2}
+    part2 = {uri_3: ts_3}
+    cluster.net_mgr.split_network([part1, part2])
+    await cluster.start_auto_comms()
+    for i in range(7):
+        command_result = await ts_1.hull.apply_command("add 1")
+        assert command_result['result'][0] == i + 1
+    await send_heartbeats(ts_1)
+    await cluster.stop_auto_comms()
+    assert await ts_1.hull.log.get_first_index() == 7
+    assert await ts_3.hull.log.get_last_index() == 0
+    snapshot = await ts_1.hull.log.get_snapshot()
+    assert len(snapshot.data) > 8
+
+    cluster.net_mgr.unsplit()
+    ts_1.hull.state.last_broadcast_time = 0
+    await ts_1.hull.state.send_heartbeats()
+    # heartbeat goes out, follower says it needs everything
+    await cluster.deliver_all_pending(out_only=True)
+    await ts_2.do_next_in_msg()
+    await ts_3.do_next_in_msg()
+    await cluster.deliver_all_pending(out_only=True)
+    await ts_1.do_next_in_msg()
+    await ts_1.do_next_in_msg()
+    chunks = [msg for msg in ts_1.out_messages if msg.get_code() == "install_snapshot"]
+    assert len(chunks) > 2
+    assert chunks[0].offset == 0
+    assert len(chunks[0].data) == 4
+    # lose the second chunk, the follower should ask for it again
+    # when it sees the third, and the rest should follow
+    ts_1.out_messages.remove(chunks[1])
+    in_ledger, out_ledger = await cluster.deliver_all_pending()
+    await asyncio.sleep(0.001)
+    resent = [msg for msg in in_ledger if msg.get_code() == "install_snapshot"
+              and msg.offset == 4]
+    assert len(resent) == 1
+    assert ts_3.operations.total == 7
+    assert ts_3.hull.get_applied_index() == 7
+    assert (await ts_3.hull.log.get_snapshot()).index == 6
+    assert await ts_3.hull.log.get_last_index() == 7
+    assert ts_1.hull.state.match_index[uri_3] == 7
+    assert ts_1.hull.state.replicators[uri_3].transfer is None
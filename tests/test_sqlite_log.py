@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+import asyncio
+import threading
+import pytest
+from raftframe.log.log_api import LogRec, SnapshotRec, RecordCode
+from raftframe.log.log_api import DurabilityPolicy, DurabilityMode
+from raftframe.log.sqlite_log import SqliteLog
+
+from servers import setup_logging
+
+setup_logging()
+
+async def test_sqlite_log_1(tmp_path):
+    log = SqliteLog()
+    await log.start(tmp_path)
+    meta = log.get_metadata()
+    assert (meta.term, meta.last_index, meta.last_term, meta.first_index) == (0, 0, 0, 1)
+    assert await log.read() is None
+    await log.set_term(1)
+    await log.append([LogRec(term=1, user_data="a"), LogRec(term=1, user_data="b")])
+    assert await log.incr_term() == 2
+    rec = await log.replace_or_append(LogRec(index=3, term=2, user_data="c"))
+    assert rec.index == 3
+    assert meta.last_index == 3
+    assert meta.last_term == 2
+    rec = await log.read(2)
+    assert rec.user_data == "b"
+    assert rec.code == RecordCode.client
+    assert (await log.read()).user_data == "c"
+    with pytest.raises(Exception):
+        await log.read(4)
+    with pytest.raises(Exception):
+        await log.replace_or_append(LogRec(index=5, term=2))
+    # overwrite in the middle leaves the end alone
+    await log.replace_or_append(LogRec(index=2, term=2, user_data="x"))
+    assert (await log.read(2)).term == 2
+    assert meta.last_index == 3
+    # the sqlite calls all run on the writer thread
+    thread_name = await log.run(lambda: threading.current_thread().name)
+    assert thread_name.startswith("raftframe-log")
+    await log.close()
+
+    # everything comes back on restart
+    log = SqliteLog()
+    await log.start(tmp_path)
+    meta = log.get_metadata()
+    assert (meta.term, meta.last_index, meta.last_term, meta.first_index) == (2, 3, 2, 1)
+    assert (await log.read(2)).user_data == "x"
+
+    await log.install_snapshot(SnapshotRec(index=2, term=2, data=b'{"total": 3}', config='{}'))
+    assert meta.first_index == 3
+    assert meta.last_index == 3
+    with pytest.raises(Exception):
+        await log.read(2)
+    snap = await log.get_snapshot()
+    assert snap.data == b'{"total": 3}'
+    assert snap.config == '{}'
+    # term doesn't match the kept record, so all go
+    await log.install_snapshot(SnapshotRec(index=5, term=3, data=b''))
+    assert (meta.first_index, meta.last_index, meta.last_term) == (6, 5, 3)
+    assert await log.read() is None
+    await log.close()
+
+    log = SqliteLog(synchronous="normal")
+    await log.start(tmp_path)
+    meta = log.get_metadata()
+    assert (meta.term, meta.last_index, meta.last_term, meta.first_index) == (2, 5, 3, 6)
+    await log.append([LogRec(term=3, user_data="d")])
+    assert (await log.read(6)).user_data == "d"
+    await log.close()
+
+    with pytest.raises(Exception):
+        SqliteLog(synchronous="sometimes")
+
+async def test_durability_1(tmp_path):
+    # group syncs are shared by everybody waiting in flush
+    log = SqliteLog(durability=DurabilityPolicy(DurabilityMode.group, group_ms=50))
+    await log.start(tmp_path)
+    counter = dict(syncs=0)
+    orig = log.syncer.sync_func
+    async def counting():
+        counter['syncs'] += 1
+        await orig()
+    log.syncer.sync_func = counting
+    meta = log.get_metadata()
+    async def command(value):
+        await log.append([LogRec(term=1, user_data=value)])
+        return await log.flush()
+    results = await asyncio.gather(*[command(f"c{i}") for i in range(5)])
+    assert meta.durable_index == 5
+    assert counter['syncs'] == 1
+    assert results == [5] * 5
+    # replacing a record means it isn't durable until the next sync
+    await log.replace_or_append(LogRec(index=3, term=2, user_data="x"))
+    assert meta.durable_index == 2
+    assert await log.flush() == 5
+    assert counter['syncs'] == 2
+    await log.close()
+
+async def test_read_range_1(tmp_path):
+    log = SqliteLog()
+    await log.start(tmp_path)
+    await log.append([LogRec(term=1, user_data=f"{i:02d}") for i in range(1, 31)])
+    recs = await log.read_range(5, 9)
+    assert [rec.index for rec in recs] == [5, 6, 7, 8, 9]
+    assert recs[0].user_data == "05"
+    assert len(await log.read_range(25)) == 6
+    assert len(await log.read_range(25, 100)) == 6
+    assert await log.read_range(31) == []
+    # two bytes each, the first one always comes back
+    assert len(await log.read_range(1, None, 7)) == 3
+    assert len(await log.read_range(1, None, 1)) == 1
+    assert [rec.index for rec in await log.read_range(9, 14, 6)] == [9, 10, 11]
+
+    seen = [rec.index async for rec in log.iter_from(3)]
+    assert seen == list(range(3, 31))
+    seen = [rec.user_data async for rec in log.iter_from(28, 29)]
+    assert seen == ["28", "29"]
+    # records added along the way show up
+    seen = []
+    async for rec in log.iter_from(29):
+        seen.append(rec.index)
+        if rec.index == 30:
+            await log.append([LogRec(term=1, user_data="31")])
+    assert seen == [29, 30, 31]
+
+    await log.install_snapshot(SnapshotRec(index=20, term=1, data=b""))
+    with pytest.raises(Exception):
+        await log.read_range(20)
+    assert [rec.index for rec in await log.read_range(21, 22)] == [21, 22]
+    await log.close()
+
+async def test_truncate_from_1(tmp_path):
+    log = SqliteLog()
+    await log.start(tmp_path)
+    meta = log.get_metadata()
+    await log.append([LogRec(term=1, user_data=f"{i:02d}") for i in range(1, 21)])
+    await log.append([LogRec(term=2, user_data=f"{i:02d}") for i in range(21, 31)])
+    await log.truncate_from(31)
+    assert meta.last_index == 30
+    await log.truncate_from(22)
+    assert (meta.last_index, meta.last_term) == (21, 2)
+    with pytest.raises(Exception):
+        await log.read(22)
+    await log.truncate_from(6)
+    assert (meta.last_index, meta.last_term) == (5, 1)
+    assert meta.durable_index == 5
+    await log.append([LogRec(term=3, user_data="new")])
+    assert (await log.read(6)).user_data == "new"
+    assert [rec.index for rec in await log.read_range(1)] == [1, 2, 3, 4, 5, 6]
+    await log.install_snapshot(SnapshotRec(index=3, term=1, data=b""))
+    with pytest.raises(Exception):
+        await log.truncate_from(3)
+    await log.truncate_from(4)
+    assert (meta.last_index, meta.last_term) == (3, 1)
+    await log.close()
+    # and it stays that way
+    await log.start(tmp_path)
+    assert (meta.first_index, meta.last_index, meta.last_term) == (4, 3, 1)
+    await log.close()